@@ -0,0 +1,118 @@
+import os
+import re
+import logging
+import threading
+from collections import namedtuple
+
+
+# one line of the routes file. exact is [(label, value)], regex is
+# [(label, compiled pattern)].
+Route = namedtuple('Route', ['chat_id', 'exact', 'regex'])
+
+
+class AlertRouter:
+    """
+    route alerts of AlertManager to chats by their labels.
+
+    routes are read from ENV/alert_routes, one line a route:
+        CHAT_ID [MATCHER ...]
+    MATCHER is `label=value' (equal) or `label=~regex' (whole value
+    matches). an alert is sent to chats of all routes whose matchers all
+    match, a route without matcher takes every alert. alerts that match no
+    route go to default_chat (ALERT_GROUP_NUMBER). lines start with `#' are
+    ignored. without the file, all alerts go to default_chat.
+
+    routes are compiled into an index on one equal matcher of each route,
+    so an alert only checks routes indexed by its own label values, plus
+    routes with regex matchers only. the file is parsed again only when it
+    changes.
+    """
+    def __init__(self, default_chat, path = 'ENV/alert_routes'):
+        self.default_chat = default_chat
+        self.path = path
+        self._lock = threading.Lock()
+        self._stamp = None
+        # ({(label, value): [Route]}, [Route]), the second are routes 
+        # without equal matcher, checked for every alert
+        self._routes = ({}, [])
+
+    @staticmethod
+    def parse_route(line):
+        """
+        parse a line into a Route. return (route, None), or (None, error
+        message) if a matcher is invalid.
+        """
+        chat_id, *matchers = line.split()
+        exact = []
+        regex = []
+        for matcher in matchers:
+            if '=~' in matcher:
+                label, pattern = matcher.split('=~', 1)
+                try:
+                    regex.append((label, re.compile(pattern)))
+                except re.error as e:
+                    return None, f'invalid regex {pattern}: {e}'
+            elif '=' in matcher:
+                exact.append(tuple(matcher.split('=', 1)))
+            else:
+                return None, f'invalid matcher {matcher}'
+        return Route(chat_id, exact, regex), None
+
+    def _refresh(self):
+        try:
+            st = os.stat(self.path)
+            stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        except OSError:
+            stamp = None
+        if stamp == self._stamp:
+            return
+        with self._lock:
+            if stamp == self._stamp:
+                return
+            index = {}
+            scan = []
+            lines = [] if stamp is None else open(self.path).read().split('\n')
+            for line in lines:
+                line = line.strip()
+                if line == '' or line.startswith('#'):
+                    continue
+                route, err = self.parse_route(line)
+                if err is not None:
+                    logging.error(f'unrecognized alert route: {line}, {err}')
+                elif len(route.exact):
+                    index.setdefault(route.exact[0], []).append(route)
+                else:
+                    scan.append(route)
+            self._routes = (index, scan)
+            self._stamp = stamp
+            count = sum(len(x) for x in index.values()) + len(scan)
+            logging.info(f'loaded {count} alert routes')
+
+    @staticmethod
+    def _match(route, labels):
+        for label, value in route.exact:
+            if labels.get(label) != value:
+                return False
+        for label, pattern in route.regex:
+            value = labels.get(label)
+            if value is None or pattern.fullmatch(str(value)) is None:
+                return False
+        return True
+
+    def route(self, labels):
+        """
+        chat ids to send an alert with labels (a dict), without duplicates.
+        """
+        self._refresh()
+        index, scan = self._routes
+        chats = []
+        for key in labels.items():
+            for route in index.get(key, []):
+                if route.chat_id not in chats and self._match(route, labels):
+                    chats.append(route.chat_id)
+        for route in scan:
+            if route.chat_id not in chats and self._match(route, labels):
+                chats.append(route.chat_id)
+        if len(chats) == 0 and self.default_chat:
+            chats.append(self.default_chat)
+        return chats
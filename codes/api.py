@@ -1,7 +1,10 @@
 #! /usr/bin/env python3.8
 import os
+import json
+import time
+import asyncio
 import logging
-import requests
+import threading
 
 APP_ID = os.getenv("APP_ID")
 APP_SECRET = os.getenv("APP_SECRET")
@@ -10,14 +13,67 @@ APP_SECRET = os.getenv("APP_SECRET")
 TENANT_ACCESS_TOKEN_URI = "/open-apis/auth/v3/tenant_access_token/internal"
 MESSAGE_URI = "/open-apis/im/v1/messages"
 USER_URI = '/open-apis/contact/v3/users'
+BATCH_MESSAGE_URI = '/open-apis/message/v4/batch_send/'
+# max users of one batch_send call
+BATCH_SEND_MAX_USERS = 200
+# tenant_access_token is fetched again this many seconds before it expires
+TOKEN_REFRESH_MARGIN = 300
 
 
-class MessageApiClient(object):
+def _requests():
+    # requests is slow to import, so it is imported on first API call
+    import requests
+    return requests
+
+
+# Lark codes of an app without the scope of an API
+NO_PERMISSION_CODES = {99991672, 99991679}
+
+
+def batch_send_unavailable(e):
+    """
+    whether error e of batch_send means the API can not be used by this 
+    app (no permission, or not provided by a private deployment). other 
+    errors, e.g. rate limit or invalid content, are worth a retry.
+    """
+    response = getattr(e, 'response', None)
+    if getattr(response, 'status_code', None) == 404:
+        return True
+    code = getattr(e, 'code', None)
+    if code is None and response is not None:
+        try:
+            code = response.json().get('code')
+        except ValueError:
+            pass
+    return code in NO_PERMISSION_CODES
+
+
+def _message_id(data):
+    return data.get("data", {}).get("message_id")
+
+
+def _invalid_user_ids(data):
+    return data.get("data", {}).get("invalid_user_ids", [])
+
+
+def _is_tenant_manager(data):
+    return data['data']['user']['is_tenant_manager']
+
+
+class _MessageApiBase(object):
+    """
+    requests and results of Lark APIs shared by MessageApiClient and
+    AsyncMessageApiClient. each API is described by a request tuple
+    (method, uri, params, json body, parser of the response dict), the
+    clients only do the HTTP call by _call. helpers returning self.xxx(...)
+    return a coroutine in the async client.
+    """
     def __init__(self, app_id, app_secret, lark_host):
         self._app_id = app_id
         self._app_secret = app_secret
         self._lark_host = lark_host
         self._tenant_access_token = ""
+        self._token_expire = 0
         self._admin_cache = {}
 
     @staticmethod
@@ -29,75 +85,94 @@ class MessageApiClient(object):
     def tenant_access_token(self):
         return self._tenant_access_token
 
-    def send_text_with_open_id(self, open_id, content):
-        self.send("open_id", open_id, "text", content)
-
-    def reply_text_with_message_id(self, message_id, content):
-        self.reply(message_id, "text", content)
-
-    def reply_user_id(self, message_id, user_id):
-        self.reply(message_id, "text", self._c_msg(f"ID: {user_id}"))
-
-    def reply(self, message_id, msg_type, content):
-        # reply message
-        self._authorize_tenant_access_token()
-        url = f"{self._lark_host}{MESSAGE_URI}/{message_id}/reply"
-        headers = {
+    def _headers(self):
+        return {
             "Content-Type": "application/json; charset=utf-8",
             "Authorization": "Bearer " + self.tenant_access_token,
         }
 
-        req_body = {
-            "content": content,
-            "msg_type": msg_type,
-        }
-        resp = requests.post(url=url, headers=headers, json=req_body)
-        MessageApiClient._check_error_response(resp)
+    def _token_valid(self):
+        # the token is reused until TOKEN_REFRESH_MARGIN before it expires
+        return time.monotonic() < self._token_expire
 
-    def send(self, receive_id_type, receive_id, msg_type, content):
-        # send message to user, implemented based on Feishu open api capability. doc link: https://open.feishu.cn/document/uAjLw4CM/ukTMukTMukTM/reference/im-v1/message/create
-        self._authorize_tenant_access_token()
-        url = "{}{}?receive_id_type={}".format(
-            self._lark_host, MESSAGE_URI, receive_id_type
-        )
-        headers = {
-            "Content-Type": "application/json; charset=utf-8",
-            "Authorization": "Bearer " + self.tenant_access_token,
-        }
+    def _token_request(self):
+        # get tenant_access_token, implemented based on Feishu open api capability. doc link: https://open.feishu.cn/document/ukTMukTMukTM/ukDNz4SO0MjL5QzM/auth-v3/auth/tenant_access_token_internal
+        # return url and form data
+        return (f"{self._lark_host}{TENANT_ACCESS_TOKEN_URI}",
+                {"app_id": self._app_id, "app_secret": self._app_secret})
+
+    def _set_token(self, resp):
+        self._check_error_response(resp)
+        data = resp.json()
+        self._tenant_access_token = data.get("tenant_access_token")
+        self._token_expire = (
+            time.monotonic() + data.get("expire", 0) - TOKEN_REFRESH_MARGIN)
+        logging.info('tenant_access_token refreshed')
 
-        req_body = {
+    def _reply_request(self, message_id, msg_type, content):
+        return ("POST", f"{MESSAGE_URI}/{message_id}/reply", None,
+                {"content": content, "msg_type": msg_type}, _message_id)
+
+    def _update_request(self, message_id, content):
+        # update a card message sent by bot, implemented based on Feishu open api capability. doc link: https://open.feishu.cn/document/uAjLw4CM/ukTMukTMukTM/reference/im-v1/message/patch
+        return ("PATCH", f"{MESSAGE_URI}/{message_id}", None,
+                {"content": content}, None)
+
+    def _send_request(self, receive_id_type, receive_id, msg_type, content):
+        # send message to user, implemented based on Feishu open api capability. doc link: https://open.feishu.cn/document/uAjLw4CM/ukTMukTMukTM/reference/im-v1/message/create
+        return ("POST", MESSAGE_URI, {"receive_id_type": receive_id_type}, {
             "receive_id": receive_id,
             "content": content,
             "msg_type": msg_type,
-        }
-        resp = requests.post(url=url, headers=headers, json=req_body)
-        MessageApiClient._check_error_response(resp)
+        }, None)
 
-    def _authorize_tenant_access_token(self):
-        # get tenant_access_token and set, implemented based on Feishu open api capability. doc link: https://open.feishu.cn/document/ukTMukTMukTM/ukDNz4SO0MjL5QzM/auth-v3/auth/tenant_access_token_internal
-        url = "{}{}".format(self._lark_host, TENANT_ACCESS_TOKEN_URI)
-        req_body = {"app_id": self._app_id, "app_secret": self._app_secret}
-        response = requests.post(url, req_body)
-        MessageApiClient._check_error_response(response)
-        self._tenant_access_token = response.json().get("tenant_access_token")
-        logging.warning(f't_access_token {self._tenant_access_token}')
+    def _batch_send_request(self, user_ids, text):
+        # send a text to at most BATCH_SEND_MAX_USERS users in one call, 
+        # return user_ids that are invalid
+        return ("POST", BATCH_MESSAGE_URI, None, {
+            "user_ids": user_ids,
+            "msg_type": "text",
+            "content": {"text": text},
+        }, _invalid_user_ids)
 
-    def check_user_is_admin(self, user_id):
-        if user_id not in self._admin_cache:
-            logging.warning('unknown user, check whether is admin')
-            self._admin_cache[user_id] = self._get_user_is_admin(user_id)
-        return self._admin_cache[user_id]
+    def _user_request(self, user_id):
+        return ("GET", f"{USER_URI}/{user_id}", {"user_id_type": "user_id"},
+                None, _is_tenant_manager)
 
-    def _get_user_is_admin(self, user_id):
-        self._authorize_tenant_access_token()
-        url = f'{self._lark_host}{USER_URI}/{user_id}?user_id_type=user_id'
-        headers = {
-            "Authorization": "Bearer " + self.tenant_access_token,
-        }
-        response = requests.get(url, headers = headers)
-        MessageApiClient._check_error_response(response)
-        is_admin = response.json()['data']['user']['is_tenant_manager']
-        return is_admin
+    def reply(self, message_id, msg_type, content):
+        # reply message, return message_id of the reply
+        return self._call(*self._reply_request(message_id, msg_type, content))
+
+    def update_card_with_message_id(self, message_id, content):
+        return self._call(*self._update_request(message_id, content))
+
+    def send(self, receive_id_type, receive_id, msg_type, content):
+        return self._call(*self._send_request(
+            receive_id_type, receive_id, msg_type, content))
+
+    def batch_send_text(self, user_ids, text):
+        return self._call(*self._batch_send_request(user_ids, text))
+
+    def send_text_with_open_id(self, open_id, content):
+        return self.send("open_id", open_id, "text", content)
+
+    def send_text_to_user(self, user_id, text):
+        return self.send("user_id", user_id, "text", json.dumps({"text": text}))
+
+    def reply_text_with_message_id(self, message_id, content):
+        return self.reply(message_id, "text", content)
+
+    def reply_card_with_message_id(self, message_id, content):
+        return self.reply(message_id, "interactive", content)
+
+    def reply_user_id(self, message_id, user_id):
+        return self.reply(message_id, "text", self._c_msg(f"ID: {user_id}"))
+
+    def warm_up(self):
+        """
+        get tenant_access_token before the first message, see tasks.warm_up.
+        """
+        return self._authorize_tenant_access_token()
 
     @staticmethod
     def _check_error_response(resp):
@@ -111,6 +186,82 @@ class MessageApiClient(object):
             raise LarkException(code=code, msg=response_dict.get("msg"))
 
 
+class MessageApiClient(_MessageApiBase):
+    def __init__(self, app_id, app_secret, lark_host):
+        super().__init__(app_id, app_secret, lark_host)
+        self._token_lock = threading.Lock()
+
+    def _call(self, method, uri, params, body, parse):
+        self._authorize_tenant_access_token()
+        resp = _requests().request(
+            method, f"{self._lark_host}{uri}", params = params,
+            headers = self._headers(), json = body)
+        self._check_error_response(resp)
+        return None if parse is None else parse(resp.json())
+
+    def _authorize_tenant_access_token(self):
+        if self._token_valid():
+            return
+        with self._token_lock:
+            if self._token_valid():
+                return
+            self._set_token(_requests().post(*self._token_request()))
+
+    def check_user_is_admin(self, user_id):
+        if user_id not in self._admin_cache:
+            logging.debug('unknown user, check whether is admin')
+            self._admin_cache[user_id] = self._call(
+                *self._user_request(user_id))
+        return self._admin_cache[user_id]
+
+
+class AsyncMessageApiClient(_MessageApiBase):
+    """
+    same as MessageApiClient, but methods are coroutines, used by asgi.py. 
+    one httpx.AsyncClient is shared by all requests, call aclose when exit.
+    """
+    def __init__(self, app_id, app_secret, lark_host):
+        super().__init__(app_id, app_secret, lark_host)
+        self._token_lock = asyncio.Lock()
+        self._http = None
+
+    @property
+    def _client(self):
+        # httpx is imported and the client is created on first API call
+        if self._http is None:
+            import httpx
+            self._http = httpx.AsyncClient(timeout = 30)
+        return self._http
+
+    async def aclose(self):
+        if self._http is not None:
+            await self._http.aclose()
+
+    async def _call(self, method, uri, params, body, parse):
+        await self._authorize_tenant_access_token()
+        resp = await self._client.request(
+            method, f"{self._lark_host}{uri}", params = params,
+            headers = self._headers(), json = body)
+        self._check_error_response(resp)
+        return None if parse is None else parse(resp.json())
+
+    async def _authorize_tenant_access_token(self):
+        if self._token_valid():
+            return
+        async with self._token_lock:
+            if self._token_valid():
+                return
+            url, data = self._token_request()
+            self._set_token(await self._client.post(url, data = data))
+
+    async def check_user_is_admin(self, user_id):
+        if user_id not in self._admin_cache:
+            logging.debug('unknown user, check whether is admin')
+            self._admin_cache[user_id] = await self._call(
+                *self._user_request(user_id))
+        return self._admin_cache[user_id]
+
+
 class LarkException(Exception):
     def __init__(self, code=0, msg=None):
         self.code = code
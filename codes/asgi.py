@@ -0,0 +1,221 @@
+#!/usr/bin/env python3.8
+"""
+asyncio entry of the bot, same callbacks as server.py. run with
+
+    uvicorn asgi:app --host 0.0.0.0 --port 29980
+
+Lark API calls and remote queries are coroutines, so slow servers do not
+hold a thread per request. commands without coroutine version run in
+worker threads, and call Lark API in the event loop.
+"""
+
+import os
+import asyncio
+import logging
+import threading
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from db import RedisConnect
+from command import CommandParser
+from api import AsyncMessageApiClient
+from event import (
+    MessageReceiveEvent,
+    UrlVerificationEvent,
+    AlertManagerEvent,
+    EventManager,
+    CallbackVerifier,
+    InvalidEventException
+)
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from dotenv import load_dotenv, find_dotenv
+from utils import (
+    alertmanager_card,
+    update_hosts
+)
+from tasks import register_tasks, warm_up
+from leader import LeaderLease
+from alerts import AlertRouter
+from log import setup_logging, log_context
+import telemetry
+
+# load env parameters form file named .env
+load_dotenv(find_dotenv())
+setup_logging()
+
+# load from env
+APP_ID = os.getenv("APP_ID")
+APP_SECRET = os.getenv("APP_SECRET")
+VERIFICATION_TOKEN = os.getenv("VERIFICATION_TOKEN")
+ENCRYPT_KEY = os.getenv("ENCRYPT_KEY")
+LARK_HOST = os.getenv("LARK_HOST")
+ALERT_GROUP_NUMBER = os.getenv("ALERT_GROUP_NUMBER")
+# chats of alerts by labels, see ENV/alert_routes
+alert_router = AlertRouter(ALERT_GROUP_NUMBER)
+# threads for commands without coroutine version and db access
+ASGI_WORKER_THREADS = int(os.getenv("ASGI_WORKER_THREADS", 64))
+
+# event loop of the app, set when app starts
+loop = None
+
+
+def in_loop(func):
+    """
+    wrap coroutine function func to a normal function for worker threads,
+    which runs func in the event loop and waits for its result.
+    """
+    def wrapper(*args, **kwargs):
+        return asyncio.run_coroutine_threadsafe(
+            func(*args, **kwargs), loop).result()
+    return wrapper
+
+
+# init service
+message_api_client = AsyncMessageApiClient(APP_ID, APP_SECRET, LARK_HOST)
+event_manager = EventManager(VERIFICATION_TOKEN, ENCRYPT_KEY)
+database = RedisConnect()
+# scheduled jobs on shared data run only on the leader instance
+leader = LeaderLease(database.conn)
+command_parser = CommandParser(
+    message_api_callback = in_loop(
+        message_api_client.reply_text_with_message_id),
+    message_api_callback_text_argname = 'content',
+    check_user_is_admin = in_loop(message_api_client.check_user_is_admin),
+    database = database,
+    message_api_reply_card = in_loop(
+        message_api_client.reply_card_with_message_id),
+    message_api_update_card = in_loop(
+        message_api_client.update_card_with_message_id),
+    message_api_async_callback =
+        message_api_client.reply_text_with_message_id,
+    message_api_async_reply_card =
+        message_api_client.reply_card_with_message_id,
+    message_api_async_update_card =
+        message_api_client.update_card_with_message_id,
+    message_api_batch_send = in_loop(message_api_client.batch_send_text),
+    message_api_send_user = in_loop(message_api_client.send_text_to_user),
+    message_api_async_batch_send = message_api_client.batch_send_text,
+    message_api_async_send_user = message_api_client.send_text_to_user
+)
+
+# set when Redis and Lark token are ready, see /ready
+ready = threading.Event()
+scheduler = None
+
+
+def start_background():
+    """
+    update /etc/hosts, start scheduler and warm up in background, so 
+    requests are served as soon as the app starts. the scheduler does not
+    wait for warm up, so passwords are locked even if Lark is unreachable.
+    """
+    global scheduler
+    update_hosts()
+    # init scheduler, jobs are blocking so run in threads
+    from apscheduler.schedulers.background import BackgroundScheduler
+    scheduler = BackgroundScheduler()
+    leader.start()
+    register_tasks(scheduler, database, leader)
+    scheduler.start()
+    warm_up(database, in_loop(message_api_client.warm_up), ready)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global loop
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(ASGI_WORKER_THREADS))
+    threading.Thread(target = start_background, daemon = True).start()
+    yield
+    if scheduler is not None:
+        scheduler.shutdown(wait = False)
+    leader.stop()
+    await message_api_client.aclose()
+
+
+app = FastAPI(lifespan = lifespan)
+
+
+@event_manager.register("url_verification")
+async def request_url_verify_handler(req_data: UrlVerificationEvent):
+    # url verification, just need return challenge
+    if not CallbackVerifier.same_string(req_data.event.token,
+                                        VERIFICATION_TOKEN):
+        raise Exception("VERIFICATION_TOKEN is invalid")
+    return {"challenge": req_data.event.challenge}
+
+
+@event_manager.register("im.message.receive_v1")
+async def message_receive_event_handler(req_data: MessageReceiveEvent):
+    message = req_data.event.message
+    if message.message_type != "text":
+        logging.info("Other types of messages have not been processed yet")
+        return {}
+    message_id = message.message_id
+    with log_context(request_id = message_id):
+        msg_ptime = await asyncio.to_thread(
+            database.message_id_last_process_time, message_id)
+        if msg_ptime == 0:
+            await command_parser.aparse(req_data, {'message_id': message_id})
+        else:
+            logging.info("message that has received bebore!")
+    return {}
+
+
+@event_manager.register("alert_manager")
+async def alert_manager_event_handler(req_data: AlertManagerEvent):
+    data = req_data.event
+    logging.info(f'alertmanager: {req_data.dict}')
+    for alert in data.alerts:
+        title, message = alertmanager_card(alert)
+        chats = alert_router.route(vars(alert.labels))
+        # a failed chat should not stop the others
+        results = await asyncio.gather(*[
+            message_api_client.send('chat_id', chat_id, 'interactive', message)
+            for chat_id in chats
+        ], return_exceptions = True)
+        for chat_id, res in zip(chats, results):
+            if isinstance(res, Exception):
+                logging.error(f'send alert {title} to {chat_id} failed: {res}')
+    return {}
+
+
+@app.exception_handler(Exception)
+async def msg_error_handler(request: Request, ex: Exception):
+    import httpx
+    logging.error(ex)
+    return JSONResponse(
+        {"message": str(ex)},
+        status_code = (
+            ex.response.status_code
+            if isinstance(ex, httpx.HTTPStatusError) else 500
+        )
+    )
+
+
+@app.post("/telemetry")
+async def telemetry_handler(request: Request):
+    # usage pushed by bash-scripts/monitor-agent
+    res, status, headers = await asyncio.to_thread(
+        telemetry.receive, database, request.headers, await request.body())
+    return JSONResponse(res, status_code = status, headers = headers)
+
+
+@app.get("/ready")
+async def ready_handler():
+    # 200 when Redis and Lark token are ready, else 503
+    if not ready.is_set():
+        return JSONResponse({"ready": False}, status_code = 503)
+    return {"ready": True}
+
+
+@app.post("/")
+async def callback_event_handler(request: Request):
+    # init callback instance and handle
+    try:
+        event_handler, event = event_manager.parse(
+            request.headers, await request.body())
+    except InvalidEventException as e:
+        logging.warning(e)
+        return JSONResponse({"message": str(e)}, status_code = e.status_code)
+    return await event_handler(event)
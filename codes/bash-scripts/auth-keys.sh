@@ -0,0 +1,114 @@
+#!/bin/bash
+
+# Update SSH keys added by the robot, sent to `bash -s' over one SSH session.
+# usage: apply_auth_keys USER TAG, with new keys on stdin, one key a line.
+# keys in authorized_keys without TAG are kept, keys with TAG are replaced
+# by new keys with TAG appended. the file is written to a temp file and
+# renamed, so it is never half written, under flock of .authorized_keys.lock
+# (the file itself is replaced, so it can not hold the lock), so two runs
+# never drop each other's keys. prints a digest of the result.
+
+apply_auth_keys() {
+    local user=$1
+    local tag=$2
+    local dir=/home/$user/.ssh
+
+    if [[ -z $tag ]]; then
+        echo tag is empty >&2
+        return 1
+    fi
+    if [[ ! -e $dir ]]; then
+        mkdir $dir || return 1
+        chmod 700 $dir
+        chown $user:$user $dir
+    fi
+    (
+        if ! flock -w 30 9; then
+            echo lock $dir/authorized_keys failed >&2
+            exit 1
+        fi
+        _replace_auth_keys "$user" "$tag" $dir/authorized_keys
+    ) 9> $dir/.authorized_keys.lock
+}
+
+# usage: _replace_auth_keys USER TAG FILE, the locked part of apply_auth_keys
+_replace_auth_keys() {
+    local user=$1
+    local tag=$2
+    local file=$3
+    local tmp kept added key
+
+    tmp=`mktemp ${file%/*}/.authorized_keys.XXXXXX` || return 1
+    if [[ -e $file ]]; then
+        # status 1 only means no line is kept
+        grep -vF -- "$tag" $file > $tmp
+        if (( $? > 1 )); then
+            echo read $file failed >&2
+            rm -f $tmp
+            return 1
+        fi
+    fi
+    kept=`wc -l < $tmp`
+    added=0
+    while IFS= read -r key; do
+        if [[ -n $key ]]; then
+            if ! echo "$key $tag" >> $tmp; then
+                echo write $tmp failed >&2
+                rm -f $tmp
+                return 1
+            fi
+            added=$((added + 1))
+        fi
+    done
+    if ! { chmod 600 $tmp && chown $user:$user $tmp && mv -f $tmp $file; }
+    then
+        rm -f $tmp
+        return 1
+    fi
+    echo kept=$kept added=$added sha256=`sha256sum $file | cut -d ' ' -f 1`
+}
+
+# usage: apply_many_auth_keys TAG, with `USER KEY' lines on stdin. a line
+# of only `USER' means the user has no key. apply_auth_keys is run for each
+# user, and `USER ok' or `USER failed' is printed.
+apply_many_auth_keys() {
+    local tag=$1
+    local line user
+    local users=()
+    local -A keys
+
+    while IFS= read -r line; do
+        user=${line%% *}
+        if [[ -z $user ]]; then
+            continue
+        fi
+        if [[ -z ${keys[$user]+x} ]]; then
+            users+=("$user")
+            keys[$user]=
+        fi
+        if [[ $line == *' '* ]]; then
+            keys[$user]+="${line#* }"$'\n'
+        fi
+    done
+    for user in "${users[@]}"; do
+        if printf %s "${keys[$user]}" | apply_auth_keys "$user" "$tag" \
+                > /dev/null; then
+            echo $user ok
+        else
+            echo $user failed
+        fi
+    done
+}
+
+# usage: digest_auth_keys TAG USER..., prints `USER SHA256' for each user,
+# SHA256 is the digest of lines with TAG in authorized_keys of the user.
+digest_auth_keys() {
+    local tag=$1
+    local user file
+    shift
+    for user in "$@"; do
+        file=/home/$user/.ssh/authorized_keys
+        echo $user `{ [[ -e $file ]] && grep -F -- "$tag" $file; } \
+            | sha256sum | cut -d ' ' -f 1`
+    done
+}
@@ -1,52 +1,84 @@
 #!/bin/bash
 
-user=USER
-id=ID
+# Create a user with fixed UID and home layout. sent to `bash -s' over SSH,
+# usage: setup_user USER ID. safe to run again, only missing parts are
+# created. the last line of output is `status: STATUS', STATUS is one of
+# created, updated, unchanged, conflict and error.
 
-if [[ ${#id} -ne 10 ]]; then
-    echo ID length error! $user, $id
-    exit
-fi
+setup_user() {
+    local user=$1
+    local id=$2
+    local entry nowid folder link target
+    local changed=0
 
-if [[ -n `cat /etc/passwd | grep ^$user` ]]; then
-    echo user exists.
-    exit 1
-elif [[ -n `cat /etc/passwd | grep :$id:$id:` ]]; then
-    echo id exists.
-    exit 1
-else
-    echo user and id not exist. create it. 
-    # create new user
-    useradd -s /bin/bash -d /home/$user -m $user
-fi
+    if [[ ${#id} -ne 10 ]]; then
+        echo ID length error! $user, $id
+        echo status: error
+        return 1
+    fi
 
-if [[ ! -e /home/$user/data ]]; then
-    ln -s /data/$user /home/$user/data
-fi
+    entry=`getent passwd $user`
+    if [[ -z $entry ]]; then
+        if getent passwd $id > /dev/null; then
+            echo id exists. `getent passwd $id | cut -d : -f 1`
+            echo status: conflict
+            return 1
+        fi
+        echo user and id not exist. create it.
+        # create new user
+        useradd -s /bin/bash -d /home/$user -m $user || {
+            echo status: error
+            return 1
+        }
+        usermod -u $id $user && groupmod -g $id $user || {
+            echo status: error
+            return 1
+        }
+        entry=`getent passwd $user`
+        changed=2
+    fi
+    nowid=`echo $entry | cut -d : -f 3`
+    if [[ $nowid != $id ]]; then
+        echo user exists with id $nowid, expected $id
+        echo status: conflict
+        return 1
+    fi
 
-if [[ ! -e /home/$user/nas ]]; then
-    ln -s /nas/user/$user /home/$user/nas
-fi
+    for folder in /nas/user/$user /data/$user; do
+        if [[ ! -e $folder ]]; then
+            echo $folder not exist, create
+            mkdir -p $folder || {
+                echo status: error
+                return 1
+            }
+            changed=${changed/0/1}
+        fi
+        if [[ `stat -c %u:%g $folder` != $id:$id ]]; then
+            chown $user:$user $folder || {
+                echo status: error
+                return 1
+            }
+            changed=${changed/0/1}
+        fi
+    done
 
-nowid=`cat /etc/passwd | grep ^$user | awk -F : '{print $3}'`
-if [[ $nowid -ne $id ]]; then
-    echo user id not right! $nowid
-    usermod -u $id $user
-    groupmod -g $id $user
-fi
+    for link in /home/$user/data:/data/$user /home/$user/nas:/nas/user/$user \
+                /nas/user/$user/data:/data/$user; do
+        target=${link#*:}
+        link=${link%%:*}
+        # -L too, a dangling link exists for ln
+        if [[ ! -e $link && ! -L $link ]]; then
+            ln -s $target $link || {
+                echo status: error
+                return 1
+            }
+            changed=${changed/0/1}
+        fi
+    done
 
-folders=(/nas/user /data)
-for folder in ${folders[*]}; do
-    folder=$folder/$user
-    if [[ ! -e $folder ]]; then
-        echo $folder not exist, create
-        # create folder and change owner
-        mkdir $folder
-    else
-        echo $folder exists
-    fi
-    chown $user:$user $folder
-done
-if [[ ! -e /nas/user/$user/data ]]; then
-    ln -s /data/$user /nas/user/$user/data
-fi
+    case $changed in
+        0) echo status: unchanged ;;
+        1) echo status: updated ;;
+        *) echo status: created ;;
+    esac
+}
@@ -1,15 +1,21 @@
 #!/usr/bin/env python3
 
-import os 
 import sys
+import shlex
+import subprocess
+from multiprocessing.dummy import Pool
 
-def copy_shell(server, username, userid):
+
+def setup_user(server, username, userid):
+    """
+    send setuser.sh to `bash -s' of server by stdin and run it, so nothing
+    is written to /tmp and servers can run at the same time.
+    """
     script = open('setuser.sh').read()
-    script = script.replace('USER', username)
-    script = script.replace('ID', userid)
-    open('/tmp/setuser.sh', 'w').write(script)
-    os.system(f'scp /tmp/setuser.sh {server}:/tmp/setuser.sh')
-    os.system(f'ssh {server} "bash /tmp/setuser.sh"')
+    script += f'\nsetup_user {shlex.quote(username)} {shlex.quote(userid)}\n'
+    p = subprocess.run(['ssh', server, 'bash -s'], input = script,
+                       capture_output = True, text = True)
+    return server, p.stdout + p.stderr
 
 
 if __name__ == '__main__':
@@ -18,6 +24,10 @@ if __name__ == '__main__':
     username = sys.argv[2]
     userid = sys.argv[3]
     userid = userid[:7] + userid[8:]
-    for server in servers:
+    pool = Pool(8)
+    for server, output in pool.imap_unordered(
+            lambda x: setup_user(x, username, userid), servers):
         print(f'server {server}')
-        copy_shell(server, username, userid)
+        print(output)
+    pool.close()
+    pool.join()
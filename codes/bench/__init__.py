@@ -0,0 +1,3 @@
+"""
+benchmark tools. run from `codes' folder, e.g. `python -m bench.load_test'.
+"""
@@ -0,0 +1,100 @@
+"""
+Benchmark routing of alerts (alerts.AlertRouter) and alert cards.
+
+a routes file with one route per server (`hostname=...'), routes on
+alertname and severity and a few regex routes is generated, then random
+alerts are routed by the index, and by checking every route for
+comparison. time of generate_alert_card is printed too.
+
+usage (in `codes' folder):
+
+    python -m bench.alert_routing --hosts 1000 --alerts 20000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+from alerts import AlertRouter
+from utils import generate_alert_card
+
+
+ALERT_NAMES = ['DiskFull', 'GPUHot', 'HostDown', 'MemoryHigh', 'LoadHigh']
+SEVERITIES = ['info', 'warning', 'critical']
+
+
+def parse_args(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n')[1])
+    parser.add_argument('--hosts', type = int, default = 1000)
+    parser.add_argument('--alerts', type = int, default = 20000)
+    parser.add_argument('--seed', type = int, default = 0)
+    return parser.parse_args(argv)
+
+
+def write_routes(path, hosts):
+    lines = [f'oc_host_{i} hostname=node{i}' for i in range(hosts)]
+    lines += [f'oc_{x.lower()} alertname={x}' for x in ALERT_NAMES]
+    lines += [
+        'oc_oncall severity=critical',
+        'oc_gpu_team alertname=GPUHot hostname=~gpu.*',
+        'oc_disk_team alertname=~Disk.*',
+        'oc_lab hostname=~node1[0-9]',
+    ]
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def linear_route(router, labels):
+    # same result as router.route, by checking every route
+    index, scan = router._routes
+    chats = []
+    for route in [x for routes in index.values() for x in routes] + scan:
+        if route.chat_id not in chats and router._match(route, labels):
+            chats.append(route.chat_id)
+    return chats or [router.default_chat]
+
+
+def main(argv = None):
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+    path = os.path.join(tempfile.mkdtemp(prefix = 'alert_routes_'), 'routes')
+    write_routes(path, args.hosts)
+    router = AlertRouter('oc_default', path)
+    router.route({})
+    alerts = [{
+        'alertname': rng.choice(ALERT_NAMES),
+        'severity': rng.choice(SEVERITIES),
+        'hostname': rng.choice(['node', 'gpu']) + str(
+            rng.randrange(args.hosts * 2)),
+        '__alert_rule_uid__': f'rule{rng.randrange(100)}',
+    } for _ in range(args.alerts)]
+
+    start = time.perf_counter()
+    routed = [router.route(x) for x in alerts]
+    used_index = time.perf_counter() - start
+    sample = alerts[:max(1, args.alerts // 20)]
+    start = time.perf_counter()
+    linear = [linear_route(router, x) for x in sample]
+    used_linear = (time.perf_counter() - start) * len(alerts) / len(sample)
+    mismatch = sum(sorted(a) != sorted(b) for a, b in zip(routed, linear))
+    start = time.perf_counter()
+    for x in alerts:
+        generate_alert_card('firing', x['alertname'], [{'hostname': x[
+            'hostname'], 'value': 93.5}], x['__alert_rule_uid__'], 'fp')
+    used_card = time.perf_counter() - start
+
+    n = len(alerts)
+    print(f'{args.hosts + len(ALERT_NAMES) + 4} routes, {n} alerts, '
+          f'{sum(len(x) for x in routed) / n:.2f} chats per alert')
+    print(f'route by index:     {used_index / n * 1e6:8.2f} us/alert')
+    print(f'route by all rules: {used_linear / n * 1e6:8.2f} us/alert '
+          f'(estimated from {len(sample)} alerts)')
+    print(f'alert card:         {used_card / n * 1e6:8.2f} us/alert')
+    print(f'different routes: {mismatch}')
+    return 0 if mismatch == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+"""
+Build signed and encrypted callbacks the same way Lark does.
+"""
+import os
+import json
+import time
+import uuid
+import base64
+import hashlib
+from Crypto.Cipher import AES
+
+
+def encrypt(encrypt_key, data):
+    """
+    AES-256-CBC encrypt data with PKCS7 padding, return base64 string.
+    """
+    key = hashlib.sha256(encrypt_key.encode('utf8')).digest()
+    iv = os.urandom(AES.block_size)
+    data = data.encode('utf8')
+    pad = AES.block_size - len(data) % AES.block_size
+    data = data + bytes([pad]) * pad
+    cipher = AES.new(key, AES.MODE_CBC, iv)
+    return base64.b64encode(iv + cipher.encrypt(data)).decode('utf8')
+
+
+def message_event(token, message_id, user_id, text, chat_type = 'p2p'):
+    """
+    an im.message.receive_v1 event (schema 2.0).
+    """
+    now = str(int(time.time() * 1000))
+    return {
+        'schema': '2.0',
+        'header': {
+            'event_id': uuid.uuid4().hex,
+            'token': token,
+            'create_time': now,
+            'event_type': 'im.message.receive_v1',
+            'tenant_key': 'bench_tenant',
+            'app_id': 'bench_app',
+        },
+        'event': {
+            'sender': {
+                'sender_id': {
+                    'union_id': f'on_{user_id}',
+                    'user_id': user_id,
+                    'open_id': f'ou_{user_id}',
+                },
+                'sender_type': 'user',
+                'tenant_key': 'bench_tenant',
+            },
+            'message': {
+                'message_id': message_id,
+                'create_time': now,
+                'chat_id': f'oc_{user_id}',
+                'chat_type': chat_type,
+                'message_type': 'text',
+                'content': json.dumps({'text': text}),
+            },
+        },
+    }
+
+
+def signed_request(encrypt_key, event, timestamp = None):
+    """
+    encrypt event and sign it. return (headers, body bytes).
+    """
+    body = json.dumps(
+        {'encrypt': encrypt(encrypt_key, json.dumps(event))}).encode('utf8')
+    timestamp = str(int(time.time())) if timestamp is None else str(timestamp)
+    nonce = uuid.uuid4().hex
+    signature = hashlib.sha256(
+        (timestamp + nonce + encrypt_key).encode('utf8') + body).hexdigest()
+    headers = {
+        'Content-Type': 'application/json',
+        'X-Lark-Request-Timestamp': timestamp,
+        'X-Lark-Request-Nonce': nonce,
+        'X-Lark-Signature': signature,
+    }
+    return headers, body
@@ -0,0 +1,65 @@
+"""
+A fake `nvidia-smi' for running monitor-agent and my-monitor on a machine
+without GPU. only the CSV queries used by my-monitor are answered, values
+change slowly with time. envs:
+
+    FAKE_GPUS     number of GPUs, default 4
+    FAKE_GPU_SEED seed of values, e.g. index of the fake server
+    FAKE_GPU_PIDS comma separated pids shown as GPU processes, default 1
+"""
+import os
+import sys
+import math
+import time
+import random
+
+
+def gpus(count, seed, now):
+    rows = []
+    for i in range(count):
+        rng = random.Random(f'{seed}-{i}')
+        total = rng.choice([11264, 24576, 81920])
+        # changes every 5 seconds
+        phase = (now // 5 + rng.random() * 10) / 3
+        util = int(50 + 50 * math.sin(phase)) if rng.random() < 0.7 else 0
+        used = int(total * util / 100 * 0.9)
+        rows.append({
+            'uuid': f'GPU-fake-{seed}-{i}',
+            'temp': 35 + util // 3,
+            'total': total,
+            'used': used,
+            'util': util,
+            'index': i,
+        })
+    return rows
+
+
+def main(argv):
+    count = int(os.getenv('FAKE_GPUS', 4))
+    seed = os.getenv('FAKE_GPU_SEED', '0')
+    rows = gpus(count, seed, int(time.time()))
+    query = ' '.join(argv)
+    if '--query-gpu' in query:
+        print('uuid, temperature.gpu, memory.total [MiB], '
+              'memory.used [MiB], utilization.gpu [%], index')
+        for x in rows:
+            print(f'{x["uuid"]}, {x["temp"]}, {x["total"]} MiB, '
+                  f'{x["used"]} MiB, {x["util"]} %, {x["index"]}')
+    elif '--query-compute-apps' in query:
+        pids = os.getenv('FAKE_GPU_PIDS', '1')
+        print('pid, gpu_uuid, used_gpu_memory [MiB]')
+        busy = [x for x in rows if x['used'] > 0]
+        for i, pid in enumerate(pids.split(',')):
+            if len(busy) == 0:
+                break
+            x = busy[i % len(busy)]
+            print(f'{pid}, {x["uuid"]}, {x["used"]} MiB')
+    else:
+        print('fake nvidia-smi only answers --query-gpu and '
+              '--query-compute-apps', file = sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,184 @@
+"""
+Fake fleet for benchmarks. replaces `ssh.exec_cmd' so no real server is
+touched; every remote call sleeps for a simulated latency and may fail.
+"""
+import os
+import re
+import time
+import asyncio
+import shlex
+import hashlib
+import random
+import threading
+from collections import defaultdict
+
+
+NVIDIA_SMI_OUTPUT = """\
++-----------------------------------------------------------------------------+
+| NVIDIA-SMI 525.60.13    Driver Version: 525.60.13    CUDA Version: 12.0     |
+|-------------------------------+----------------------+----------------------+
+| GPU  Name        Persistence-M| Bus-Id        Disp.A | Volatile Uncorr. ECC |
+|===============================+======================+======================|
+|   0  FAKE GPU            Off  | 00000000:01:00.0 Off |                  N/A |
+| 30%   35C    P8    20W / 350W |      1MiB / 24576MiB |      0%      Default |
++-------------------------------+----------------------+----------------------+
+"""
+
+MY_MONITOR_OUTPUT = """\
+CPU usage:      1.0%, CPU Temprature: 40.0
+Memory usage:   5.0%, All memory: 257000.0 MiB
+===============================================================================
+GPU 0, Temp: 35, Util:  0%, Mem:  0%, TotMem:24576M
+"""
+
+
+class FakeFleet:
+    """
+    simulate N hosts. latency is seconds per remote call, jitter is the
+    relative random range of latency, failure_rate is the probability that
+    a call fails like an unreachable host. down_hosts always fail after
+    timeout seconds.
+    """
+    def __init__(self, hosts, latency = 0.05, jitter = 0.5, failure_rate = 0.0,
+                 seed = None, down_hosts = (), timeout = 1.0):
+        self.hosts = set(hosts)
+        self.down_hosts = set(down_hosts)
+        self.timeout = timeout
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.seed = seed
+        self.random = random.Random(seed)
+        self._pid = os.getpid()
+        self.lock = threading.Lock()
+        self.calls = defaultdict(int)
+        self.failures = defaultdict(int)
+
+    @staticmethod
+    def target(cmd):
+        """
+        get target host of a ssh/scp command line.
+        """
+        cmd = cmd.strip()
+        if cmd.startswith('scp'):
+            found = re.search(r'\s([^\s:]+):\S*\s*$', cmd)
+        else:
+            found = re.match(r'ssh\s+(\S+)', cmd)
+        return found.group(1) if found else None
+
+    @staticmethod
+    def _script_output(input):
+        """
+        output of ssh.run_remote_script, as if the remote script succeeds.
+        """
+        lines = input.split('\n')
+        for i in range(len(lines) - 1, -1, -1):
+            try:
+                args = shlex.split(lines[i].split(' <<')[0])
+            except ValueError:
+                continue
+            if len(args) and args[0] in (
+                    'apply_many_auth_keys', 'digest_auth_keys', 'setup_user'):
+                break
+        else:
+            return ''
+        if args[0] == 'setup_user':
+            return 'status: unchanged\n'
+        if args[0] == 'digest_auth_keys':
+            empty = hashlib.sha256(b'').hexdigest()
+            return ''.join(f'{x} {empty}\n' for x in args[2:])
+        users = []
+        for line in lines[i + 1:]:
+            user = line.split(' ')[0]
+            if line.startswith('__') or user == '':
+                break
+            if user not in users:
+                users.append(user)
+        return ''.join(f'{x} ok\n' for x in users)
+
+    def _output(self, cmd, input = None):
+        if 'bash -s' in cmd and input is not None:
+            return self._script_output(input)
+        if 'nvidia-smi' in cmd:
+            return NVIDIA_SMI_OUTPUT
+        if 'drop_caches' in cmd:
+            return 'Cached:         8388608 kB\nCached:          262144 kB\n'
+        if 'my-monitor' in cmd and cmd.strip().startswith('ssh'):
+            return MY_MONITOR_OUTPUT
+        return ''
+
+    def _plan(self, cmd):
+        """
+        return: (host, seconds to sleep, whether failed)
+        """
+        host = self.target(cmd)
+        with self.lock:
+            if os.getpid() != self._pid:
+                # forked by multiprocessing pool, avoid same random sequence
+                self._pid = os.getpid()
+                self.random.seed(f'{self.seed}-{self._pid}')
+            delay = self.latency * (
+                1 + self.jitter * (2 * self.random.random() - 1))
+            failed = self.random.random() < self.failure_rate
+            if host in self.down_hosts:
+                failed = True
+                delay = self.timeout
+            self.calls[host] += 1
+            if failed:
+                self.failures[host] += 1
+        return host, max(0, delay), failed
+
+    def _result(self, cmd, input, host, failed, start):
+        from ssh import CommandResult
+        if host not in self.hosts:
+            returncode, out, err = (
+                255, '', f'ssh: Could not resolve hostname {host}')
+        elif failed:
+            returncode, out, err = (
+                255, '', f'ssh: connect to host {host} port 22: '
+                'Connection timed out'
+            )
+        else:
+            returncode, out, err = 0, self._output(cmd, input), ''
+        return CommandResult(
+            returncode, out, err, time.monotonic() - start, False, False)
+
+    def _timed_out(self, timeout, start):
+        from ssh import CommandResult
+        return CommandResult(
+            -9, '', f'command timed out after {timeout}s',
+            time.monotonic() - start, True, False)
+
+    def exec_cmd(self, cmd, timeout = None, input = None, max_output = None):
+        """
+        same interface as ssh.exec_cmd.
+        """
+        start = time.monotonic()
+        host, delay, failed = self._plan(cmd)
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            return self._timed_out(timeout, start)
+        time.sleep(delay)
+        return self._result(cmd, input, host, failed, start)
+
+    async def aexec_cmd(self, cmd, timeout = None, input = None,
+                        max_output = None):
+        """
+        same interface as ssh.aexec_cmd.
+        """
+        start = time.monotonic()
+        host, delay, failed = self._plan(cmd)
+        if timeout is not None and delay > timeout:
+            await asyncio.sleep(timeout)
+            return self._timed_out(timeout, start)
+        await asyncio.sleep(delay)
+        return self._result(cmd, input, host, failed, start)
+
+    def install(self):
+        """
+        replace ssh.exec_cmd and ssh.aexec_cmd with the fake ones.
+        """
+        import ssh
+        ssh.exec_cmd = self.exec_cmd
+        ssh.aexec_cmd = self.aexec_cmd
+        return self
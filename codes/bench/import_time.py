@@ -0,0 +1,125 @@
+"""
+Cold start benchmark of the bot.
+
+each run starts a new Python process, which imports `server.py' (or
+`asgi.py' and runs its lifespan), and reports seconds until the module is
+imported and until `ready' is set (Redis and Lark token are warm). the
+slowest imports of the last run are listed from `python -X importtime'.
+
+usage (in `codes' folder, Redis listening on localhost):
+
+    python -m bench.import_time --runs 5 [--asgi]
+"""
+import os
+import sys
+import json
+import logging
+import argparse
+import statistics
+import subprocess
+
+from bench.lark_mock import LarkMock
+
+
+CHILD = """
+import sys, time, json, asyncio
+start = time.perf_counter()
+import {module} as m
+imported = time.perf_counter() - start
+ready = None
+if hasattr(m, 'ready'):
+    async def serve():
+        async with m.app.router.lifespan_context(m.app):
+            await asyncio.to_thread(m.ready.wait, {timeout})
+    if {module!r} == 'asgi':
+        asyncio.run(serve())
+    else:
+        m.ready.wait({timeout})
+    if m.ready.is_set():
+        ready = time.perf_counter() - start
+print(json.dumps({{'import': imported, 'ready': ready}}))
+sys.stdout.flush()
+import os
+os._exit(0)
+"""
+
+
+def parse_args(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n')[1])
+    parser.add_argument('--runs', type = int, default = 5)
+    parser.add_argument('--asgi', action = 'store_true',
+                        help = 'start asgi.py instead of server.py')
+    parser.add_argument('--top', type = int, default = 15,
+                        help = 'number of slowest imports to list')
+    parser.add_argument('--timeout', type = float, default = 30)
+    parser.add_argument('--redis-host', default = '127.0.0.1')
+    parser.add_argument('--redis-port', type = int, default = 6379)
+    parser.add_argument('--redis-db', type = int, default = 15)
+    return parser.parse_args(argv)
+
+
+def run_once(args, env):
+    """
+    return: ({'import': seconds, 'ready': seconds or None},
+        [(cumulative us, module)] from -X importtime)
+    """
+    module = 'asgi' if args.asgi else 'server'
+    code = CHILD.format(module = module, timeout = args.timeout)
+    p = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        env = env, capture_output = True, text = True,
+        timeout = args.timeout + 30
+    )
+    if p.stdout.strip() == '':
+        raise RuntimeError(f'start failed:\n{p.stderr[-2000:]}')
+    result = json.loads(p.stdout.strip().split('\n')[-1])
+    imports = []
+    for line in p.stderr.split('\n'):
+        if line.startswith('import time:'):
+            fields = line[len('import time:'):].split('|')
+            if fields[1].strip().isdigit():
+                imports.append((int(fields[1]), fields[2].strip()))
+    return result, imports
+
+
+def main(argv = None):
+    args = parse_args(argv)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    lark = LarkMock().start()
+    env = dict(os.environ)
+    env.update({
+        'APP_ID': 'bench_app',
+        'APP_SECRET': 'bench_secret',
+        'VERIFICATION_TOKEN': 'bench_token',
+        'ENCRYPT_KEY': 'bench_encrypt_key',
+        'LARK_HOST': lark.url,
+        'REDIS_HOST': args.redis_host,
+        'REDIS_PORT': str(args.redis_port),
+        'REDIS_DB': str(args.redis_db),
+    })
+    results = []
+    imports = []
+    try:
+        for _ in range(args.runs):
+            result, imports = run_once(args, env)
+            results.append(result)
+    finally:
+        lark.stop()
+
+    print('slowest imports of last run (cumulative ms):')
+    top = sorted(imports, reverse = True)[:args.top]
+    for us, name in top:
+        print(f'{us / 1000:10.1f}  {name}')
+    print(f'{"":20} {"min":>8} {"median":>8} {"max":>8}  (ms, '
+          f'{len(results)} runs)')
+    for key in ['import', 'ready']:
+        values = [x[key] * 1000 for x in results if x[key] is not None]
+        if len(values) == 0:
+            print(f'{key:20} {"n/a":>8}')
+            continue
+        print(f'{key:20} {min(values):8.1f} {statistics.median(values):8.1f}'
+              f' {max(values):8.1f}')
+
+
+if __name__ == '__main__':
+    main()
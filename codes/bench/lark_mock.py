@@ -0,0 +1,181 @@
+"""
+A local stand-in of the Lark open API. only endpoints used by `api.py' are
+implemented, and every message sent by the bot is recorded for later checks.
+"""
+import time
+import json
+import threading
+from collections import defaultdict
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
+
+
+class LarkMock:
+    """
+    mock Lark server. run in a background thread with self.start().
+    """
+    def __init__(self, host = '127.0.0.1', port = 0, latency = 0.0,
+                 admin_users = (), batch_send = True, batch_send_errors = 0,
+                 invalid_users = (), invalid_chats = ()):
+        """
+        args:
+            latency: seconds to sleep before answering every API call.
+            admin_users: user_ids that are considered as tenant manager.
+            batch_send: False to answer batch_send with a no permission 
+                error (HTTP 400, code 99991672).
+            batch_send_errors: the first batch_send_errors calls of 
+                batch_send get a rate limit error (code 99991400).
+            invalid_users: user_ids that batch_send reports as invalid.
+            invalid_chats: receive_ids that send answers with HTTP 400.
+        """
+        self.latency = latency
+        self.admin_users = set(admin_users)
+        self.batch_send = batch_send
+        self.batch_send_errors = batch_send_errors
+        self.invalid_users = set(invalid_users)
+        self.invalid_chats = set(invalid_chats)
+        self.batch_sent = []
+        self.lock = threading.Lock()
+        self.replies = defaultdict(list)
+        self.updates = defaultdict(list)
+        self.sent = []
+        self.calls = defaultdict(int)
+        self._message_count = 0
+        self.app = self._build_app()
+        self.server = make_server(host, port, self.app, threaded = True)
+        self.url = f'http://{host}:{self.server.server_port}'
+        self._thread = None
+
+    def _new_message_id(self):
+        with self.lock:
+            self._message_count += 1
+            return f'om_mock_{self._message_count}'
+
+    def _count(self, name):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls[name] += 1
+
+    def _build_app(self):
+        app = Flask('lark_mock')
+
+        @app.route('/open-apis/auth/v3/tenant_access_token/internal',
+                   methods = ['POST'])
+        def tenant_access_token():
+            self._count('tenant_access_token')
+            return jsonify({
+                'code': 0,
+                'msg': 'ok',
+                'tenant_access_token': 't-mock-token',
+                'expire': 7200,
+            })
+
+        @app.route('/open-apis/im/v1/messages/<message_id>/reply',
+                   methods = ['POST'])
+        def reply(message_id):
+            self._count('reply')
+            body = request.get_json()
+            body['reply_message_id'] = self._new_message_id()
+            with self.lock:
+                self.replies[message_id].append(body)
+            return jsonify({
+                'code': 0,
+                'msg': 'ok',
+                'data': {'message_id': body['reply_message_id']},
+            })
+
+        @app.route('/open-apis/im/v1/messages/<message_id>',
+                   methods = ['PATCH'])
+        def update(message_id):
+            self._count('update')
+            body = request.get_json()
+            with self.lock:
+                self.updates[message_id].append(body)
+            return jsonify({'code': 0, 'msg': 'ok', 'data': {}})
+
+        @app.route('/open-apis/im/v1/messages', methods = ['POST'])
+        def send():
+            self._count('send')
+            body = request.get_json()
+            body['receive_id_type'] = request.args.get('receive_id_type')
+            if body.get('receive_id') in self.invalid_chats:
+                return jsonify({
+                    'code': 230002, 'msg': 'bot is not in the chat'}), 400
+            with self.lock:
+                self.sent.append(body)
+            return jsonify({
+                'code': 0,
+                'msg': 'ok',
+                'data': {'message_id': self._new_message_id()},
+            })
+
+        @app.route('/open-apis/message/v4/batch_send/', methods = ['POST'])
+        def batch_send():
+            self._count('batch_send')
+            if not self.batch_send:
+                return jsonify({
+                    'code': 99991672, 'msg': 'no permission'}), 400
+            with self.lock:
+                if self.batch_send_errors > 0:
+                    self.batch_send_errors -= 1
+                    return jsonify({
+                        'code': 99991400,
+                        'msg': 'request trigger frequency limit'})
+            body = request.get_json()
+            invalid = [
+                x for x in body['user_ids'] if x in self.invalid_users]
+            with self.lock:
+                self.batch_sent.append(body)
+            return jsonify({
+                'code': 0,
+                'msg': 'ok',
+                'data': {
+                    'message_id': f'bm-{self._new_message_id()}',
+                    'invalid_department_ids': [],
+                    'invalid_open_ids': [],
+                    'invalid_user_ids': invalid,
+                },
+            })
+
+        @app.route('/open-apis/contact/v3/users/<user_id>', methods = ['GET'])
+        def user(user_id):
+            self._count('user')
+            return jsonify({
+                'code': 0,
+                'msg': 'ok',
+                'data': {'user': {
+                    'user_id': user_id,
+                    'is_tenant_manager': user_id in self.admin_users,
+                }},
+            })
+
+        return app
+
+    def start(self):
+        self._thread = threading.Thread(
+            target = self.server.serve_forever, daemon = True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def reply_texts(self, message_id):
+        """
+        texts of all replies to message_id. for cards, the latest text.
+        """
+        with self.lock:
+            replies = list(self.replies.get(message_id, []))
+            updates = dict(self.updates)
+        res = []
+        for reply in replies:
+            content = json.loads(reply['content'])
+            if reply['msg_type'] == 'interactive':
+                card_id = reply.get('reply_message_id')
+                if card_id in updates:
+                    content = json.loads(updates[card_id][-1]['content'])
+                res.append(content['elements'][0]['text']['content'])
+            else:
+                res.append(content.get('text'))
+        return res
@@ -0,0 +1,294 @@
+"""
+End-to-end load test of the bot.
+
+`server.py' runs in this process against a local Lark mock (`lark_mock.py')
+and a local Redis, SSH is replaced by a fake fleet (`fake_ssh.py'). signed
+and encrypted callbacks are replayed at a target rate, some of them are
+retried with the same message_id to check deduplication.
+
+usage (in `codes' folder, Redis listening on localhost):
+
+    python -m bench.load_test --rate 20 --duration 30 --hosts 16 \\
+        --latency 0.2 --failure-rate 0.05 --retry-rate 0.1
+
+add --asgi to run `asgi.py' with uvicorn instead of `server.py'.
+
+WARNING: the selected Redis db (--redis-db, default 15) is flushed.
+"""
+import os
+import sys
+import time
+import random
+import socket
+import logging
+import argparse
+import tempfile
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from werkzeug.serving import make_server
+
+from bench.lark_mock import LarkMock
+from bench.fake_ssh import FakeFleet
+from bench.callback import message_event, signed_request
+
+
+DEFAULT_COMMANDS = [
+    'nvidia-smi {host}',
+    'my-monitor {host}',
+    'CheckAccount',
+    'GenerateNewPassword',
+]
+TOKEN = 'bench_verification_token'
+ENCRYPT_KEY = 'bench_encrypt_key'
+
+
+def parse_args(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n')[1])
+    parser.add_argument('--rate', type = float, default = 10,
+                        help = 'callbacks per second')
+    parser.add_argument('--duration', type = float, default = 10,
+                        help = 'seconds to send callbacks')
+    parser.add_argument('--concurrency', type = int, default = 64,
+                        help = 'max in-flight callbacks')
+    parser.add_argument('--hosts', type = int, default = 8,
+                        help = 'number of fake servers')
+    parser.add_argument('--users', type = int, default = 16,
+                        help = 'number of bound users')
+    parser.add_argument('--latency', type = float, default = 0.05,
+                        help = 'mean seconds per fake SSH call')
+    parser.add_argument('--jitter', type = float, default = 0.5,
+                        help = 'relative random range of SSH latency')
+    parser.add_argument('--failure-rate', type = float, default = 0.0,
+                        help = 'probability a fake SSH call fails')
+    parser.add_argument('--down-hosts', type = int, default = 0,
+                        help = 'number of fake servers that are always down')
+    parser.add_argument('--down-timeout', type = float, default = 1.0,
+                        help = 'seconds to wait before a down server fails')
+    parser.add_argument('--lark-latency', type = float, default = 0.0,
+                        help = 'seconds per Lark API call')
+    parser.add_argument('--retry-rate', type = float, default = 0.1,
+                        help = 'probability a callback is delivered twice')
+    parser.add_argument('--retry-delay', type = float, default = 0.2,
+                        help = 'seconds between a callback and its retry')
+    parser.add_argument('--command', action = 'append', dest = 'commands',
+                        help = 'command template, {host} is replaced by a '
+                               'random fake server. repeat to add more.')
+    parser.add_argument('--redis-host', default = '127.0.0.1')
+    parser.add_argument('--redis-port', type = int, default = 6379)
+    parser.add_argument('--redis-db', type = int, default = 15)
+    parser.add_argument('--asgi', action = 'store_true',
+                        help = 'serve asgi.py with uvicorn instead of '
+                               'server.py')
+    parser.add_argument('--seed', type = int, default = None)
+    parser.add_argument('--verbose', action = 'store_true',
+                        help = 'keep logs of the bot')
+    args = parser.parse_args(argv)
+    if not args.commands:
+        args.commands = DEFAULT_COMMANDS
+    return args
+
+
+def prepare_workdir(args):
+    """
+    create ENV files for fake hosts and accounts, and change into it, as
+    the bot reads ENV/* relative to working directory.
+    """
+    workdir = tempfile.mkdtemp(prefix = 'lark_bench_')
+    os.mkdir(os.path.join(workdir, 'ENV'))
+    hosts = [f'bench{i:02d}' for i in range(args.hosts)]
+    accounts = [f'benchuser{i:02d}' for i in range(args.users)]
+    open(os.path.join(workdir, 'ENV/available_servers'), 'w').write(
+        '\n'.join(hosts))
+    open(os.path.join(workdir, 'ENV/available_accounts'), 'w').write(
+        '\n'.join(accounts))
+    open(os.path.join(workdir, 'ENV/master_server'), 'w').write('benchmaster')
+    os.chdir(workdir)
+    return hosts + ['benchmaster'], accounts
+
+
+def start_bot(args, lark_url):
+    """
+    import server.py (or asgi.py) with benchmark environments and serve it
+    in a thread.
+    """
+    os.environ.update({
+        'APP_ID': 'bench_app',
+        'APP_SECRET': 'bench_secret',
+        'VERIFICATION_TOKEN': TOKEN,
+        'ENCRYPT_KEY': ENCRYPT_KEY,
+        'LARK_HOST': lark_url,
+        'AUTH_KEY_TAG': 'lark_bench',
+        'ALERT_GROUP_NUMBER': 'oc_bench_alert',
+        'REDIS_HOST': args.redis_host,
+        'REDIS_PORT': str(args.redis_port),
+        'REDIS_DB': str(args.redis_db),
+    })
+    if args.asgi:
+        return start_asgi_bot()
+    import server
+    httpd = make_server('127.0.0.1', 0, server.app, threaded = True)
+    threading.Thread(target = httpd.serve_forever, daemon = True).start()
+    return server, httpd, f'http://127.0.0.1:{httpd.server_port}/'
+
+
+class UvicornThread:
+    """
+    uvicorn server in a thread, same shutdown interface as werkzeug.
+    """
+    def __init__(self, app):
+        import uvicorn
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+        self.server = uvicorn.Server(uvicorn.Config(
+            app, host = '127.0.0.1', port = self.port,
+            log_level = 'warning', backlog = 4096))
+        self.thread = threading.Thread(target = self.server.run,
+                                       daemon = True)
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+
+    def shutdown(self):
+        self.server.should_exit = True
+        self.thread.join()
+
+
+def start_asgi_bot():
+    import asgi
+    httpd = UvicornThread(asgi.app)
+    return asgi, httpd, f'http://127.0.0.1:{httpd.port}/'
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    idx = min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))
+    return values[idx]
+
+
+class LoadTest:
+    def __init__(self, args, bot_url, users, hosts):
+        self.args = args
+        self.bot_url = bot_url
+        self.users = users
+        self.hosts = hosts
+        self.random = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.latency = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.sent_messages = {}
+        self._local = threading.local()
+
+    def _session(self):
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _post(self, command, event, delay = 0.0):
+        if delay:
+            time.sleep(delay)
+        headers, body = signed_request(ENCRYPT_KEY, event)
+        start = time.perf_counter()
+        try:
+            resp = self._session().post(self.bot_url, data = body,
+                                        headers = headers)
+            ok = resp.status_code == 200
+        except requests.RequestException:
+            ok = False
+        used = time.perf_counter() - start
+        with self.lock:
+            self.latency[command].append(used)
+            if not ok:
+                self.errors[command] += 1
+
+    def run(self):
+        args = self.args
+        total = int(args.rate * args.duration)
+        futures = []
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers = args.concurrency) as executor:
+            for i in range(total):
+                wait = start + i / args.rate - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+                template = self.random.choice(args.commands)
+                text = template.format(host = self.random.choice(self.hosts))
+                command = text.split(' ')[0]
+                user_id = self.random.choice(self.users)
+                message_id = f'om_bench_{start:.0f}_{i}'
+                event = message_event(TOKEN, message_id, user_id, text)
+                self.sent_messages[message_id] = command
+                futures.append(
+                    executor.submit(self._post, command, event))
+                if self.random.random() < args.retry_rate:
+                    futures.append(executor.submit(
+                        self._post, command, event, args.retry_delay))
+            for future in futures:
+                future.result()
+        self.elapsed = time.perf_counter() - start
+        self.requests = len(futures)
+
+    def report(self, lark):
+        print(f'{self.requests} callbacks ({len(self.sent_messages)} unique) '
+              f'in {self.elapsed:.2f}s, '
+              f'throughput {self.requests / self.elapsed:.2f} req/s')
+        print(f'{"command":<24}{"count":>8}{"errors":>8}'
+              f'{"p50(ms)":>10}{"p99(ms)":>10}{"max(ms)":>10}')
+        for command in sorted(self.latency):
+            values = self.latency[command]
+            print(f'{command:<24}{len(values):>8}{self.errors[command]:>8}'
+                  f'{percentile(values, 50) * 1000:>10.1f}'
+                  f'{percentile(values, 99) * 1000:>10.1f}'
+                  f'{max(values) * 1000:>10.1f}')
+        duplicated = []
+        missing = []
+        for message_id in self.sent_messages:
+            count = len(lark.replies.get(message_id, []))
+            if count == 0:
+                missing.append(message_id)
+            elif count > 1:
+                duplicated.append(message_id)
+        print(f'dedup: {len(duplicated)} messages processed more than once, '
+              f'{len(missing)} messages without reply')
+        print(f'lark api calls: {dict(lark.calls)}')
+        return len(duplicated) == 0 and len(missing) == 0
+
+
+def main(argv = None):
+    args = parse_args(argv)
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+    codes_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, codes_dir)
+    hosts, accounts = prepare_workdir(args)
+    users = [f'benchuid{i:02d}' for i in range(len(accounts))]
+    lark = LarkMock(latency = args.lark_latency).start()
+    fleet = FakeFleet(hosts, args.latency, args.jitter, args.failure_rate,
+                      args.seed, hosts[:args.down_hosts],
+                      args.down_timeout).install()
+    server, httpd, bot_url = start_bot(args, lark.url)
+    server.database.conn.flushdb()
+    for user_id, account in zip(users, accounts):
+        server.database.user_id_to_account_name(user_id, account)
+
+    test = LoadTest(args, bot_url, users, hosts[:-1])
+    test.run()
+    # wait a little for slow replies
+    time.sleep(args.retry_delay + args.latency * 2)
+    ok = test.report(lark)
+    # calls in forked pool workers are not counted
+    print(f'ssh calls in bot process: {sum(fleet.calls.values())}, '
+          f'failed: {sum(fleet.failures.values())}')
+    httpd.shutdown()
+    lark.stop()
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
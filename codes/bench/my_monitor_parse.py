@@ -0,0 +1,176 @@
+"""
+Benchmark parsing of bash-scripts/my-monitor with replayed outputs.
+
+outputs of nvidia-smi, top and ps of a big server (many GPUs, thousands of
+processes) are generated to a folder, then my-monitor runs with
+`REPLAY_DIR' set to it, so no GPU is needed. time of collect_gpu_data,
+collect_cpu_data, sample of monitor-agent and the screen of my-monitor is
+printed, with a checksum of collected data to check that a change of
+parsing keeps the output.
+
+usage (in `codes' folder):
+
+    python -m bench.my_monitor_parse --gpus 64 --procs 5000 [--runs 20]
+    python -m bench.my_monitor_parse --fixtures DIR  # my-monitor --record DIR
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import tempfile
+import contextlib
+import importlib.util
+from importlib.machinery import SourceFileLoader
+
+from bench import fake_nvidia_smi
+
+
+CODES_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USERS = ['alice', 'bob', 'carol', 'dave', 'eve', 'frank', 'root']
+
+
+def parse_args(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n')[1])
+    parser.add_argument('--gpus', type = int, default = 64)
+    parser.add_argument('--procs', type = int, default = 5000,
+                        help = 'processes in top and ps')
+    parser.add_argument('--gpu-procs', type = int, default = 500,
+                        help = 'processes on GPUs')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--runs', type = int, default = 20)
+    parser.add_argument('--fixtures',
+                        help = 'use outputs in this folder instead of '
+                               'generated ones')
+    parser.add_argument('--save', help = 'save generated outputs here')
+    return parser.parse_args(argv)
+
+
+def load_script(name):
+    path = os.path.join(CODES_DIR, 'bash-scripts', name)
+    loader = SourceFileLoader(name.replace('-', '_'), path)
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+def top_sample(rng, procs, cmds):
+    lines = [
+        'top - 10:00:00 up 100 days,  2 users,  load average: 30.0, 30.0, 30.0',
+        f'Tasks: {len(procs)} total,  40 running, {len(procs) - 40} sleeping,'
+        '   0 stopped,   0 zombie',
+        '%Cpu(s): 35.2 us,  3.1 sy,  0.0 ni, 61.2 id,  0.3 wa,  0.0 hi,'
+        '  0.2 si,  0.0 st',
+        'MiB Mem : 1031770.5 total, 401234.1 free, 512345.6 used,'
+        ' 118190.8 buff/cache',
+        'MiB Swap:   8192.0 total,   8192.0 free,      0.0 used.'
+        ' 509876.5 avail Mem',
+        '',
+        '    PID USER      PR  NI    VIRT    RES    SHR S  %CPU  %MEM'
+        '     TIME+ COMMAND',
+    ]
+    for pid, user in procs:
+        busy = rng.random() < 0.1
+        cpu = rng.uniform(90, 400) if busy else rng.uniform(0, 5)
+        mem = rng.uniform(0, 6) if busy else rng.uniform(0, 0.5)
+        lines.append(
+            f'{pid:>7} {user:<9} 20   0   10.2g   2.1g 102400 '
+            f'{"R" if busy else "S"} {cpu:5.1f} {mem:5.1f}  12:34.56 '
+            f'{cmds[pid].split()[0]}')
+    return lines
+
+
+def generate(folder, args):
+    """
+    write outputs of commands used by my-monitor to folder.
+    """
+    rng = random.Random(args.seed)
+    gpus = fake_nvidia_smi.gpus(args.gpus, args.seed, 0)
+    pids = rng.sample(range(1000, 4000000), args.procs)
+    procs = [(pid, rng.choice(USERS)) for pid in pids]
+    cmds = {
+        pid: f'python train_{pid % 97}.py --config configs/exp{pid}.yaml '
+             f'--lr {rng.random():.4f}'
+        for pid in pids
+    }
+    files = {}
+    files['query-gpu'] = [
+        'uuid, temperature.gpu, memory.total [MiB], memory.used [MiB], '
+        'utilization.gpu [%], index'] + [
+        f'{x["uuid"]}, {x["temp"]}, {x["total"]} MiB, {x["used"]} MiB, '
+        f'{x["util"]} %, {x["index"]}' for x in gpus]
+    # some GPU processes are gone from top, shown as `Unknown PID!'
+    gpu_pids = rng.sample(pids, min(args.gpu_procs, len(pids)))
+    gpu_pids[:len(gpu_pids) // 20] = range(10, 10 + len(gpu_pids) // 20)
+    files['query-compute-apps'] = ['pid, gpu_uuid, used_gpu_memory [MiB]'] + [
+        f'{pid}, {rng.choice(gpus)["uuid"]}, {rng.randint(100, 40000)} MiB'
+        for pid in gpu_pids]
+    files['top'] = (top_sample(rng, procs, cmds) + ['']
+                    + top_sample(rng, procs, cmds))
+    files['ps'] = ['    PID TTY      STAT   TIME COMMAND'] + [
+        f'{pid:>7} ?        Sl   12:34 {cmds[pid]}' for pid, _ in procs]
+    for i, user in enumerate(USERS):
+        uid = 0 if user == 'root' else 100000000 + i
+        files[f'id-{user}'] = [str(uid)]
+    for name, lines in files.items():
+        with open(os.path.join(folder, name), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+def timed(func, runs):
+    used = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = func()
+        used.append(time.perf_counter() - start)
+    return result, sum(used) / len(used), min(used)
+
+
+def main(argv = None):
+    args = parse_args(argv)
+    folder = args.fixtures
+    if folder is None:
+        folder = args.save or tempfile.mkdtemp(prefix = 'my_monitor_')
+        os.makedirs(folder, exist_ok = True)
+        generate(folder, args)
+    monitor = load_script('my-monitor')
+    agent = load_script('monitor-agent')
+    monitor.REPLAY_DIR = folder
+    monitor.use_color = False
+
+    def screen():
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            monitor.list_gpu_info(gpu_data, gpu_pid, *cpu_data, 79)
+        return out.getvalue()
+
+    (gpu_data, gpu_pid), gpu_mean, gpu_min = timed(
+        monitor.collect_gpu_data, args.runs)
+    cpu_data, cpu_mean, cpu_min = timed(monitor.collect_cpu_data, args.runs)
+    _, sample_mean, sample_min = timed(
+        lambda: agent.sample(monitor), args.runs)
+    _, screen_mean, screen_min = timed(screen, args.runs)
+
+    checksum = hashlib.sha1(json.dumps(
+        [gpu_data, gpu_pid, cpu_data], sort_keys = True).encode()).hexdigest()
+    print(f'fixtures: {folder}, {len(gpu_data)} GPUs, '
+          f'{sum(len(x) for x in gpu_pid)} GPU processes, '
+          f'{len(cpu_data[1])} processes')
+    print(f'{"step":<20}{"mean ms":>10}{"min ms":>10}')
+    for name, mean, best in [
+        ('collect_gpu_data', gpu_mean, gpu_min),
+        ('collect_cpu_data', cpu_mean, cpu_min),
+        ('agent sample', sample_mean, sample_min),
+        ('screen', screen_mean, screen_min),
+    ]:
+        print(f'{name:<20}{mean * 1000:>10.2f}{best * 1000:>10.2f}')
+    print(f'checksum of collected data: {checksum}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
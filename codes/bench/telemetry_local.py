@@ -0,0 +1,145 @@
+"""
+Run monitor-agent and the bot on one machine.
+
+`server.py' (or `asgi.py') runs in this process against the Lark mock, and
+one monitor-agent process is started for each fake server, with a fake
+`nvidia-smi' (`fake_nvidia_smi.py') in PATH. after some time, `Status'
+commands are sent, replies and agent counters are printed.
+
+usage (in `codes' folder, Redis listening on localhost):
+
+    python -m bench.telemetry_local --hosts 4 --interval 2 --duration 20
+
+WARNING: the selected Redis db (--redis-db, default 15) is flushed.
+"""
+import os
+import sys
+import json
+import time
+import signal
+import logging
+import argparse
+import tempfile
+import subprocess
+
+import requests
+
+from bench import load_test
+from bench.lark_mock import LarkMock
+from bench.callback import message_event, signed_request
+
+
+CODES_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TELEMETRY_TOKEN = 'bench_telemetry_token'
+
+
+def parse_args(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n')[1])
+    parser.add_argument('--hosts', type = int, default = 4)
+    parser.add_argument('--gpus', type = int, default = 4,
+                        help = 'GPUs of each fake server')
+    parser.add_argument('--interval', type = float, default = 2,
+                        help = 'seconds between samples of agents')
+    parser.add_argument('--batch', type = int, default = 1)
+    parser.add_argument('--duration', type = float, default = 20)
+    parser.add_argument('--redis-host', default = '127.0.0.1')
+    parser.add_argument('--redis-port', type = int, default = 6379)
+    parser.add_argument('--redis-db', type = int, default = 15)
+    parser.add_argument('--asgi', action = 'store_true',
+                        help = 'run asgi.py with uvicorn instead of server.py')
+    parser.add_argument('--verbose', action = 'store_true',
+                        help = 'keep logs of the bot')
+    args = parser.parse_args(argv)
+    # fields used by load_test helpers
+    args.users = 1
+    return args
+
+
+def fake_nvidia_smi_dir():
+    """
+    folder with an executable `nvidia-smi' that runs fake_nvidia_smi.py.
+    """
+    folder = tempfile.mkdtemp(prefix = 'fake_nvidia_smi_')
+    path = os.path.join(folder, 'nvidia-smi')
+    script = os.path.join(CODES_DIR, 'bench', 'fake_nvidia_smi.py')
+    open(path, 'w').write(f'#!/bin/sh\nexec {sys.executable} {script} "$@"\n')
+    os.chmod(path, 0o755)
+    return folder
+
+
+def start_agents(args, hosts, url):
+    bin_dir = fake_nvidia_smi_dir()
+    agents = []
+    for i, host in enumerate(hosts):
+        env = dict(os.environ)
+        env.update({
+            'PATH': bin_dir + os.pathsep + env.get('PATH', ''),
+            'FAKE_GPUS': str(args.gpus),
+            'FAKE_GPU_SEED': str(i),
+        })
+        agents.append(subprocess.Popen([
+            sys.executable,
+            os.path.join(CODES_DIR, 'bash-scripts', 'monitor-agent'),
+            '--url', url, '--token', TELEMETRY_TOKEN, '--host', host,
+            '--interval', str(args.interval), '--batch', str(args.batch),
+        ], env = env, stdout = subprocess.PIPE, text = True))
+    return agents
+
+
+def stop_agents(agents):
+    stats = []
+    for agent in agents:
+        agent.send_signal(signal.SIGTERM)
+    for agent in agents:
+        out, _ = agent.communicate(timeout = 30)
+        lines = [x for x in out.split('\n') if x.startswith('{')]
+        stats.append(json.loads(lines[-1]) if lines else {})
+    return stats
+
+
+def send_command(bot_url, lark, text, message_id):
+    headers, body = signed_request(load_test.ENCRYPT_KEY, message_event(
+        load_test.TOKEN, message_id, 'benchuid00', text))
+    start = time.perf_counter()
+    requests.post(bot_url, data = body, headers = headers)
+    used = time.perf_counter() - start
+    return used, '\n'.join(lark.reply_texts(message_id))
+
+
+def main(argv = None):
+    args = parse_args(argv)
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+    sys.path.insert(0, CODES_DIR)
+    hosts, _ = load_test.prepare_workdir(args)
+    hosts = hosts[:-1]
+    os.environ['TELEMETRY_TOKEN'] = TELEMETRY_TOKEN
+    lark = LarkMock().start()
+    server, httpd, bot_url = load_test.start_bot(args, lark.url)
+    server.database.conn.flushdb()
+    server.database.ephemeral.flushdb()
+
+    agents = start_agents(args, hosts, bot_url + 'telemetry')
+    time.sleep(args.duration)
+    for i, text in enumerate(['Status', f'Status {hosts[0]}']):
+        used, reply = send_command(
+            bot_url, lark, text, f'om_telemetry_{time.time():.0f}_{i}')
+        print(f'>> {text} ({used * 1000:.1f} ms)\n{reply}\n')
+    stats = stop_agents(agents)
+
+    print(f'{"host":<12}{"samples":>8}{"full":>6}{"delta":>7}{"posts":>7}'
+          f'{"failed":>8}{"bytes":>8}{"B/post":>8}')
+    for host, x in zip(hosts, stats):
+        posts = x.get('posts', 0) - x.get('failed_posts', 0)
+        print(f'{host:<12}{x.get("samples", 0):>8}{x.get("full", 0):>6}'
+              f'{x.get("delta", 0):>7}{x.get("posts", 0):>7}'
+              f'{x.get("failed_posts", 0):>8}{x.get("bytes", 0):>8}'
+              f'{x.get("bytes", 0) / max(posts, 1):>8.0f}')
+    httpd.shutdown()
+    lark.stop()
+    ok = all(x.get('samples') and x.get('failed_posts') == 0 for x in stats)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,222 @@
+import os
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from api import BATCH_SEND_MAX_USERS, batch_send_unavailable
+
+
+class Broadcaster:
+    """
+    send a text to all users that have bound an account.
+
+    bindings are read from Redis by SCAN (RedisConnect.bound_users) and
+    grouped into batches of batch_size users. at most concurrency batches
+    are sent at once. every Lark call, a batch or a single message, first
+    takes a token of the rate limit bucket `broadcast:api' shared by all
+    instances, and a failed call is retried with exponential backoff. if
+    the app can not use batch_send, users are sent one by one.
+    envs: BROADCAST_BATCH_SIZE (default and max 200), BROADCAST_CONCURRENCY
+    (default 4), BROADCAST_RETRIES (default 3), BROADCAST_RATE (calls per
+    second, default 5).
+    """
+    def __init__(self, database, batch_size = None, concurrency = None,
+                 retries = None, rate = None, backoff = 1.0):
+        self.db = database
+        self.batch_size = min(BATCH_SEND_MAX_USERS, int(
+            batch_size or os.getenv('BROADCAST_BATCH_SIZE', 200)))
+        self.concurrency = int(
+            concurrency or os.getenv('BROADCAST_CONCURRENCY', 4))
+        self.retries = int(
+            retries if retries is not None
+            else os.getenv('BROADCAST_RETRIES', 3))
+        self.rate = float(rate or os.getenv('BROADCAST_RATE', 5))
+        self.backoff = backoff
+        # set to False when batch_send is found unavailable
+        self.batch_send = True
+
+    def batches(self):
+        """
+        yield lists of (account_name, user_id), each user only once.
+        """
+        seen = set()
+        batch = []
+        for page in self.db.bound_users():
+            for account_name, user_id in page:
+                if user_id in seen:
+                    continue
+                seen.add(user_id)
+                batch.append((account_name, user_id))
+                if len(batch) >= self.batch_size:
+                    yield batch
+                    batch = []
+        if len(batch):
+            yield batch
+
+    def _rate_limit_wait(self):
+        """
+        return: 0 if a call is allowed now, else seconds to wait.
+        """
+        try:
+            allowed, wait = self.db.take_rate_limit_token([
+                ('broadcast:api', max(1, int(self.rate)), 1 / self.rate)])
+        except Exception as e:
+            # do not block broadcast when limiter fails
+            logging.error(f'rate limit of broadcast failed: {e}')
+            return 0
+        return 0 if allowed else wait
+
+    def _retry_wait(self, attempt, error):
+        """
+        log a failed call. return: seconds to wait before the next attempt,
+        or None if no attempt is left or batch_send is unavailable.
+        """
+        if batch_send_unavailable(error):
+            return None
+        logging.warning(f'broadcast call failed (attempt {attempt + 1}): '
+                        f'{error}')
+        if attempt >= self.retries:
+            return None
+        return self.backoff * 2 ** attempt
+
+    def _call(self, func, *args):
+        """
+        call func with rate limit and retries.
+
+        return: (result, None), or (None, the last error)
+        """
+        for attempt in range(self.retries + 1):
+            wait_seconds = self._rate_limit_wait()
+            while wait_seconds > 0:
+                time.sleep(wait_seconds)
+                wait_seconds = self._rate_limit_wait()
+            try:
+                return func(*args), None
+            except Exception as e:
+                retry = self._retry_wait(attempt, e)
+                if retry is None:
+                    return None, e
+                time.sleep(retry)
+
+    async def _acall(self, func, *args):
+        # coroutine version of _call, func is a coroutine function
+        for attempt in range(self.retries + 1):
+            wait_seconds = await asyncio.to_thread(self._rate_limit_wait)
+            while wait_seconds > 0:
+                await asyncio.sleep(wait_seconds)
+                wait_seconds = await asyncio.to_thread(self._rate_limit_wait)
+            try:
+                return await func(*args), None
+            except Exception as e:
+                retry = self._retry_wait(attempt, e)
+                if retry is None:
+                    return None, e
+                await asyncio.sleep(retry)
+
+    def _batch_result(self, batch, invalid, err):
+        """
+        return: account names not delivered by a batch_send call, or None
+            if users should be sent one by one.
+        """
+        if err is None:
+            invalid = set(invalid)
+            return [a for a, u in batch if u in invalid]
+        if batch_send_unavailable(err):
+            if self.batch_send:
+                logging.warning(
+                    f'batch_send unavailable, send one by one: {err}')
+            self.batch_send = False
+            return None
+        return [x[0] for x in batch]
+
+    def _send_batch(self, batch_send, send_one, batch, text):
+        """
+        return: account names not delivered.
+        """
+        if self.batch_send:
+            failed = self._batch_result(batch, *self._call(
+                batch_send, [x[1] for x in batch], text))
+            if failed is not None:
+                return failed
+        failed = []
+        for account_name, user_id in batch:
+            if self._call(send_one, user_id, text)[1] is not None:
+                failed.append(account_name)
+        return failed
+
+    async def _asend_batch(self, abatch_send, asend_one, batch, text):
+        if self.batch_send:
+            failed = self._batch_result(batch, *await self._acall(
+                abatch_send, [x[1] for x in batch], text))
+            if failed is not None:
+                return failed
+        failed = []
+        for account_name, user_id in batch:
+            if (await self._acall(asend_one, user_id, text))[1] is not None:
+                failed.append(account_name)
+        return failed
+
+    def run(self, batch_send, send_one, text):
+        """
+        send text by batch_send(user_ids, text), which returns invalid
+        user_ids, or by send_one(user_id, text) if batch_send is not
+        available, e.g. batch_send_text and send_text_to_user of
+        MessageApiClient.
+
+        return: (number of delivered users, account names not delivered)
+        """
+        delivered = 0
+        failed = []
+        running = {}
+
+        def collect(done):
+            nonlocal delivered
+            for future in done:
+                batch = running.pop(future)
+                res = future.result()
+                delivered += len(batch) - len(res)
+                failed.extend(res)
+
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            for batch in self.batches():
+                if len(running) >= self.concurrency:
+                    collect(wait(running, return_when = FIRST_COMPLETED)[0])
+                future = pool.submit(
+                    self._send_batch, batch_send, send_one, batch, text)
+                running[future] = batch
+            collect(wait(running)[0])
+        return delivered, failed
+
+    async def arun(self, abatch_send, asend_one, text):
+        """
+        coroutine version of run, abatch_send and asend_one are coroutine
+        functions.
+        """
+        delivered = 0
+        failed = []
+        running = {}
+
+        def collect(done):
+            nonlocal delivered
+            for task in done:
+                batch = running.pop(task)
+                res = task.result()
+                delivered += len(batch) - len(res)
+                failed.extend(res)
+
+        batches = self.batches()
+        while True:
+            # SCAN is blocking, read each batch in a thread
+            batch = await asyncio.to_thread(next, batches, None)
+            if batch is None:
+                break
+            if len(running) >= self.concurrency:
+                done, _ = await asyncio.wait(
+                    running, return_when = asyncio.FIRST_COMPLETED)
+                collect(done)
+            task = asyncio.create_task(
+                self._asend_batch(abatch_send, asend_one, batch, text))
+            running[task] = batch
+        if len(running):
+            collect((await asyncio.wait(running))[0])
+        return delivered, failed
@@ -1,19 +1,238 @@
+import os
+import re
+import abc
 import json
+import asyncio
+import math
+import time
 import inspect
 import logging
+import threading
 from event import MessageReceiveEvent
-from flask import jsonify
-from ssh import get_nvidia_smi, get_my_monitor, lock_all_password, clear_cache
-from utils import list_all_servers
+from ssh import (
+    get_nvidia_smi, 
+    get_my_monitor, 
+    aget_nvidia_smi,
+    aget_my_monitor,
+    clear_all_cache,
+    aclear_all_cache,
+    password_servers,
+    lock_servers,
+    available_servers,
+    provision_all_user,
+    host_health
+)
+from inventory import inventory
+from broadcast import Broadcaster
+from log import log_context
+from telemetry import format_server, format_summary
+from utils import (
+    list_all_servers, 
+    list_available_accounts, 
+    generate_text_card
+)
 from typing import List
 
 
+class FleetProgress:
+    """
+    progress of an operation on many servers. a card is replied when it
+    starts, and updated in place when each server finishes, so user can see
+    results before the slowest server returns.
+    """
+    def __init__(self, command, title, servers, cb_kwargs, 
+                 min_interval = 1.0):
+        """
+        args:
+            command: the Command instance, whose callbacks are used.
+            title: title of the card.
+            servers: servers that will report results.
+            cb_kwargs: keyword arguments to pass to message api callbacks.
+            min_interval: min seconds between two updates of the card.
+        """
+        self.command = command
+        self.title = title
+        self.waiting = list(servers)
+        self.cb_kwargs = cb_kwargs
+        self.min_interval = min_interval
+        self.results = []
+        self.failed = 0
+        self.message_id = None
+        self._last_update = 0
+
+    def start(self):
+        if (
+            self.command.api_reply_card is None
+            or self.command.api_update_card is None
+        ):
+            # card not supported, only reply when finish
+            return self
+        kwargs = dict(self.cb_kwargs)
+        kwargs[self.command.api_cb_textkey] = generate_text_card(
+            self.title, self._progress_text())
+        try:
+            self.message_id = self.command.api_reply_card(**kwargs)
+        except Exception as e:
+            logging.error(f'reply progress card failed: {e}')
+        self._last_update = time.time()
+        return self
+
+    def _progress_text(self):
+        total = len(self.results) + len(self.waiting)
+        lines = [
+            f'{len(self.results)}/{total} servers finished, '
+            f'{self.failed} failed.'
+        ]
+        if len(self.results):
+            lines.append('-----')
+            lines += self.results
+        if len(self.waiting):
+            lines.append(f'waiting: {" ".join(self.waiting)}')
+        return '\n'.join(lines)
+
+    def _update(self, text, color = 'blue'):
+        try:
+            self.command.api_update_card(
+                self.message_id, generate_text_card(self.title, text, color))
+        except Exception as e:
+            logging.error(f'update progress card failed: {e}')
+        self._last_update = time.time()
+
+    def on_result(self, server, result):
+        """
+        callback of ssh fleet operations when one server finishes. result
+        is ssh.CommandResult.
+        """
+        if self._record(server, result):
+            self._update(self._progress_text())
+
+    def _record(self, server, result):
+        """
+        record result of server. return: whether the card should update.
+        """
+        if server in self.waiting:
+            self.waiting.remove(server)
+        if result.returncode == 0:
+            self.results.append(
+                f'{server}: success ({result.duration:.1f}s)')
+        else:
+            self.failed += 1
+            reason = (result.stderr or result.stdout or '').strip()
+            reason = reason.split('\n')[-1][:100]
+            self.results.append(
+                f'{server}: failed ({result.returncode}, '
+                f'{result.duration:.1f}s) {reason}')
+        return (
+            self.message_id is not None
+            and time.time() - self._last_update >= self.min_interval
+        )
+
+    def finish(self, text, success = True):
+        """
+        make final summary with text. if card is not replied, reply text.
+        """
+        if self.message_id is None:
+            self.command._reply_text_msg(text, self.cb_kwargs)
+            return
+        self._update(*self._final_text(text, success))
+
+    def _final_text(self, text, success):
+        color = 'green' if success and self.failed == 0 else 'red'
+        if len(self.results):
+            # some servers are processed, show their results
+            text = self._progress_text() + '\n=====\n' + text
+        return text, color
+
+
+class AsyncFleetProgress(FleetProgress):
+    """
+    FleetProgress for coroutine commands, use astart, aon_result and 
+    afinish instead. card callbacks of the command should be coroutines.
+    """
+    async def astart(self):
+        if (
+            self.command.api_areply_card is None
+            or self.command.api_aupdate_card is None
+        ):
+            return self
+        kwargs = dict(self.cb_kwargs)
+        kwargs[self.command.api_cb_textkey] = generate_text_card(
+            self.title, self._progress_text())
+        try:
+            self.message_id = await self.command.api_areply_card(**kwargs)
+        except Exception as e:
+            logging.error(f'reply progress card failed: {e}')
+        self._last_update = time.time()
+        return self
+
+    async def _aupdate(self, text, color = 'blue'):
+        try:
+            await self.command.api_aupdate_card(
+                self.message_id, generate_text_card(self.title, text, color))
+        except Exception as e:
+            logging.error(f'update progress card failed: {e}')
+        self._last_update = time.time()
+
+    async def aon_result(self, server, result):
+        if self._record(server, result):
+            await self._aupdate(self._progress_text())
+
+    async def afinish(self, text, success = True):
+        if self.message_id is None:
+            await self.command._areply_text_msg(text, self.cb_kwargs)
+            return
+        await self._aupdate(*self._final_text(text, success))
+
+
+def load_rate_limits(path = 'ENV/rate_limits'):
+    """
+    load rate limits from file. one line a limit: 
+        `command scope capacity seconds'
+    scope is `user', `host' or `host:SERVER'. a bucket holds at most 
+    capacity tokens and one token is refilled every seconds. capacity 
+    `none' removes the default limit. lines start with `#' are ignored.
+
+    return: {command_name_lower: {scope: (capacity, seconds) or None}}
+    """
+    limits = {}
+    if not os.path.exists(path):
+        return limits
+    for line in open(path).read().strip().split('\n'):
+        line = line.strip()
+        if line == '' or line.startswith('#'):
+            continue
+        line = line.split()
+        if len(line) == 3 and line[2].lower() == 'none':
+            limit = None
+        elif len(line) == 4:
+            limit = (int(line[2]), float(line[3]))
+        else:
+            logging.error(f'unrecognized rate limit: {" ".join(line)}')
+            continue
+        limits.setdefault(line[0].lower(), {})[line[1]] = limit
+    return limits
+
+
 class Command:
     """
     Base class of commands.
     """
+    # default rate limits. {scope: (capacity, seconds to refill one token)},
+    # scope is `user' for each user, `host' for each target server. can be
+    # overridden by ENV/rate_limits, see load_rate_limits.
+    rate_limits = {}
+
     def __init__(self, message_api_callback, message_api_callback_text_argname, 
-                 check_user_is_admin, database):
+                 check_user_is_admin, database, 
+                 message_api_reply_card = None, 
+                 message_api_update_card = None,
+                 message_api_async_callback = None,
+                 message_api_async_reply_card = None,
+                 message_api_async_update_card = None,
+                 message_api_batch_send = None,
+                 message_api_send_user = None,
+                 message_api_async_batch_send = None,
+                 message_api_async_send_user = None):
         """
         args:
             message_api_callback: a callback function to reply in lark.
@@ -22,10 +241,35 @@ class Command:
             check_user_is_admin: check certain user_id is admin user. useful
                 to perform previliged commands.
             database: a database instance to set/get informations.
+            message_api_reply_card: a callback function to reply a card,
+                same arguments as message_api_callback, return message_id
+                of the card. optional.
+            message_api_update_card: a callback function to update a card
+                with (message_id, content). optional.
+            message_api_async_callback, message_api_async_reply_card,
+            message_api_async_update_card: coroutine versions of above 
+                callbacks, used by arun. optional.
+            message_api_batch_send: a callback function to send a text to
+                many users with (user_ids, text), return invalid user_ids.
+                used by Broadcast, optional.
+            message_api_send_user: a callback function to send a text to 
+                one user with (user_id, text), used by Broadcast when 
+                batch send is not available. optional.
+            message_api_async_batch_send, message_api_async_send_user: 
+                coroutine versions of above.
         """
         self.db = database
         self.api_cb = message_api_callback
         self.api_cb_textkey = message_api_callback_text_argname
+        self.api_reply_card = message_api_reply_card
+        self.api_update_card = message_api_update_card
+        self.api_acb = message_api_async_callback
+        self.api_areply_card = message_api_async_reply_card
+        self.api_aupdate_card = message_api_async_update_card
+        self.api_batch_send = message_api_batch_send
+        self.api_send_user = message_api_send_user
+        self.api_abatch_send = message_api_async_batch_send
+        self.api_asend_user = message_api_async_send_user
         self._user_admin_check = check_user_is_admin
 
     @staticmethod
@@ -35,6 +279,13 @@ class Command:
         """
         return ""
 
+    @staticmethod
+    def target_hosts(cmd_data: List[str]):
+        """
+        servers the command operates on, used by per-host rate limit.
+        """
+        return []
+
     @staticmethod
     def _is_p2p(req_data: MessageReceiveEvent):
         return req_data.event.message.chat_type == 'p2p'
@@ -81,6 +332,29 @@ class Command:
         cb_kwargs[self.api_cb_textkey] = json.dumps({"text":text_msg})
         self.api_cb(**cb_kwargs)
 
+    async def _areply_text_msg(self, text_msg: str, cb_kwargs: dict):
+        """
+        reply text message in coroutine commands
+        """
+        if self.api_acb is None:
+            await asyncio.to_thread(self._reply_text_msg, text_msg, cb_kwargs)
+            return
+        cb_kwargs[self.api_cb_textkey] = json.dumps({"text":text_msg})
+        await self.api_acb(**cb_kwargs)
+
+    def _fleet_progress(self, title, servers, cb_kwargs):
+        """
+        create and start a FleetProgress.
+        """
+        return FleetProgress(self, title, servers, cb_kwargs).start()
+
+    async def _afleet_progress(self, title, servers, cb_kwargs):
+        """
+        create and start an AsyncFleetProgress.
+        """
+        return await AsyncFleetProgress(
+            self, title, servers, cb_kwargs).astart()
+
     def run(self, 
             cmd_data: List[str], 
             req_data: MessageReceiveEvent, 
@@ -95,6 +369,17 @@ class Command:
         """
         pass
 
+    async def arun(self, 
+                   cmd_data: List[str], 
+                   req_data: MessageReceiveEvent, 
+                   cb_kwargs: dict):
+        """
+        coroutine version of run, used by asgi.py. by default, run is 
+        called in a worker thread; commands that wait for servers override 
+        it, so they do not hold a thread while waiting.
+        """
+        await asyncio.to_thread(self.run, cmd_data, req_data, cb_kwargs)
+
 
 class BindAccount(Command):
     """
@@ -152,7 +437,7 @@ class CheckAccount(Command):
 
 class ListAllServers(Command):
     """
-    list server alias and IP
+    list server alias, IP and health
     """
     @staticmethod
     def command_name():
@@ -173,101 +458,148 @@ class ListAllServers(Command):
             self._reply_text_msg(f'Error occured: {err_msg}', cb_kwargs)
         else:
             count = len(res)
-            res = '\n'.join([x[0] + '     ' + x[1] for x in res])
+            res = '\n'.join([
+                x[0] + '     ' + x[1] + '     ' + host_health.summary(x[1])
+                for x in res
+            ])
             self._reply_text_msg(
                 f'Success! {count} servers.\n{res}',
                 cb_kwargs
             )
 
 
-class Nvidia_SMI(Command):
+class RemoteQueryCommand(Command, abc.ABC):
     """
-    run nvidia-smi in remote
+    base of commands that run a query on one server and reply its output.
+    subclasses set usage and implement query and aquery, run and arun only
+    differ in how they wait.
     """
+    # reply when the arguments are not exactly one server
+    usage = ''
+
     @staticmethod
-    def command_name():
-        return "nvidia-smi"
+    def target_hosts(cmd_data: List[str]):
+        return cmd_data[:1]
+
+    @abc.abstractmethod
+    def query(self, server: str):
+        """
+        return: (output, None), or (None, error dict)
+        """
+
+    @abc.abstractmethod
+    async def aquery(self, server: str):
+        """
+        coroutine version of query.
+        """
+
+    @staticmethod
+    def _result_text(res, err_msg):
+        return f'Error occured: {err_msg}' if res is None else res
 
     def run(self, 
             cmd_data: List[str], 
             req_data: MessageReceiveEvent, 
             cb_kwargs: dict):
-        # if not self._is_p2p(req_data):
-        #     return
         if len(cmd_data) != 1:
-            self._reply_text_msg(
-                'Command "nvidia-smi" should contain exactly one argument.', 
-                cb_kwargs
-            )
+            self._reply_text_msg(self.usage, cb_kwargs)
             return
-        res, err_msg = get_nvidia_smi(cmd_data[0])
-        if res is None:
-            self._reply_text_msg(f'Error occured: {err_msg}', cb_kwargs)
-        else:
-            self._reply_text_msg(
-                res,
-                cb_kwargs
-            )
+        self._reply_text_msg(
+            self._result_text(*self.query(cmd_data[0])), cb_kwargs)
+
+    async def arun(self, 
+                   cmd_data: List[str], 
+                   req_data: MessageReceiveEvent, 
+                   cb_kwargs: dict):
+        if len(cmd_data) != 1:
+            await self._areply_text_msg(self.usage, cb_kwargs)
+            return
+        await self._areply_text_msg(
+            self._result_text(*await self.aquery(cmd_data[0])), cb_kwargs)
 
 
-class My_Monitor(Command):
+class Nvidia_SMI(RemoteQueryCommand):
+    """
+    run nvidia-smi in remote
+    """
+    usage = 'Command "nvidia-smi" should contain exactly one argument.'
+
+    @staticmethod
+    def command_name():
+        return "nvidia-smi"
+
+    def query(self, server: str):
+        return get_nvidia_smi(server)
+
+    async def aquery(self, server: str):
+        return await aget_nvidia_smi(server)
+
+
+class My_Monitor(RemoteQueryCommand):
     """
     run my-monitor in remote
     """
+    usage = 'Command "my-monitor" should contain exactly one argument.'
+
     @staticmethod
     def command_name():
         return "my-monitor"
 
-    def run(self, 
-            cmd_data: List[str], 
-            req_data: MessageReceiveEvent, 
-            cb_kwargs: dict):
-        # if not self._is_p2p(req_data):
-        #     return
-        if len(cmd_data) != 1:
-            self._reply_text_msg(
-                'Command "my-monitor" should contain exactly one argument.', 
-                cb_kwargs
-            )
-            return
-        res, err_msg = get_my_monitor(cmd_data[0])
-        if res is None:
-            self._reply_text_msg(f'Error occured: {err_msg}', cb_kwargs)
-        else:
-            self._reply_text_msg(
-                res,
-                cb_kwargs
-            )
+    def query(self, server: str):
+        return get_my_monitor(server)
 
+    async def aquery(self, server: str):
+        return await aget_my_monitor(server)
 
-class My_Monitor_All(Command):
+
+class My_Monitor_All(RemoteQueryCommand):
     """
     run my-monitor-all in remote
     """
+    rate_limits = {'user': (3, 60), 'host': (3, 30)}
+    usage = 'Command "my-monitor" should contain exactly one argument.'
+
     @staticmethod
     def command_name():
         return "my-monitor-all"
 
+    def query(self, server: str):
+        return get_my_monitor(server, True)
+
+    async def aquery(self, server: str):
+        return await aget_my_monitor(server, True)
+
+
+class Status(Command):
+    """
+    show usage pushed by monitor-agent of servers, no SSH is used
+    """
+    @staticmethod
+    def command_name():
+        return "Status"
+
     def run(self, 
             cmd_data: List[str], 
             req_data: MessageReceiveEvent, 
             cb_kwargs: dict):
-        # if not self._is_p2p(req_data):
-        #     return
-        if len(cmd_data) != 1:
+        servers, unknown = inventory.select(
+            [x for x in cmd_data if x != ''] or ['all'])
+        if len(unknown):
             self._reply_text_msg(
-                'Command "my-monitor" should contain exactly one argument.', 
+                f'Error occured: unrecognized server name: '
+                f'{" ".join(unknown)}', 
                 cb_kwargs
             )
             return
-        res, err_msg = get_my_monitor(cmd_data[0], True)
-        if res is None:
-            self._reply_text_msg(f'Error occured: {err_msg}', cb_kwargs)
-        else:
+        states = self.db.get_all_telemetry(servers)
+        if len(servers) == 1 and states[0] is not None:
             self._reply_text_msg(
-                res,
-                cb_kwargs
-            )
+                format_server(servers[0], states[0]), cb_kwargs)
+            return
+        self._reply_text_msg(
+            '\n'.join(format_summary(x, y) for x, y in zip(servers, states)),
+            cb_kwargs
+        )
 
 
 class GenerateNewAdminPassword(Command):
@@ -287,20 +619,22 @@ class GenerateNewAdminPassword(Command):
             return
         if self._private_chat_command_notify(req_data, cb_kwargs):
             return
-        user_id = self._get_user_id(req_data)
-        res, err_msg = self.db.account_name_to_password('mdm')
+        progress = self._fleet_progress(
+            'Generate new admin password', password_servers('mdm'), cb_kwargs)
+        res, err_msg = self.db.account_name_to_password(
+            'mdm', on_result = progress.on_result)
         if res is None:
-            self._reply_text_msg(f'Error occured: {err_msg}', cb_kwargs)
+            progress.finish(f'Error occured: {err_msg}', False)
         else:
-            self._reply_text_msg(
+            progress.finish(
                 'Generate new admin password success!\n-----\n'
                 f'New Password: \n{res}\n-----\n'
-                'Please note the password will expire in the next day, '
+                'Please note the password will expire in '
+                f'{self.db.password_expire_hours:g} hours, '
                 'you should generate new password after then. '
                 'To use servers more convenient, we highly recommend '
                 'using SSH keys as main login method. See '
-                'Command "AddNewPublicKey" in doc for details.',
-                cb_kwargs
+                'Command "AddNewPublicKey" in doc for details.'
             )
 
 
@@ -308,6 +642,8 @@ class GenerateNewPassword(Command):
     """
     generate new password for account
     """
+    rate_limits = {'user': (3, 600)}
+
     @staticmethod
     def command_name():
         return "GenerateNewPassword"
@@ -319,20 +655,83 @@ class GenerateNewPassword(Command):
         if self._private_chat_command_notify(req_data, cb_kwargs):
             return
         user_id = self._get_user_id(req_data)
-        res, err_msg = self.db.user_id_to_password(user_id)
-        if res is None:
+        account_name, err_msg = self.db.user_id_to_account_name(user_id)
+        if account_name is None:
             self._reply_text_msg(f'Error occured: {err_msg}', cb_kwargs)
+            return
+        progress = self._fleet_progress(
+            'Generate new password', password_servers(account_name), 
+            cb_kwargs)
+        res, err_msg = self.db.user_id_to_password(
+            user_id, on_result = progress.on_result)
+        if res is None:
+            progress.finish(f'Error occured: {err_msg}', False)
         else:
-            self._reply_text_msg(
+            progress.finish(
                 'Generate new password success!\n-----\n'
                 f'New Password: \n{res}\n-----\n'
-                'Please note the password will expire in the next day, '
+                'Please note the password will expire in '
+                f'{self.db.password_expire_hours:g} hours, '
                 'you should generate new password after then. '
                 'To use servers more convenient, we highly recommend '
                 'using SSH keys as main login method. See '
-                'Command "AddNewPublicKey" in doc for details.',
+                'Command "AddNewPublicKey" in doc for details.'
+            )
+
+
+class RotatePasswords(Command):
+    """
+    generate new passwords for many accounts at once
+    """
+    @staticmethod
+    def command_name():
+        return "RotatePasswords"
+
+    def run(self, 
+            cmd_data: List[str], 
+            req_data: MessageReceiveEvent, 
+            cb_kwargs: dict):
+        if self._private_chat_command_notify(req_data, cb_kwargs):
+            return
+        if len(cmd_data) == 0:
+            self._reply_text_msg(
+                'Command "RotatePasswords" should take account names or '
+                '"all" as input', 
                 cb_kwargs
             )
+            return
+        user_id = self._get_user_id(req_data)
+        if self._not_admin_notify(user_id, cb_kwargs):
+            return
+        account_names = cmd_data
+        if cmd_data == ['all']:
+            account_names = list_available_accounts()
+        servers = []
+        for account_name in account_names:
+            servers += [
+                x for x in password_servers(account_name) if x not in servers]
+        progress = self._fleet_progress(
+            f'Rotate password of {len(account_names)} accounts', servers, 
+            cb_kwargs)
+        res, err_msg = self.db.rotate_passwords(
+            account_names, on_result = progress.on_result)
+        if res is None:
+            progress.finish(f'Error occured: {err_msg}', False)
+            return
+        lines = []
+        success = True
+        for account_name, (password, failed) in res.items():
+            lines.append(f'{account_name}: {password}')
+            if len(failed):
+                success = False
+                lines.append(f'    failed on: {" ".join(sorted(failed))}')
+        progress.finish(
+            f'Rotate password of {len(res)} accounts finished.\n-----\n'
+            + '\n'.join(lines) + '\n-----\n'
+            'Please note the passwords will expire in '
+            f'{self.db.password_expire_hours:g} hours.',
+            success
+        )
 
 
 class AddNewPublicKey(Command):
@@ -356,17 +755,19 @@ class AddNewPublicKey(Command):
             )
             return
         user_id = self._get_user_id(req_data)
-        res, err_msg = self.db.user_id_to_pk(user_id, ' '.join(cmd_data))
+        progress = self._fleet_progress(
+            'Add new public key', available_servers(), cb_kwargs)
+        res, err_msg = self.db.user_id_to_pk(
+            user_id, ' '.join(cmd_data), on_result = progress.on_result)
         if res is None:
-            self._reply_text_msg(f'Error occured: {err_msg}', cb_kwargs)
+            progress.finish(f'Error occured: {err_msg}', False)
         else:
-            self._reply_text_msg(
+            progress.finish(
                 'Add public key success!\n'
                 'Current available public keys:'
                  + '\n-----\n'.join([''] + res + [''])
                  + 'Delete/modify is not supported now, please wait for newer '
-                'version or contact admin.',
-                cb_kwargs
+                'version or contact admin.'
             )
 
 
@@ -385,17 +786,19 @@ class CheckAndUpdatePublicKey(Command):
         if self._private_chat_command_notify(req_data, cb_kwargs):
             return
         user_id = self._get_user_id(req_data)
-        res, err_msg = self.db.user_id_to_pk(user_id)
+        progress = self._fleet_progress(
+            'Update public key', available_servers(), cb_kwargs)
+        res, err_msg = self.db.user_id_to_pk(
+            user_id, on_result = progress.on_result)
         if res is None:
-            self._reply_text_msg(f'Error occured: {err_msg}', cb_kwargs)
+            progress.finish(f'Error occured: {err_msg}', False)
         else:
-            self._reply_text_msg(
+            progress.finish(
                 'Update public key success!\n'
                 'Current available public keys:'
                  + '\n-----\n'.join([''] + res + [''])
                  + 'Delete/modify is not supported now, please wait for newer '
-                'version or contact admin.',
-                cb_kwargs
+                'version or contact admin.'
             )
 
 
@@ -604,43 +1007,277 @@ class LockPassword(Command):
         user_id = self._get_user_id(req_data)
         if self._not_admin_notify(user_id, cb_kwargs):
             return
-        res = lock_all_password()
+        progress = self._fleet_progress(
+            'Lock password', lock_servers(), cb_kwargs)
+        res = self.db.lock_password(True, on_result = progress.on_result)
         if res is not None:
-            self._reply_text_msg(f'Error occured: {res}', cb_kwargs)
+            progress.finish(f'Error occured: {res}', False)
         else:
-            self._reply_text_msg(
-                f'Lock password success!',
-                cb_kwargs
-            )
+            progress.finish('Lock password success!')
 
 
-class ClearCache(Command):
+class ProvisionUser(Command):
     """
-    clear cache of one server
+    create user with uid in all servers
     """
     @staticmethod
     def command_name():
-        return "ClearCache"
+        return "ProvisionUser"
 
     def run(self, 
             cmd_data: List[str], 
             req_data: MessageReceiveEvent, 
             cb_kwargs: dict):
+        if self._private_chat_command_notify(req_data, cb_kwargs):
+            return
         user_id = self._get_user_id(req_data)
-        if len(cmd_data) != 1:
+        if self._not_admin_notify(user_id, cb_kwargs):
+            return
+        if (
+            len(cmd_data) != 2
+            or re.fullmatch(r'[a-z_][a-z0-9_-]{0,31}', cmd_data[0]) is None
+            or re.fullmatch(r'[0-9]{10}', cmd_data[1]) is None
+        ):
             self._reply_text_msg(
-                'Command "ClearCache" should take server name as input', 
+                'Command "ProvisionUser" should take account name and '
+                '10 digits uid as input', 
                 cb_kwargs
             )
             return
-        res, err_msg = clear_cache(cmd_data[0])
+        user, uid = cmd_data
+        progress = self._fleet_progress(
+            f'Provision user {user}', available_servers(), cb_kwargs)
+        res = provision_all_user(user, uid, on_result = progress.on_result)
+        statuses = {}
+        for server, (status, _) in sorted(res.items()):
+            statuses.setdefault(status, []).append(server)
+        lines = [f'{k}: {" ".join(v)}' for k, v in sorted(statuses.items())]
+        progress.finish(
+            f'Provision user {user} with uid {uid} finished.\n-----\n'
+            + '\n'.join(lines),
+            set(statuses) <= {'created', 'updated', 'unchanged'}
+        )
+
+
+class ClearCache(Command):
+    """
+    clear cache of servers
+    """
+    rate_limits = {'user': (2, 600), 'host': (1, 600)}
+    default_concurrency = 4
+    default_stagger = 5.0
+    # bounds of options, so cache of many servers is never dropped at once
+    max_concurrency = 8
+    min_stagger = 1.0
+
+    @staticmethod
+    def parse_args(cmd_data: List[str]):
+        """
+        parse `[--concurrency N] [--stagger SECONDS] SERVER_OR_GLOB ...'.
+
+        return: (servers, concurrency, stagger, err_msg)
+        """
+        concurrency = ClearCache.default_concurrency
+        stagger = ClearCache.default_stagger
+        patterns = []
+        i = 0
+        try:
+            while i < len(cmd_data):
+                if cmd_data[i] == '--concurrency':
+                    concurrency = int(cmd_data[i + 1])
+                    i += 2
+                elif cmd_data[i] == '--stagger':
+                    stagger = float(cmd_data[i + 1])
+                    i += 2
+                else:
+                    patterns.append(cmd_data[i])
+                    i += 1
+        except (IndexError, ValueError):
+            return [], concurrency, stagger, 'invalid options'
+        if (
+            concurrency < 1 or concurrency > ClearCache.max_concurrency
+            or stagger < ClearCache.min_stagger
+        ):
+            return [], concurrency, stagger, (
+                f'concurrency should be 1 to {ClearCache.max_concurrency}, '
+                f'stagger should be at least {ClearCache.min_stagger:g}')
+        if len(patterns) == 0:
+            return [], concurrency, stagger, 'no server name'
+        servers, unknown = inventory.select(patterns)
+        if len(unknown):
+            return [], concurrency, stagger, \
+                f'unrecognized server name: {" ".join(unknown)}'
+        return servers, concurrency, stagger, None
+
+    @staticmethod
+    def target_hosts(cmd_data: List[str]):
+        return ClearCache.parse_args(cmd_data)[0]
+
+    @staticmethod
+    def command_name():
+        return "ClearCache"
+
+    @staticmethod
+    def _is_fleet(cmd_data: List[str], servers: List[str]):
+        """
+        whether more than one server is selected, or by `all' or a glob.
+        """
+        patterns = [
+            x for i, x in enumerate(cmd_data)
+            if not x.startswith('--')
+            and (i == 0 or cmd_data[i - 1] not in ['--concurrency', '--stagger'])
+        ]
+        return len(servers) > 1 or any(
+            x == 'all' or any(c in x for c in '*?[') for x in patterns)
+
+    def _check(self, cmd_data: List[str], req_data: MessageReceiveEvent,
+               cb_kwargs: dict):
+        """
+        reply and return None if the command can not run, else (servers, 
+        concurrency, stagger). clearing many servers needs an admin in 
+        private chat.
+        """
+        servers, concurrency, stagger, err_msg = self.parse_args(cmd_data)
         if err_msg is not None:
-            self._reply_text_msg(f'Error occured: {res}', cb_kwargs)
-        else:
+            self._reply_text_msg(self._usage(err_msg), cb_kwargs)
+            return None
+        if self._is_fleet(cmd_data, servers) and (
+            self._private_chat_command_notify(req_data, cb_kwargs)
+            or self._not_admin_notify(self._get_user_id(req_data), cb_kwargs)
+        ):
+            return None
+        return servers, concurrency, stagger
+
+    def run(self, 
+            cmd_data: List[str], 
+            req_data: MessageReceiveEvent, 
+            cb_kwargs: dict):
+        checked = self._check(cmd_data, req_data, cb_kwargs)
+        if checked is None:
+            return
+        servers, concurrency, stagger = checked
+        progress = self._fleet_progress(
+            f'Clear cache of {len(servers)} servers', servers, cb_kwargs)
+        res = clear_all_cache(
+            servers, concurrency, stagger, on_result = progress.on_result)
+        progress.finish(*self._summary(servers, res))
+
+    async def arun(self, 
+                   cmd_data: List[str], 
+                   req_data: MessageReceiveEvent, 
+                   cb_kwargs: dict):
+        # admin check and replies are blocking callbacks
+        checked = await asyncio.to_thread(
+            self._check, cmd_data, req_data, cb_kwargs)
+        if checked is None:
+            return
+        servers, concurrency, stagger = checked
+        progress = await self._afleet_progress(
+            f'Clear cache of {len(servers)} servers', servers, cb_kwargs)
+        res = await aclear_all_cache(
+            servers, concurrency, stagger, on_result = progress.aon_result)
+        await progress.afinish(*self._summary(servers, res))
+
+    @staticmethod
+    def _usage(err_msg):
+        return (
+            f'Error occured: {err_msg}. Command "ClearCache" should take '
+            'server names or globs like "node0*" as input, options are '
+            '"--concurrency N" and "--stagger SECONDS". Clearing more than '
+            'one server is only for admins in private chat'
+        )
+
+    @staticmethod
+    def _summary(servers, res):
+        """
+        return: (summary text, success)
+        """
+        lines = []
+        for server in servers:
+            before, after = res[server]
+            if before is None:
+                lines.append(f'{server}: failed')
+            else:
+                lines.append(
+                    f'{server}: cached {before / 1024:.0f}MiB -> '
+                    f'{after / 1024:.0f}MiB')
+        success = all(x[0] is not None for x in res.values())
+        return (
+            f'Clear cache {"success" if success else "finished"}!\n-----\n'
+            + '\n'.join(lines),
+            success
+        )
+
+
+class Broadcast(Command):
+    """
+    send an announcement to all users that have bound an account
+    """
+    rate_limits = {'user': (2, 600)}
+
+    @staticmethod
+    def command_name():
+        return "Broadcast"
+
+    def _check(self, cmd_data: List[str], req_data: MessageReceiveEvent,
+               cb_kwargs: dict):
+        """
+        reply and return None if the command can not run, else the text.
+        """
+        if self._private_chat_command_notify(req_data, cb_kwargs):
+            return None
+        text = ' '.join(cmd_data).strip()
+        if text == '':
             self._reply_text_msg(
-                f'Clear cache of {cmd_data[0]} success!',
+                'Command "Broadcast" should take the announcement as input',
                 cb_kwargs
             )
+            return None
+        if self._not_admin_notify(self._get_user_id(req_data), cb_kwargs):
+            return None
+        return text
+
+    def run(self, 
+            cmd_data: List[str], 
+            req_data: MessageReceiveEvent, 
+            cb_kwargs: dict):
+        text = self._check(cmd_data, req_data, cb_kwargs)
+        if text is None:
+            return
+        if self.api_batch_send is None or self.api_send_user is None:
+            self._reply_text_msg('Broadcast is not supported', cb_kwargs)
+            return
+        self._reply_text_msg('Broadcasting to all bound users...', cb_kwargs)
+        delivered, failed = Broadcaster(self.db).run(
+            self.api_batch_send, self.api_send_user, text)
+        self._reply_text_msg(self._summary(delivered, failed), cb_kwargs)
+
+    async def arun(self, 
+                   cmd_data: List[str], 
+                   req_data: MessageReceiveEvent, 
+                   cb_kwargs: dict):
+        if self.api_abatch_send is None or self.api_asend_user is None:
+            await super().arun(cmd_data, req_data, cb_kwargs)
+            return
+        # admin check and replies are blocking callbacks
+        text = await asyncio.to_thread(
+            self._check, cmd_data, req_data, cb_kwargs)
+        if text is None:
+            return
+        await self._areply_text_msg(
+            'Broadcasting to all bound users...', cb_kwargs)
+        delivered, failed = await Broadcaster(self.db).arun(
+            self.api_abatch_send, self.api_asend_user, text)
+        await self._areply_text_msg(
+            self._summary(delivered, failed), cb_kwargs)
+
+    @staticmethod
+    def _summary(delivered, failed):
+        text = (f'Broadcast finished: {delivered} delivered, '
+                f'{len(failed)} failed.')
+        if len(failed):
+            text += f'\n-----\nfailed: {" ".join(sorted(failed))}'
+        return text
 
 
 class CommandParser(Command):
@@ -650,11 +1287,13 @@ class CommandParser(Command):
     """
     def __init__(self, *argv, **kwargs):
         """
-        after initialize, save all Command instance in self.commands.
+        after initialize, all Command classes are known, their instances
+        are created on first use and saved in self.commands.
         """
         super().__init__(*argv, **kwargs)
-        # all command classes. for new command, add class here.
-        self._cmd_classes = []
+        # all command classes, key is lower case command name. for new 
+        # command, add class here.
+        self._cmd_classes = {}
         for i in globals():
             i = globals()[i]
             if (
@@ -662,49 +1301,138 @@ class CommandParser(Command):
                 and issubclass(i, Command) 
                 and i != Command 
                 and i != CommandParser
+                # base classes of commands have no name
+                and i.command_name()
             ):
-                self._cmd_classes.append(i)
-        # save all commands. key is command name, value is commad func.
+                self._cmd_classes[i.command_name().lower()] = i
+        # Command instances, created on first use by self._command.
+        self._cmd_args = (argv, kwargs)
+        self._cmd_lock = threading.Lock()
         self.commands = {}
         self.help_string = "existing commands:\n"
-        for i in self._cmd_classes:
-            self.commands[i.command_name().lower()] = i(*argv, **kwargs)
+        for i in self._cmd_classes.values():
             self.help_string = self.help_string + i.command_name() + '\n'
-        logging.warning(f'exist commands: {list(self.commands.keys())}')
+        logging.info(f'exist commands: {list(self._cmd_classes.keys())}')
+        # rate limits of commands, defaults updated by ENV/rate_limits
+        self.command_rate_limits = {}
+        overrides = load_rate_limits()
+        for name, cmd in self._cmd_classes.items():
+            limits = dict(cmd.rate_limits)
+            limits.update(overrides.get(name, {}))
+            self.command_rate_limits[name] = {
+                k: v for k, v in limits.items() if v is not None}
+        logging.info(f'rate limits: {self.command_rate_limits}')
+
+    def _command(self, name: str):
+        """
+        return: Command instance of command name, created on first use.
+        """
+        cmd = self.commands.get(name)
+        if cmd is None:
+            with self._cmd_lock:
+                cmd = self.commands.get(name)
+                if cmd is None:
+                    argv, kwargs = self._cmd_args
+                    cmd = self._cmd_classes[name](*argv, **kwargs)
+                    self.commands[name] = cmd
+        return cmd
+
+    def _rate_limit_wait(self, command: str, cmd_data: List[str],
+                         req_data: MessageReceiveEvent):
+        """
+        take tokens of user and target hosts of the command.
 
-    def run(self, 
-            cmd_data: List[str], 
-            req_data: MessageReceiveEvent, 
-            cb_kwargs: dict):
+        return: 0 if allowed, else seconds to wait.
+        """
+        limits = self.command_rate_limits.get(command, {})
+        buckets = []
+        if 'user' in limits:
+            user_id = self._get_user_id(req_data)
+            buckets.append((f'{command}:user:{user_id}', *limits['user']))
+        for host in self._command(command).target_hosts(cmd_data):
+            limit = limits.get(f'host:{host}', limits.get('host'))
+            if limit is not None:
+                buckets.append((f'{command}:host:{host}', *limit))
+        try:
+            allowed, wait = self.db.take_rate_limit_token(buckets)
+        except Exception as e:
+            # do not block commands when limiter fails
+            logging.error(f'rate limit of {command} failed: {e}')
+            return 0
+        return 0 if allowed else wait
+
+    def _prepare(self, req_data: MessageReceiveEvent):
         """
-        parse a command. the first word separated by space is considered as 
-        command, and will use corresponding function to process.
+        parse the message and check rate limit, shared by run and arun. the 
+        first word separated by space is considered as command.
+
+        return: (text to reply or None, command name or None, arguments). 
+            the command is run only if there is nothing to reply.
         """
-        assert cmd_data is None or len(cmd_data) == 0, \
-            'in CommandParser, cmd_data should remain "" or None'
         message = req_data.event.message
         if message.message_type != "text":
             resp = ("can only process plain text, "
                     f"but got {message.message_type}.")
-            logging.warning(resp)
-            self._reply_text_msg(resp, cb_kwargs)
-            return
+            logging.info(resp)
+            return resp, None, []
         text_content = json.loads(message.content)['text'].strip()
-        logging.warning(f'input: {text_content}')
+        logging.info('input: %s', text_content)
         # chat_type = message.chat_type  # p2p or group
         # user_id = req_data.event.sender.sender_id.user_id
         text_content = text_content.split(' ')
         command = text_content[0].lower()
         data = text_content[1:]
-        if command in self.commands.keys():
-            self.commands[command].run(data, req_data, cb_kwargs)
-        else:
+        if command not in self._cmd_classes:
             if self._is_p2p(req_data):
-                self._reply_text_msg(self.help_string, cb_kwargs)
-                logging.warning(f"not a command: {command}")
+                logging.info("not a command: %s", command)
+                return self.help_string, None, data
+            return None, None, data
+        wait = self._rate_limit_wait(command, data, req_data)
+        if wait > 0:
+            return (f'Too many requests of "{text_content[0]}", please '
+                    f'retry after {math.ceil(wait)} seconds.', command, data)
+        return None, command, data
+
+    def run(self, 
+            cmd_data: List[str], 
+            req_data: MessageReceiveEvent, 
+            cb_kwargs: dict):
+        """
+        parse a command by _prepare, and use corresponding command to 
+        process.
+        """
+        assert cmd_data is None or len(cmd_data) == 0, \
+            'in CommandParser, cmd_data should remain "" or None'
+        reply, command, data = self._prepare(req_data)
+        if reply is not None:
+            self._reply_text_msg(reply, cb_kwargs)
+        elif command is not None:
+            with log_context(command = command):
+                self._command(command).run(data, req_data, cb_kwargs)
 
     def parse(self, req_data: MessageReceiveEvent, cb_kwargs: dict):
         """
         parse a command. will call self.run to do real parse.
         """
         self.run('', req_data, cb_kwargs)
+
+    async def arun(self, 
+                   cmd_data: List[str], 
+                   req_data: MessageReceiveEvent, 
+                   cb_kwargs: dict):
+        """
+        coroutine version of run, commands are called by their arun.
+        """
+        # rate limit in _prepare uses blocking Redis
+        reply, command, data = await asyncio.to_thread(self._prepare, req_data)
+        if reply is not None:
+            await self._areply_text_msg(reply, cb_kwargs)
+        elif command is not None:
+            with log_context(command = command):
+                await self._command(command).arun(data, req_data, cb_kwargs)
+
+    async def aparse(self, req_data: MessageReceiveEvent, cb_kwargs: dict):
+        """
+        coroutine version of parse.
+        """
+        await self.arun('', req_data, cb_kwargs)
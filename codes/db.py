@@ -1,25 +1,214 @@
+import os
+import json
 import redis
 import time
 import logging
+import threading
 import base64
 import secrets
 from utils import (
     is_valid_pk, 
     duplicate_pk, 
     is_valid_account_name, 
+    list_available_accounts,
     generate_password
 )
-from ssh import change_all_password, change_all_auth_keys
+from ssh import (
+    change_all_password, 
+    change_all_passwords,
+    change_all_auth_keys, 
+    password_servers,
+    lock_all_password,
+    lock_passwords,
+    reconcile_auth_keys,
+    verify_all_auth_keys,
+    available_servers
+)
+
+
+# remove members of a sorted set only if their scores are not changed. 
+# ARGV are member and score pairs.
+ZREM_IF_SCORE_SCRIPT = """
+local removed = 0
+for i = 1, #ARGV, 2 do
+    local score = redis.call('ZSCORE', KEYS[1], ARGV[i])
+    if score and tonumber(score) == tonumber(ARGV[i + 1]) then
+        removed = removed + redis.call('ZREM', KEYS[1], ARGV[i])
+    end
+end
+return removed
+"""
+
+# token buckets in hashes. KEYS are buckets, ARGV are capacity and seconds
+# to refill one token of each bucket. a token is taken from every bucket 
+# only if all buckets have one. return 1 and 0 if allowed, else 0 and 
+# seconds to wait.
+TOKEN_BUCKET_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local tokens = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 2 - 1])
+    local interval = tonumber(ARGV[i * 2])
+    local data = redis.call('HMGET', key, 'tokens', 'ts')
+    local t = capacity
+    if data[1] then
+        t = math.min(capacity, 
+                     tonumber(data[1]) + (now - tonumber(data[2])) / interval)
+    end
+    tokens[i] = t
+    if t < 1 then
+        wait = math.max(wait, (1 - t) * interval)
+    end
+end
+if wait > 0 then
+    return {0, tostring(wait)}
+end
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 2 - 1])
+    local interval = tonumber(ARGV[i * 2])
+    redis.call('HSET', key, 'tokens', tostring(tokens[i] - 1), 
+               'ts', tostring(now))
+    redis.call('EXPIRE', key, math.ceil(capacity * interval) + 1)
+end
+return {1, '0'}
+"""
+
+class KeyCache:
+    """
+    in-process cache of string values of Redis keys, kept coherent by 
+    keyspace notifications, so changes by other workers are seen at once.
+    Redis should have `notify-keyspace-events' with `K', `g' and `$'.
+
+    the cache is only used after a notification of a probe key is received,
+    and is cleared when the subscription breaks. values also expire after 
+    ttl seconds as a safety net.
+    """
+    probe_key = 'key_cache_probe'
+
+    def __init__(self, conn, ttl = 60):
+        self.conn = conn
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._values = {}
+        self._pending = {}
+        self._enabled = False
+        db = conn.connection_pool.connection_kwargs.get('db', 0)
+        self._pattern = f'__keyspace@{db}__:*'
+        if ttl > 0:
+            threading.Thread(target = self._listen, daemon = True).start()
+
+    def get(self, key):
+        """
+        same as conn.get(key), but from cache if possible.
+        """
+        now = time.monotonic()
+        with self._lock:
+            cached = self._values.get(key)
+            if cached is not None and cached[0] > now:
+                return cached[1]
+            token = object()
+            if self._enabled:
+                self._pending[key] = token
+        value = self.conn.get(key)
+        with self._lock:
+            # not cached if key is changed while reading
+            if self._pending.get(key) is token:
+                del self._pending[key]
+                self._values[key] = (now + self.ttl, value)
+        return value
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._values.pop(key, None)
+                self._pending.pop(key, None)
+
+    def _reset(self, enabled):
+        with self._lock:
+            self._values.clear()
+            self._pending.clear()
+            self._enabled = enabled
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.conn.pubsub()
+                pubsub.psubscribe(self._pattern)
+                for message in pubsub.listen():
+                    if message['type'] == 'psubscribe':
+                        # notifications may be lost before subscribed
+                        self._reset(False)
+                        self.conn.set(self.probe_key, time.time())
+                    elif message['type'] == 'pmessage':
+                        key = message['channel'].split(':', 1)[1]
+                        if key == self.probe_key and not self._enabled:
+                            logging.info('key cache enabled')
+                            self._reset(True)
+                        self.invalidate(key)
+            except Exception as e:
+                logging.warning(f'key cache disabled: {e}')
+                self._reset(False)
+                time.sleep(1)
 
 
 class RedisConnect:
     """
     connect to Redis server in `redis' docker.
     except specified, all functions is used to get/set value with a key.
+
+    data is in two tiers. accounts, public keys and password states are in
+    self.conn, which is persisted. message ids, rate limits and other data
+    that can be lost are in self.ephemeral, a Redis without snapshots set 
+    by REDIS_EPHEMERAL_HOST, or the same Redis as self.conn if not set.
     """
     def __init__(self):
-        self.conn = redis.StrictRedis(host = 'redis', decode_responses=True)
+        self.conn = redis.StrictRedis(
+            host = os.getenv('REDIS_HOST', 'redis'),
+            port = int(os.getenv('REDIS_PORT', 6379)),
+            db = int(os.getenv('REDIS_DB', 0)),
+            decode_responses=True
+        )
+        if os.getenv('REDIS_EPHEMERAL_HOST'):
+            self.ephemeral = redis.StrictRedis(
+                host = os.getenv('REDIS_EPHEMERAL_HOST'),
+                port = int(os.getenv('REDIS_EPHEMERAL_PORT', 6379)),
+                db = int(os.getenv('REDIS_EPHEMERAL_DB', 0)),
+                decode_responses=True
+            )
+        else:
+            self.ephemeral = self.conn
+        # message ids are kept to drop events sent again by Lark
+        self.message_id_expire = int(
+            float(os.getenv('MESSAGE_ID_EXPIRE_HOURS', 24)) * 3600)
         self.an_prefix = 'account_name_'
+        self.rate_limit_prefix = 'rate_limit_'
+        # latest usage pushed by monitor-agent of each server, dropped when
+        # not updated for telemetry_expire seconds
+        self.telemetry_prefix = 'telemetry_'
+        self.telemetry_expire = int(
+            os.getenv('TELEMETRY_EXPIRE_SECONDS', 300))
+        self._token_bucket = self.ephemeral.register_script(
+            TOKEN_BUCKET_SCRIPT)
+        # sorted set of `account@server' that may have an unlocked password,
+        # score is the time password is issued. it is a delay queue, each
+        # password is locked password_expire_hours after issued.
+        self.unlocked_key = 'passwd_unlocked'
+        self.password_expire_hours = float(
+            os.getenv('PASSWORD_EXPIRE_HOURS', 24))
+        self.full_lock_time_key = 'passwd_full_lock_time'
+        self._zrem_if_score = self.conn.register_script(ZREM_IF_SCORE_SCRIPT)
+        # sorted set of `account@server' whose authorized_keys may differ 
+        # from public keys in db, score is the time it is marked. they are
+        # updated by reconcile_auth_keys in background.
+        self.auth_keys_dirty_key = 'auth_keys_dirty'
+        # set of servers whose keys are managed, to find new servers
+        self.auth_keys_servers_key = 'auth_keys_servers'
+        self.auth_keys_pool = int(os.getenv('AUTH_KEYS_RECONCILE_POOL', 5))
+        # bindings and public keys read by commands are cached in process
+        self.key_cache = KeyCache(
+            self.conn, float(os.getenv('BINDING_CACHE_TTL', 60)))
 
     def _message_id_to_value(self, message_id, value = None):
         """
@@ -31,11 +220,11 @@ class RedisConnect:
             if got error, return (error, Error message)
         """
         if value is None:
-            res = self.conn.get(message_id)
+            res = self.ephemeral.get(message_id)
             if res is None:
                 return None, 'empty message value'
             return res, None
-        self.conn.set(message_id, value)
+        self.ephemeral.set(message_id, value, ex = self.message_id_expire)
         return value, None
 
     def message_id_last_process_time(self, message_id):
@@ -44,10 +233,14 @@ class RedisConnect:
         if it is the first time to process, will return 0.
         the process time of message_id will be updated to now.
 
+        the old value is read and replaced in one SET ... GET, so when 
+        instances behind a load balancer get the same event, only one of
+        them sees 0.
+
         return: 0 for first process, otherwise last process time.
         """
-        last_res, _ = self._message_id_to_value(message_id)
-        self._message_id_to_value(message_id, time.time())
+        last_res = self.ephemeral.set(
+            message_id, time.time(), ex = self.message_id_expire, get = True)
         return 0 if last_res is None else last_res
 
     def user_id_to_account_name(self, user_id, account_name = None, 
@@ -61,7 +254,7 @@ class RedisConnect:
             if got error, return (None, Error message).
         """
         if account_name is None:
-            res = self.conn.get(user_id)
+            res = self.key_cache.get(user_id)
             if res is None:
                 return None, 'empty account name'
             return res, None
@@ -83,8 +276,33 @@ class RedisConnect:
                 )
             self.conn.set(user_id, account_name)
             self.conn.set(self._account_key(account_name), user_id)
+            self.key_cache.invalidate(
+                user_id, self._account_key(account_name))
             return account_name, None
 
+    def bound_users(self, count = 500):
+        """
+        iterate bound accounts by SCAN, so all bindings are never loaded 
+        at once. yield a list of (account_name, user_id) for each SCAN 
+        batch. only accounts still in ENV/available_accounts are listed; 
+        an account may be listed twice if bindings change while scanning.
+        """
+        valid = set(list_available_accounts())
+        cursor = 0
+        while True:
+            cursor, keys = self.conn.scan(
+                cursor, match = self.an_prefix + '*', count = count)
+            names = [x[len(self.an_prefix):] for x in keys]
+            keys = [k for k, x in zip(keys, names) if x in valid]
+            if len(keys):
+                user_ids = self.conn.mget(keys)
+                yield [
+                    (k[len(self.an_prefix):], x)
+                    for k, x in zip(keys, user_ids) if x is not None
+                ]
+            if cursor == 0:
+                break
+
     def _account_key(self, account_name):
         return self.an_prefix + account_name
 
@@ -94,7 +312,8 @@ class RedisConnect:
     def _account_passwd_key(self, account_name):
         return self.an_prefix + account_name + '_passwd'
 
-    def user_id_to_pk(self, user_id, pk = None, append = True):
+    def user_id_to_pk(self, user_id, pk = None, append = True, 
+                      on_result = None):
         """
         alias of account_name_to_pk, except use user id as input, will
         find account name and call self.account_name_to_pk
@@ -102,15 +321,17 @@ class RedisConnect:
         return: if user id has corresponding account name, return the results
             of self.account_name_to_pk; otherwise, return (None, Error message)
         """
-        account_name = self.conn.get(user_id)
+        account_name = self.key_cache.get(user_id)
         if account_name is None:
             return None, 'user id has no corresponding account name'
-        return self.account_name_to_pk(account_name, pk, append)
+        return self.account_name_to_pk(account_name, pk, append, on_result)
             
-    def account_name_to_pk(self, account_name, pk = None, append = True):
+    def account_name_to_pk(self, account_name, pk = None, append = True,
+                           on_result = None):
         """
         get or set public key of an account. will check pk basic format.
-        after set, trigger self.update_account_pk.
+        after set, trigger self.update_account_pk. on_result is called when
+        each server is updated, see ssh.change_all_auth_keys.
 
         when set, defaule is append, and use `:' to split. 
         if not append, will replace the value.
@@ -119,16 +340,22 @@ class RedisConnect:
             if got error, return (None, Error message)
         """
         key = self._account_pk_key(account_name)
-        current = self.conn.get(key)
+        if pk is None:
+            current = self.key_cache.get(key)
+        else:
+            # read again for appending, cache may lag behind other workers
+            current = self.conn.get(key)
         if pk is None:
             if current is None:
                 return None, 'empty public key'
-            ret = self._update_account_pk(account_name)
+            ret = self._update_account_pk(account_name, on_result)
             if ret is not None:
                 return None, ret
             return current.split(':'), None
         if ':' in pk:
             return None, "public key should not contain `:'"
+        if '\n' in pk or '\r' in pk:
+            return None, 'public key should be in one line'
         if not is_valid_pk(pk):
             return None, 'public key is not valid'
         if duplicate_pk(current, pk):
@@ -138,26 +365,35 @@ class RedisConnect:
         if len(current) != 0:
             pk = current + ':' + pk
         self.conn.set(key, pk)
-        ret = self._update_account_pk(account_name)
+        self.key_cache.invalidate(key)
+        ret = self._update_account_pk(account_name, on_result)
         if ret is not None:
             return None, ret
         return pk.split(':'), None
 
-    def _update_account_pk(self, account_name):
+    def _update_account_pk(self, account_name, on_result = None):
         """
         update public keys of account
         """
         key = self._account_pk_key(account_name)
-        logging.warning(f'try to update public keys of {account_name}')
+        logging.info(f'try to update public keys of {account_name}')
         pk = self.conn.get(key).split(':')
-        ret = change_all_auth_keys(account_name, pk)
+        servers = available_servers()
+        marked = self._mark_auth_keys_dirty([account_name], servers)
+        ret = change_all_auth_keys(account_name, pk, on_result = on_result)
+        done = [x for x in servers if ret is None or x not in ret]
+        if len(done):
+            # failed servers are left to reconcile_auth_keys
+            self._zrem_if_score(keys = [self.auth_keys_dirty_key], args = [
+                y for x in done for y in (f'{account_name}@{x}', marked)])
         if ret is not None:
             return (
                 f'try to update public key, but some server '
                 f'update failed. detail: {ret}' 
             )
 
-    def user_id_to_password(self, user_id, password = None):
+    def user_id_to_password(self, user_id, password = None, 
+                            on_result = None):
         """
         alias of account_name_to_password, except use user id as input, will
         find account name and call self.account_name_to_password
@@ -165,15 +401,18 @@ class RedisConnect:
         return: if user id has corresponding account name, return the results
             of self.account_name_to_pk; otherwise, return (None, Error message)
         """
-        account_name = self.conn.get(user_id)
+        account_name = self.key_cache.get(user_id)
         if account_name is None:
             return None, 'user id has no corresponding account name'
-        return self.account_name_to_password(account_name, password)
+        return self.account_name_to_password(account_name, password, 
+                                             on_result)
             
-    def account_name_to_password(self, account_name, password = None):
+    def account_name_to_password(self, account_name, password = None,
+                                 on_result = None):
         """
         get or set password of an account. 
-        after set, trigger self.update_account_passwd.
+        after set, trigger self.update_account_passwd. on_result is called 
+        when each server is updated, see ssh.change_all_password.
 
         return: if get or successfully set, return (password, None)
             if got error, return (None, Error message)
@@ -183,23 +422,129 @@ class RedisConnect:
             return None, 'unable to set password, can only get random password'
         new_passwd = generate_password()
         # self.conn.set(key, new_passwd)  # currently no need to save in db
-        ret = self._update_account_passwd(account_name, new_passwd)
+        ret = self._update_account_passwd(account_name, new_passwd, 
+                                          on_result)
         if ret is not None:
             return None, ret
         return new_passwd, None
 
-    def _update_account_passwd(self, account_name, passwd):
+    def _update_account_passwd(self, account_name, passwd, on_result = None):
         """
         update password of an account.
         """
-        logging.warning(f'try to update password of {account_name}')
-        ret = change_all_password(account_name, passwd)
+        logging.info(f'try to update password of {account_name}')
+        # record before change, so the password is locked even if changing
+        # is interrupted
+        self._record_unlocked([account_name])
+        ret = change_all_password(account_name, passwd, on_result = on_result)
         if ret is not None:
             return (
                 f'try to set password {passwd}, but some server '
                 f'set failed. detail: {ret}' 
             )
     
+    def full_lock_password_due(self, days = None):
+        """
+        whether a full password lock of all accounts should run, i.e. last
+        successful full lock is older than days. default from env
+        FULL_LOCK_PASSWORD_DAYS or 7.
+        """
+        if days is None:
+            days = float(os.getenv('FULL_LOCK_PASSWORD_DAYS', 7))
+        last = self.conn.get(self.full_lock_time_key)
+        return last is None or time.time() - float(last) >= days * 86400
+
+    def lock_password(self, full = False, on_result = None, 
+                      issued_before = None):
+        """
+        lock passwords. if full, lock all accounts on all servers; else only
+        lock (account, server) pairs that received a password and are not
+        locked yet. on_result is called when each server finishes, see 
+        ssh.lock_all_password.
+        issued_before: if set, only passwords issued before this UNIX 
+            timestamp are locked. not used when full.
+
+        return: if all success, none. else, a dict: 
+            {error_server_name: { stdout: xxx, stderr: yyy } }
+        """
+        if full or issued_before is None:
+            issued_before = '+inf'
+        unlocked = self.conn.zrangebyscore(
+            self.unlocked_key, '-inf', issued_before, withscores = True)
+        server_pairs = {}
+        for member, score in unlocked:
+            account_name, server = member.rsplit('@', 1)
+            server_pairs.setdefault(server, []).append(
+                (account_name, member, score))
+        if full:
+            start = time.time()
+            ret = lock_all_password(on_result = on_result)
+        else:
+            if len(server_pairs) == 0:
+                return
+            logging.info(
+                f'lock password of {len(unlocked)} accounts on '
+                f'{len(server_pairs)} servers')
+            ret = lock_passwords({
+                server: [x[0] for x in pairs] 
+                for server, pairs in server_pairs.items()
+            }, on_result = on_result)
+        failed = ret if ret is not None else {}
+        locked = []
+        for server, pairs in server_pairs.items():
+            if server not in failed:
+                for _, member, score in pairs:
+                    locked += [member, repr(score)]
+        if len(locked):
+            self._zrem_if_score(keys = [self.unlocked_key], args = locked)
+        if full and ret is None:
+            self.conn.set(self.full_lock_time_key, start)
+        return ret
+
+    def expire_password(self, on_result = None):
+        """
+        lock passwords that are issued password_expire_hours ago, batched 
+        by server. expected to run every minute.
+
+        return: same as self.lock_password.
+        """
+        return self.lock_password(
+            on_result = on_result, 
+            issued_before = time.time() - self.password_expire_hours * 3600)
+
+    def _record_unlocked(self, account_names):
+        """
+        record passwords of accounts are issued now, see self.unlocked_key.
+        """
+        now = time.time()
+        self.conn.zadd(self.unlocked_key, {
+            f'{account_name}@{server}': now 
+            for account_name in account_names
+            for server in password_servers(account_name)
+        })
+
+    def rotate_passwords(self, account_names, on_result = None):
+        """
+        generate new passwords of many accounts, and set them in all 
+        servers with one SSH session per server. on_result is called when
+        each server finishes, see ssh.change_all_passwords.
+
+        return: ({account_name: (password, {failed_server: reason})}, None)
+            if got error, return (None, Error message)
+        """
+        account_names = list(dict.fromkeys(account_names))
+        if len(account_names) == 0:
+            return None, 'no account to rotate'
+        for account_name in account_names:
+            if account_name != 'mdm' and not is_valid_account_name(
+                    account_name):
+                return None, f'account name({account_name}) not in valid list'
+        passwords = [(x, generate_password()) for x in account_names]
+        logging.info(f'try to rotate password of {account_names}')
+        self._record_unlocked(account_names)
+        failed = change_all_passwords(passwords, on_result = on_result)
+        return {x: (p, failed[x]) for x, p in passwords}, None
+
     def clear_user_data(self, user_id):
         """
         clear user data based on user_id. if it is linked to a account name,
@@ -218,8 +563,114 @@ class RedisConnect:
             return None, f'user data of user id({user_id}) not found'
         if len(rmkeys):
             self.conn.delete(*rmkeys)
+            self.key_cache.invalidate(*rmkeys)
+            # keys of this account in servers are removed in background
+            self._mark_auth_keys_dirty([account_name])
         return rmkeys, None
 
+    def _mark_auth_keys_dirty(self, account_names, servers = None):
+        """
+        mark authorized_keys of accounts in servers (default all servers) 
+        should be updated, see self.auth_keys_dirty_key.
+
+        return: the time marked, as score in self.auth_keys_dirty_key.
+        """
+        if servers is None:
+            servers = available_servers()
+        now = time.time()
+        members = {f'{x}@{y}': now for x in account_names for y in servers}
+        if len(members):
+            self.conn.zadd(self.auth_keys_dirty_key, members)
+        return now
+
+    def _pk_account_names(self):
+        """
+        valid account names that have public keys in db.
+        """
+        res = []
+        for key in self.conn.scan_iter(match = f'{self.an_prefix}*_pk'):
+            account_name = key[len(self.an_prefix):-len('_pk')]
+            if is_valid_account_name(account_name):
+                res.append(account_name)
+        return res
+
+    def reconcile_auth_keys(self):
+        """
+        update authorized_keys of dirty account@server pairs, at most 
+        self.auth_keys_pool servers at the same time, one SSH session per 
+        server. all accounts with public keys are marked dirty in servers 
+        newly added to available_servers. expected to run periodically.
+
+        return: if all dirty pairs are updated, None; else error message.
+        """
+        servers = available_servers()
+        known = self.conn.smembers(self.auth_keys_servers_key)
+        new = [x for x in servers if x not in known]
+        if len(new):
+            logging.info(f'new servers to update public keys: {new}')
+            self._mark_auth_keys_dirty(self._pk_account_names(), new)
+            self.conn.sadd(self.auth_keys_servers_key, *new)
+        removed = known - set(servers)
+        if len(removed):
+            self.conn.srem(self.auth_keys_servers_key, *removed)
+
+        dirty = self.conn.zrange(
+            self.auth_keys_dirty_key, 0, -1, withscores = True)
+        if len(dirty) == 0:
+            return
+        server_user_keys = {}
+        account_keys = {}
+        dropped = []
+        for member, score in dirty:
+            account_name, server = member.rsplit('@', 1)
+            if server not in servers or not is_valid_account_name(
+                    account_name):
+                dropped.append(member)
+                continue
+            if account_name not in account_keys:
+                pk = self.conn.get(self._account_pk_key(account_name))
+                account_keys[account_name] = pk.split(':') if pk else []
+            server_user_keys.setdefault(server, {})[account_name] = \
+                account_keys[account_name]
+        if len(dropped):
+            self.conn.zrem(self.auth_keys_dirty_key, *dropped)
+        logging.info(
+            f'try to update public keys of {len(dirty) - len(dropped)} '
+            f'dirty account@server')
+        updated = reconcile_auth_keys(
+            server_user_keys, pool = self.auth_keys_pool)
+        scores = dict(dirty)
+        done = []
+        for server, account_names in updated.items():
+            for account_name in account_names:
+                member = f'{account_name}@{server}'
+                done += [member, scores[member]]
+        if len(done):
+            # pairs marked again while updating stay dirty
+            self._zrem_if_score(keys = [self.auth_keys_dirty_key], args = done)
+        left = len(dirty) - len(dropped) - len(done) // 2
+        if left:
+            return f'{left} account@server failed to update public keys'
+
+    def verify_auth_keys(self):
+        """
+        compare digests of public keys in servers with db, different 
+        account@server are marked dirty. expected to run periodically.
+
+        return: list of different `account@server'.
+        """
+        user_keys = {}
+        for account_name in self._pk_account_names():
+            pk = self.conn.get(self._account_pk_key(account_name))
+            user_keys[account_name] = pk.split(':') if pk else []
+        different = verify_all_auth_keys(
+            user_keys, pool = self.auth_keys_pool)
+        res = []
+        for account_name, server in different:
+            self._mark_auth_keys_dirty([account_name], [server])
+            res.append(f'{account_name}@{server}')
+        return res
+
     def get_all_keys(self):
         """
         get all keys
@@ -242,6 +693,7 @@ class RedisConnect:
             return 'None', None
         else:
             self.conn.set(key, value)
+            self.key_cache.invalidate(key)
             return value, None
 
     def delete_db(self, key):
@@ -252,14 +704,64 @@ class RedisConnect:
         if res is None:
             return None, f'Key {key} not exist'
         self.conn.delete(key)
+        self.key_cache.invalidate(key)
         return key, None
 
     def clear_message_id(self):
         """
-        clear message_id in db
+        clear message_id in db. also those in self.conn, which are written
+        before the ephemeral tier is set.
         """
-        keys = self.conn.keys('om_*')
-        if len(keys):
-            self.conn.delete(*keys)
+        conns = [self.ephemeral]
+        if self.conn is not self.ephemeral:
+            conns.append(self.conn)
+        keys = []
+        for conn in conns:
+            found = conn.keys('om_*')
+            if len(found):
+                conn.delete(*found)
+            keys += found
         keys.sort()
         return keys, None
+
+    def get_telemetry(self, server):
+        """
+        return: telemetry state of server (see telemetry.apply_updates), 
+            or None if not pushed recently.
+        """
+        res = self.ephemeral.get(self.telemetry_prefix + server)
+        return None if res is None else json.loads(res)
+
+    def get_all_telemetry(self, servers):
+        """
+        return: list of telemetry state or None, in order of servers.
+        """
+        if len(servers) == 0:
+            return []
+        res = self.ephemeral.mget([self.telemetry_prefix + x for x in servers])
+        return [None if x is None else json.loads(x) for x in res]
+
+    def set_telemetry(self, server, state):
+        self.ephemeral.set(
+            self.telemetry_prefix + server, 
+            json.dumps(state, separators = (',', ':')),
+            ex = self.telemetry_expire
+        )
+
+    def take_rate_limit_token(self, buckets):
+        """
+        token bucket rate limit. buckets is a list of 
+        (name, capacity, seconds to refill one token). a token is taken from 
+        all buckets only when every bucket has one.
+
+        return: (True, 0) if allowed, otherwise (False, seconds to wait).
+        """
+        if len(buckets) == 0:
+            return True, 0
+        keys = []
+        args = []
+        for name, capacity, interval in buckets:
+            keys.append(self.rate_limit_prefix + name)
+            args += [capacity, interval]
+        allowed, wait = self._token_bucket(keys = keys, args = args)
+        return bool(int(allowed)), float(wait)
@@ -1,19 +1,20 @@
 #!/usr/bin/env python3.8
 
+import os
+import hmac
 import json
 import abc
+import time
 import hashlib
 import typing as t
 from utils import dict_2_obj
-from flask import request, jsonify
-from decrypt import AESCipher
 
 
 class Event(object):
     callback_handler = None
 
     # event base
-    def __init__(self, dict_data, token, encrypt_key):
+    def __init__(self, dict_data, token, signed):
         # event check and init
         header = dict_data.get("header")
         event = dict_data.get("event")
@@ -21,20 +22,14 @@ class Event(object):
             raise InvalidEventException("request is not callback event(v2)")
         self.header = dict_2_obj(header)
         self.event = dict_2_obj(event)
-        self._validate(token, encrypt_key)
-
-    def _validate(self, token, encrypt_key):
-        if self.header.token != token:
-            raise InvalidEventException("invalid token")
-        timestamp = request.headers.get("X-Lark-Request-Timestamp")
-        nonce = request.headers.get("X-Lark-Request-Nonce")
-        signature = request.headers.get("X-Lark-Signature")
-        body = request.data
-        bytes_b1 = (timestamp + nonce + encrypt_key).encode("utf-8")
-        bytes_b = bytes_b1 + body
-        h = hashlib.sha256(bytes_b)
-        if signature != h.hexdigest():
-            raise InvalidEventException("invalid signature in event")
+        self._validate(token, signed)
+
+    def _validate(self, token, signed):
+        # signature is checked by CallbackVerifier before parsing
+        if not signed:
+            raise InvalidEventException("no signature in event", 401)
+        if not CallbackVerifier.same_string(self.header.token, token):
+            raise InvalidEventException("invalid token", 401)
 
     @abc.abstractmethod
     def event_type(self):
@@ -72,6 +67,81 @@ class AlertManagerEvent(Event):
         return "alert_manager"
 
 
+class CallbackVerifier(object):
+    """
+    verify and decrypt callbacks from Lark. create once at startup, so the
+    derived AES key is reused by all requests. the cipher (and the crypto
+    module) is loaded on the first encrypted callback.
+    """
+    def __init__(self, token, encrypt_key, max_age = None):
+        """
+        args:
+            token: VERIFICATION_TOKEN.
+            encrypt_key: ENCRYPT_KEY, empty means callbacks are not encrypted.
+            max_age: max seconds between X-Lark-Request-Timestamp and now.
+                0 means not check. default from env CALLBACK_MAX_AGE or 300.
+        """
+        if max_age is None:
+            max_age = int(os.getenv("CALLBACK_MAX_AGE", 300))
+        self.token = token
+        self.encrypt_key = encrypt_key or ""
+        self.max_age = max_age
+        self._encrypt_key_bytes = self.encrypt_key.encode("utf-8")
+        self._cipher = None
+
+    @staticmethod
+    def same_string(a, b):
+        """
+        constant-time string compare.
+        """
+        if not isinstance(a, str) or not isinstance(b, str):
+            return False
+        return hmac.compare_digest(a.encode("utf-8"), b.encode("utf-8"))
+
+    def verify_signature(self, headers, body):
+        """
+        check timestamp and signature of raw body. called before any JSON
+        work, so forged or stale requests are dropped cheaply.
+
+        return: True if verified, False if request is not signed.
+            raise InvalidEventException if signature is wrong or stale.
+        """
+        signature = headers.get("X-Lark-Signature")
+        if signature is None:
+            return False
+        timestamp = headers.get("X-Lark-Request-Timestamp")
+        nonce = headers.get("X-Lark-Request-Nonce")
+        if timestamp is None or nonce is None:
+            raise InvalidEventException("incomplete signature headers", 401)
+        if self.max_age:
+            try:
+                age = abs(time.time() - int(timestamp))
+            except ValueError:
+                raise InvalidEventException("invalid request timestamp", 401)
+            if age > self.max_age:
+                raise InvalidEventException("stale request timestamp", 401)
+        h = hashlib.sha256(timestamp.encode("utf-8"))
+        h.update(nonce.encode("utf-8"))
+        h.update(self._encrypt_key_bytes)
+        h.update(body)
+        if not CallbackVerifier.same_string(signature, h.hexdigest()):
+            raise InvalidEventException("invalid signature in event", 401)
+        return True
+
+    def decrypt(self, data):
+        encrypt_data = data.get("encrypt")
+        if self.encrypt_key == "" and encrypt_data is None:
+            # data haven't been encrypted
+            return data
+        if self.encrypt_key == "":
+            raise Exception("ENCRYPT_KEY is necessary")
+        if self._cipher is None:
+            from decrypt import AESCipher
+            self._cipher = AESCipher(self.encrypt_key)
+
+        return json.loads(self._cipher.decrypt_string(encrypt_data))
+
+
 class EventManager(object):
     event_callback_map = dict()
     event_type_map = dict()
@@ -81,9 +151,10 @@ class EventManager(object):
         AlertManagerEvent
     ]
 
-    def __init__(self):
+    def __init__(self, token, encrypt_key):
         for event in EventManager._event_list:
             EventManager.event_type_map[event.event_type()] = event
+        self.verifier = CallbackVerifier(token, encrypt_key)
 
     def register(self, event_type: str) -> t.Callable:
         def decorator(f: t.Callable) -> t.Callable:
@@ -96,18 +167,41 @@ class EventManager(object):
     def register_handler_with_event_type(event_type, handler):
         EventManager.event_callback_map[event_type] = handler
 
-    @staticmethod
-    def get_handler_with_event(token, encrypt_key):
-        dict_data = json.loads(request.data)
-        if EventManager._from_alertmanager(dict_data):
+    def get_handler_with_event(self):
+        # for Flask (server.py), asgi.py calls parse directly
+        from flask import request
+        return self.parse(request.headers, request.get_data())
+
+    def parse(self, headers, body):
+        """
+        verify and parse a raw callback, independent of web framework.
+        with ENCRYPT_KEY, a body without signature is accepted only as an
+        AlertManager payload, or as an encrypted url verification with the
+        right token. events (v2) always need a signature.
+
+        return: (handler, event)
+            raise InvalidEventException if the callback is rejected.
+        """
+        signed = self.verifier.verify_signature(headers, body)
+        dict_data = json.loads(body)
+        if not signed and EventManager._from_alertmanager(dict_data):
             # return AlterManager, data
             event_type = "alert_manager"
             event = EventManager.event_type_map.get(event_type)(dict_data)
             return EventManager.event_callback_map.get(event_type), event
-        dict_data = EventManager._decrypt_data(encrypt_key, dict_data)
+        if self.verifier.encrypt_key and "encrypt" not in dict_data:
+            raise InvalidEventException("event is not encrypted", 401)
+        try:
+            dict_data = self.verifier.decrypt(dict_data)
+        except ValueError:
+            raise InvalidEventException("can not decrypt event", 401)
         callback_type = dict_data.get("type")
-        # only verification data has callback_type, else is event
+        # only verification data has callback_type, else is event.
+        # Lark does not sign it, the token is checked instead
         if callback_type == "url_verification":
+            if not CallbackVerifier.same_string(
+                    dict_data.get("token"), self.verifier.token):
+                raise InvalidEventException("invalid token", 401)
             event = UrlVerificationEvent(dict_data)
             return EventManager.event_callback_map.get(event.event_type()), event
 
@@ -119,7 +213,8 @@ class EventManager(object):
         # get event_type
         event_type = dict_data.get("header").get("event_type")
         # build event
-        event = EventManager.event_type_map.get(event_type)(dict_data, token, encrypt_key)
+        event = EventManager.event_type_map.get(event_type)(
+            dict_data, self.verifier.token, signed)
         # get handler
         return EventManager.event_callback_map.get(event_type), event
 
@@ -131,22 +226,12 @@ class EventManager(object):
                 return False
         return True
 
-    @staticmethod
-    def _decrypt_data(encrypt_key, data):
-        encrypt_data = data.get("encrypt")
-        if encrypt_key == "" and encrypt_data is None:
-            # data haven't been encrypted
-            return data
-        if encrypt_key == "":
-            raise Exception("ENCRYPT_KEY is necessary")
-        cipher = AESCipher(encrypt_key)
-
-        return json.loads(cipher.decrypt_string(encrypt_data))
-
 
 class InvalidEventException(Exception):
-    def __init__(self, error_info):
+    def __init__(self, error_info, status_code = 400):
         self.error_info = error_info
+        # HTTP status of the response, 401 for failed authentication
+        self.status_code = status_code
 
     def __str__(self) -> str:
         return "Invalid event: {}".format(self.error_info)
@@ -0,0 +1,135 @@
+import time
+import logging
+import threading
+
+
+class HostHealth:
+    """
+    recent health of servers, recorded from results of remote commands.
+
+    a server is `down' after `threshold' consecutive connection failures
+    (SSH exit code 255 or timeout). a down server is skipped and reported
+    instantly until `cooldown' seconds passed, then one request (or a
+    background probe) is allowed to try it again. a success closes the
+    circuit. a probe that never reports back (its caller raised before
+    record or release) expires after max(cooldown, probe_timeout) seconds,
+    then another probe is allowed.
+    """
+    def __init__(self, threshold = 3, cooldown = 60, latency_alpha = 0.3,
+                 probe_timeout = None):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.probe_timeout = max(cooldown, probe_timeout or 0)
+        self.latency_alpha = latency_alpha
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def _host(self, server):
+        if server not in self._hosts:
+            self._hosts[server] = {
+                'failures': 0,
+                'latency': None,
+                'last_error': None,
+                'last_seen': None,
+                'down_since': None,
+                'retry_at': 0,
+                # a probe is running until then
+                'probe_until': 0,
+            }
+        return self._hosts[server]
+
+    @staticmethod
+    def is_connection_failure(result):
+        """
+        whether a CommandResult means the server is unreachable. other non
+        zero return codes are errors of the command, the server is alive.
+        """
+        return result.timed_out or result.returncode == 255
+
+    def record(self, server, result):
+        """
+        record a CommandResult of server.
+        """
+        now = time.time()
+        with self._lock:
+            host = self._host(server)
+            host['probe_until'] = 0
+            if self.is_connection_failure(result):
+                host['failures'] += 1
+                host['last_error'] = (result.stderr or '').strip()[-200:]
+                if host['failures'] >= self.threshold:
+                    if host['down_since'] is None:
+                        host['down_since'] = now
+                        logging.warning(
+                            f'server {server} is down: {host["last_error"]}')
+                    host['retry_at'] = now + self.cooldown
+                return
+            if host['down_since'] is not None:
+                logging.info(f'server {server} is up again')
+            host['failures'] = 0
+            host['down_since'] = None
+            host['last_seen'] = now
+            if host['latency'] is None:
+                host['latency'] = result.duration
+            else:
+                host['latency'] += self.latency_alpha * (
+                    result.duration - host['latency'])
+
+    def allow(self, server):
+        """
+        whether a command should be sent to server now. a down server is
+        allowed once after cooldown, as a probe.
+        """
+        now = time.time()
+        with self._lock:
+            host = self._host(server)
+            if host['down_since'] is None:
+                return True
+            if now < host['probe_until'] or now < host['retry_at']:
+                return False
+            host['probe_until'] = now + self.probe_timeout
+            return True
+
+    def release(self, server):
+        """
+        end a probe allowed by allow without a result, e.g. the command
+        raised. call it in finally, it does nothing after record.
+        """
+        with self._lock:
+            self._host(server)['probe_until'] = 0
+
+    def is_down(self, server):
+        with self._lock:
+            return self._host(server)['down_since'] is not None
+
+    def down_servers(self):
+        with self._lock:
+            return [
+                k for k, v in self._hosts.items() if v['down_since'] is not None
+            ]
+
+    def down_message(self, server):
+        with self._lock:
+            host = self._host(server)
+            return (
+                f'known down since {time.ctime(host["down_since"])} after '
+                f'{host["failures"]} failures, last error: '
+                f'{host["last_error"]}'
+            )
+
+    def summary(self, server):
+        """
+        one line health description of server.
+        """
+        with self._lock:
+            host = self._host(server)
+            if host['down_since'] is not None:
+                minutes = (time.time() - host['down_since']) / 60
+                return (f'DOWN {minutes:.0f}min, '
+                        f'{host["failures"]} failures')
+            if host['last_seen'] is None:
+                return 'unknown'
+            res = f'ok {host["latency"]:.1f}s'
+            if host['failures']:
+                res += f', {host["failures"]} recent failures'
+            return res
@@ -0,0 +1,156 @@
+import os
+import logging
+import fnmatch
+import threading
+from collections import namedtuple
+
+
+# one server. name is the nickname used by SSH and commands, address and
+# aliases are from the hosts line, source is the hosts file of that line.
+Host = namedtuple('Host', ['name', 'address', 'aliases', 'source'])
+
+
+class HostInventory:
+    """
+    servers of the bot, single source of host lists for all modules.
+
+    nicknames are read from ENV/available_servers and ENV/master_server,
+    addresses from /etc/hosts and /etc/host_hosts. files are parsed into
+    dict indexes, so a lookup is exact (`node1' never matches `node10') and
+    O(1). files are parsed again only when one of them changes.
+    """
+    def __init__(self,
+                 servers_path = 'ENV/available_servers',
+                 master_path = 'ENV/master_server',
+                 hosts_paths = ('/etc/hosts', '/etc/host_hosts')):
+        self.servers_path = servers_path
+        self.master_path = master_path
+        self.hosts_paths = list(hosts_paths)
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._servers = []
+        self._server_set = set()
+        self._master = None
+        self._hosts = {}
+
+    @staticmethod
+    def _file_stamp(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    @staticmethod
+    def _read_lines(path):
+        try:
+            return open(path).read().strip().split('\n')
+        except OSError:
+            return []
+
+    @staticmethod
+    def parse_hosts(text, source = None, index = None):
+        """
+        parse hosts file text into index {name: Host}. the first line of a
+        name wins, comments and empty lines are ignored.
+        """
+        if index is None:
+            index = {}
+        for line in text.split('\n'):
+            line = line.split('#')[0].split()
+            if len(line) < 2:
+                continue
+            address, names = line[0], line[1:]
+            for name in names:
+                if name not in index:
+                    index[name] = Host(name, address, names, source)
+        return index
+
+    def _refresh(self):
+        paths = [self.servers_path, self.master_path] + self.hosts_paths
+        stamp = tuple(self._file_stamp(x) for x in paths)
+        if stamp == self._stamp:
+            return
+        with self._lock:
+            if stamp == self._stamp:
+                return
+            servers = [
+                x.strip() for x in self._read_lines(self.servers_path)
+                if x.strip() != ''
+            ]
+            master = (self._read_lines(self.master_path) + [''])[0].strip()
+            master = master or None
+            hosts = {}
+            for path in self.hosts_paths:
+                self.parse_hosts(
+                    '\n'.join(self._read_lines(path)), path, hosts)
+            self._servers = servers
+            self._server_set = set(servers)
+            self._master = master
+            self._hosts = hosts
+            self._stamp = stamp
+            logging.info(
+                f'inventory loaded: {len(servers)} servers, master {master}, '
+                f'{len(hosts)} host names')
+
+    def available_servers(self):
+        """
+        nicknames of servers that users can use, in file order.
+        """
+        self._refresh()
+        return list(self._servers)
+
+    def master_server(self):
+        """
+        nickname of the master server, where the bot runs.
+        """
+        self._refresh()
+        return self._master
+
+    def is_available(self, name):
+        self._refresh()
+        return name in self._server_set
+
+    def select(self, patterns):
+        """
+        available servers matching names or glob patterns like `node0*',
+        `all' matches all servers.
+
+        return: (matched servers in file order, patterns matched nothing)
+        """
+        servers = self.available_servers()
+        matched = set()
+        unknown = []
+        for pattern in patterns:
+            if pattern == 'all':
+                found = servers
+            elif pattern in self._server_set:
+                found = [pattern]
+            else:
+                found = fnmatch.filter(servers, pattern)
+            if len(found) == 0:
+                unknown.append(pattern)
+            matched.update(found)
+        return [x for x in servers if x in matched], unknown
+
+    def lookup(self, name):
+        """
+        return: Host of name, or None if name is not in hosts files.
+        """
+        self._refresh()
+        return self._hosts.get(name)
+
+    def address(self, name):
+        host = self.lookup(name)
+        return None if host is None else host.address
+
+    def hosts(self):
+        """
+        return: Host of available servers which have address, in file order.
+        """
+        self._refresh()
+        hosts = self._hosts
+        return [hosts[x] for x in self._servers if x in hosts]
+
+
+inventory = HostInventory()
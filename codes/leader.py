@@ -0,0 +1,121 @@
+import os
+import time
+import atexit
+import socket
+import logging
+import secrets
+import threading
+
+
+# extend the lease only if it is still held by this instance.
+# KEYS[1] is the lease, ARGV are instance id and lease milliseconds.
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# delete the lease only if it is held by this instance
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class LeaderLease:
+    """
+    elect one leader among bot instances sharing a Redis, by a lease key
+    holding the id of the leader. the leader renews it every lease/3
+    seconds, others try to take it at the same pace, so a crashed leader
+    is replaced in about `lease' seconds, and a stopped one at once.
+
+    an instance treats itself as leader only while the lease it last got
+    or renewed is not expired by its own clock, so a stalled leader stops
+    running singleton work before another one can start.
+    envs: LEADER_LEASE_SECONDS (default 15), LEADER_KEY (default
+    `leader_lease').
+    """
+    def __init__(self, conn, lease = None, key = None):
+        self.conn = conn
+        self.lease = float(
+            lease or os.getenv('LEADER_LEASE_SECONDS', 15))
+        self.key = key or os.getenv('LEADER_KEY', 'leader_lease')
+        self.id = f'{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}'
+        self._renew = conn.register_script(RENEW_SCRIPT)
+        self._release = conn.register_script(RELEASE_SCRIPT)
+        self._valid_until = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def is_leader(self):
+        return time.monotonic() < self._valid_until
+
+    def _try_lead(self):
+        """
+        take or renew the lease. return whether this instance is leader.
+        """
+        if self._stop.is_set():
+            return False
+        start = time.monotonic()
+        lease_ms = int(self.lease * 1000)
+        ok = (
+            self._renew(keys = [self.key], args = [self.id, lease_ms])
+            or self.conn.set(self.key, self.id, nx = True, px = lease_ms))
+        was_leader = self.is_leader()
+        # counted from before the request, so it never outlives the key
+        self._valid_until = start + self.lease if ok else 0
+        if ok and not was_leader:
+            logging.info(f'became leader {self.id}')
+        elif was_leader and not ok:
+            logging.warning(f'lost leadership {self.id}')
+        return bool(ok)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._try_lead()
+            except Exception as e:
+                if self.is_leader():
+                    logging.warning(f'renew leader lease failed: {e}')
+            self._stop.wait(self.lease / 3)
+
+    def start(self):
+        """
+        start electing in a daemon thread. the lease is released at exit.
+        """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target = self._run, name = 'leader-lease', daemon = True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """
+        stop electing and release the lease, so another instance takes
+        over without waiting for expiry.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.lease / 3)
+        was_leader = self.is_leader()
+        self._valid_until = 0
+        if was_leader:
+            try:
+                self._release(keys = [self.key], args = [self.id])
+            except Exception as e:
+                logging.warning(f'release leader lease failed: {e}')
+
+    def only(self, func):
+        """
+        wrap func to run only on the leader, for scheduled jobs.
+        """
+        def wrapper(*args, **kwargs):
+            if not self.is_leader():
+                return None
+            return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        return wrapper
@@ -0,0 +1,175 @@
+import os
+import re
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import contextvars
+import logging.handlers
+from contextlib import contextmanager
+
+
+# fields added to every log record in the current request, see log_context
+_context = contextvars.ContextVar('log_context', default = {})
+CONTEXT_FIELDS = ['request_id', 'command', 'host']
+
+# secrets in messages are replaced by `***'
+REDACT_PATTERNS = [
+    # Lark tenant/user access tokens
+    re.compile(r'\b[tu]-[0-9A-Za-z_]{16,}'),
+    re.compile(r'(?i)(bearer\s+)\S+'),
+    # values of keys like `password=...' or `"app_secret": "..."'
+    re.compile(r'(?i)((?<![a-z])(?:password|passwd|secret|token)["\']?'
+               r'\s*[:=]\s*["\']?)[^\s"\',{}()\[\]]+'),
+]
+# values of these envs are replaced wherever they appear
+REDACT_ENVS = ['APP_SECRET', 'VERIFICATION_TOKEN', 'ENCRYPT_KEY']
+# libraries that log every job or connection at INFO or DEBUG
+QUIET_LOGGERS = ['apscheduler', 'urllib3', 'httpx', 'httpcore', 'tzlocal']
+
+_listener = None
+
+
+@contextmanager
+def log_context(**fields):
+    """
+    add fields (request_id, command, host) to logs in this block. works in
+    threads and coroutines, and is copied to asyncio.to_thread and tasks.
+    """
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """
+    copy log_context fields to record, and keep 1 of every 1/sample_rate
+    DEBUG records. runs in the thread that logs, so it must be cheap.
+    """
+    def __init__(self, sample_rate = 1.0):
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record):
+        if (
+            record.levelno <= logging.DEBUG
+            and self.sample_rate < 1
+            and random.random() >= self.sample_rate
+        ):
+            return False
+        for key, value in _context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+def redact(text):
+    for pattern in REDACT_PATTERNS:
+        text = pattern.sub(
+            lambda m: (m.group(1) if m.groups() else '') + '***', text)
+    for env in REDACT_ENVS:
+        value = os.getenv(env) or ''
+        if len(value) >= 6:
+            text = text.replace(value, '***')
+    return text
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    one JSON object a line, with time, level, module, message and context
+    fields. secrets are redacted.
+    """
+    def format(self, record):
+        data = {
+            'time': time.strftime(
+                '%Y-%m-%dT%H:%M:%S', time.localtime(record.created))
+                + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'module': record.module,
+            'message': redact(record.getMessage()),
+        }
+        for key in CONTEXT_FIELDS:
+            value = getattr(record, key, None)
+            if value is not None:
+                data[key] = value
+        if record.exc_info:
+            data['exc'] = redact(self.formatException(record.exc_info))
+        return json.dumps(data, ensure_ascii = False, default = str)
+
+
+class TextFormatter(logging.Formatter):
+    """
+    plain text for reading in terminal, secrets are redacted.
+    """
+    def __init__(self):
+        super().__init__(
+            '%(asctime)s %(levelname)s %(module)s %(context)s%(message)s')
+
+    def format(self, record):
+        record.context = ''.join(
+            f'[{getattr(record, x)}] ' for x in CONTEXT_FIELDS
+            if getattr(record, x, None) is not None)
+        return redact(super().format(record))
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that drops records when the queue is full, so logging
+    never blocks a request.
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging():
+    """
+    log through a queue: callers only copy the record to the queue, and a
+    background thread formats and writes it. configured by envs LOG_LEVEL
+    (default INFO), LOG_FORMAT (json or text, default json),
+    LOG_DEBUG_SAMPLE (fraction of DEBUG records kept, default 1) and
+    LOG_QUEUE_SIZE (default 10000).
+    """
+    global _listener
+    if _listener is not None:
+        return
+    level = os.getenv('LOG_LEVEL', 'INFO').upper()
+    formatter = (
+        TextFormatter() if os.getenv('LOG_FORMAT', 'json') == 'text'
+        else JsonFormatter())
+    context_filter = ContextFilter(float(os.getenv('LOG_DEBUG_SAMPLE', 1)))
+    stream = logging.StreamHandler()
+    stream.setFormatter(formatter)
+    log_queue = queue.Queue(int(os.getenv('LOG_QUEUE_SIZE', 10000)))
+    handler = DroppingQueueHandler(log_queue)
+    handler.addFilter(context_filter)
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(handler)
+    root.setLevel(level)
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+    _listener = logging.handlers.QueueListener(log_queue, stream)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    def after_fork():
+        # no listener thread in forked workers, write directly there
+        root.removeHandler(handler)
+        direct = logging.StreamHandler()
+        direct.setFormatter(formatter)
+        direct.addFilter(context_filter)
+        root.addHandler(direct)
+
+    os.register_at_fork(after_in_child = after_fork)
@@ -2,8 +2,7 @@
 
 import os
 import logging
-import requests
-import json
+import threading
 from db import RedisConnect
 from command import CommandParser
 from api import MessageApiClient
@@ -11,20 +10,25 @@ from event import (
     MessageReceiveEvent, 
     UrlVerificationEvent, 
     AlertManagerEvent,
-    EventManager
+    EventManager,
+    CallbackVerifier,
+    InvalidEventException
 )
 from flask import Flask, jsonify, request
-from flask_apscheduler import APScheduler
 from dotenv import load_dotenv, find_dotenv
 from utils import (
-    parse_alertmanager_value_string, 
-    generate_alert_card,
+    alertmanager_card,
     update_hosts
 )
-from ssh import lock_all_password
+from tasks import register_tasks, warm_up
+from leader import LeaderLease
+from alerts import AlertRouter
+from log import setup_logging, log_context
+import telemetry
 
 # load env parameters form file named .env
 load_dotenv(find_dotenv())
+setup_logging()
 
 app = Flask(__name__)
 
@@ -35,17 +39,25 @@ VERIFICATION_TOKEN = os.getenv("VERIFICATION_TOKEN")
 ENCRYPT_KEY = os.getenv("ENCRYPT_KEY")
 LARK_HOST = os.getenv("LARK_HOST")
 ALERT_GROUP_NUMBER = os.getenv("ALERT_GROUP_NUMBER")
+# chats of alerts by labels, see ENV/alert_routes
+alert_router = AlertRouter(ALERT_GROUP_NUMBER)
 # LOCK_PASSWORD_INTERVAL = os.getenv("LOCK_PASSWORD_INTERVAL")
 
 # init service
 message_api_client = MessageApiClient(APP_ID, APP_SECRET, LARK_HOST)
-event_manager = EventManager()
+event_manager = EventManager(VERIFICATION_TOKEN, ENCRYPT_KEY)
 database = RedisConnect()
+# scheduled jobs on shared data run only on the leader instance
+leader = LeaderLease(database.conn)
 command_parser = CommandParser(
     message_api_callback = message_api_client.reply_text_with_message_id,
     message_api_callback_text_argname = 'content',
     check_user_is_admin = message_api_client.check_user_is_admin,
-    database = database
+    database = database,
+    message_api_reply_card = message_api_client.reply_card_with_message_id,
+    message_api_update_card = message_api_client.update_card_with_message_id,
+    message_api_batch_send = message_api_client.batch_send_text,
+    message_api_send_user = message_api_client.send_text_to_user
 )
 
 def shutdown():
@@ -54,30 +66,36 @@ def shutdown():
         raise RuntimeError('Not running werkzeug')
     shutdown_func()
 
-# init scheduler
-# scheduler = sched.scheduler(time.time, time.sleep)
-scheduler = APScheduler()
-scheduler.init_app(app)
-
-@scheduler.task('cron', id = 'lock_all_password_scheduler', hour = 4)
-def lock_all_password_scheduler():
-    res = lock_all_password()
-    if res is not None:
-        logging.warning(f'error in lock_all_password: {res}')
-
-@scheduler.task('interval', id = 'daily_shutdown_scheduler', days = 1)
-def daily_shutdown_scheduler():
-    # import requests
-    # requests.get('http://localhost:29980/shutdown_the_server')
-    os.system('pkill -2 python')
-
-scheduler.start()
+# set when Redis and Lark token are ready, see /ready
+ready = threading.Event()
+
+
+def start_background(hosts = False):
+    """
+    start scheduler and warm up in background, so requests are served 
+    as soon as the module is imported. the scheduler does not wait for 
+    warm up, so passwords are locked even if Lark is unreachable.
+    args:
+        hosts: update /etc/hosts first.
+    """
+    if hosts:
+        update_hosts()
+    # init scheduler
+    # scheduler = sched.scheduler(time.time, time.sleep)
+    from flask_apscheduler import APScheduler
+    scheduler = APScheduler()
+    scheduler.init_app(app)
+    leader.start()
+    register_tasks(scheduler, database, leader)
+    scheduler.start()
+    warm_up(database, message_api_client.warm_up, ready)
 
 
 @event_manager.register("url_verification")
 def request_url_verify_handler(req_data: UrlVerificationEvent):
     # url verification, just need return challenge
-    if req_data.event.token != VERIFICATION_TOKEN:
+    if not CallbackVerifier.same_string(req_data.event.token, 
+                                        VERIFICATION_TOKEN):
         raise Exception("VERIFICATION_TOKEN is invalid")
     return jsonify({"challenge": req_data.event.challenge})
 
@@ -86,52 +104,46 @@ def request_url_verify_handler(req_data: UrlVerificationEvent):
 def message_receive_event_handler(req_data: MessageReceiveEvent):
     message = req_data.event.message
     if message.message_type != "text":
-        logging.warning("Other types of messages have not been processed yet")
+        logging.info("Other types of messages have not been processed yet")
         return jsonify()
         # get open_id and text_content
     message_id = message.message_id
     user_id = req_data.event.sender.sender_id.user_id
-    msg_ptime = database.message_id_last_process_time(message_id)
-    if msg_ptime == 0:
-        # echo text message
-        # message_api_client.send_text_with_open_id(open_id, text_content)
-        # message_api_client.reply_text_with_message_id(message_id, text_content)
-        # message_api_client.reply_user_id(message_id, user_id)
-        logging.warning('is admin? '
-                        f'{message_api_client.check_user_is_admin(user_id)}')
-        command_parser.parse(req_data, {'message_id': message_id})
-        # raise NotImplementedError
-        pass
-    else:
-        logging.warning("message that has received bebore!")
+    with log_context(request_id = message_id):
+        msg_ptime = database.message_id_last_process_time(message_id)
+        if msg_ptime == 0:
+            # echo text message
+            # message_api_client.send_text_with_open_id(open_id, text_content)
+            # message_api_client.reply_text_with_message_id(message_id, text_content)
+            # message_api_client.reply_user_id(message_id, user_id)
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                is_admin = message_api_client.check_user_is_admin(user_id)
+                logging.debug(f'is admin? {is_admin}')
+            command_parser.parse(req_data, {'message_id': message_id})
+            # raise NotImplementedError
+            pass
+        else:
+            logging.info("message that has received bebore!")
     return jsonify()
 
 
 @event_manager.register("alert_manager")
 def alert_manager_event_handler(req_data: AlertManagerEvent):
     data = req_data.event
-    logging.warning(f'alertmanager: {req_data.dict}')
+    logging.info(f'alertmanager: {req_data.dict}')
     for alert in data.alerts:
-        status = alert.status
-        title = alert.labels.alertname
-        try:
-            rule_id = alert.labels.__alert_rule_uid__
-        except:
-            rule_id = None
-        fingerprint = alert.fingerprint
-        if '__value_string__' in dir(alert.annotations):
-            detail = parse_alertmanager_value_string(alert.annotations.__value_string__)
-        else:
-            detail = []
-        # detail = json.loads(alert.annotations.__value_string__)
-        message = generate_alert_card(status, title, detail, rule_id, fingerprint)
-        message_api_client.send(
-            'chat_id', 
-            ALERT_GROUP_NUMBER, 
-            'interactive',
-            message
-        )
-        # logging.warning(detail)
+        title, message = alertmanager_card(alert)
+        # a failed chat should not stop the others
+        for chat_id in alert_router.route(vars(alert.labels)):
+            try:
+                message_api_client.send(
+                    'chat_id', 
+                    chat_id, 
+                    'interactive',
+                    message
+                )
+            except Exception as e:
+                logging.error(f'send alert {title} to {chat_id} failed: {e}')
     return jsonify()
 
 
@@ -139,6 +151,7 @@ def alert_manager_event_handler(req_data: AlertManagerEvent):
 def msg_error_handler(ex):
     logging.error(ex)
     response = jsonify(message=str(ex))
+    import requests
     response.status_code = (
         ex.response.status_code if isinstance(ex, requests.HTTPError) else 500
     )
@@ -148,22 +161,47 @@ def msg_error_handler(ex):
 @app.route("/", methods=["POST"])
 def callback_event_handler():
     # init callback instance and handle
-    event_handler, event = event_manager.get_handler_with_event(VERIFICATION_TOKEN, ENCRYPT_KEY)
+    try:
+        event_handler, event = event_manager.get_handler_with_event()
+    except InvalidEventException as e:
+        logging.warning(e)
+        return jsonify(message=str(e)), e.status_code
 
     return event_handler(event)
 
 
+@app.route("/telemetry", methods=["POST"])
+def telemetry_handler():
+    # usage pushed by bash-scripts/monitor-agent
+    res, status, headers = telemetry.receive(
+        database, request.headers, request.get_data())
+    return jsonify(res), status, headers
+
+
+@app.route("/ready", methods=["GET"])
+def ready_handler():
+    # 200 when Redis and Lark token are ready, else 503
+    if not ready.is_set():
+        return jsonify(ready = False), 503
+    return jsonify(ready = True)
+
+
 @app.route("/shutdown_the_server", methods=["GET"])
 def shutdown():
     shutdown_func = request.environ.get('werkzeug.server.shutdown')
     if shutdown_func is None:
         raise RuntimeError('Not running werkzeug')
-    logging.error('try shutdown')
+    logging.warning('try shutdown')
     shutdown_func()
-    logging.error('shutdown over?')
+    logging.warning('shutdown over?')
     return jsonify("shutdown")
 
+threading.Thread(
+    target = start_background, 
+    kwargs = {'hosts': __name__ == "__main__"},
+    daemon = True
+).start()
+
 if __name__ == "__main__":
     # init()
-    update_hosts()
     app.run(host="0.0.0.0", port=29980, debug=True)
@@ -1,38 +1,346 @@
 import os
+import re
+import asyncio
+import time
+import shlex
+import hashlib
+import signal
 import logging
-from subprocess import PIPE, Popen
+import selectors
+from collections import namedtuple
+from subprocess import PIPE, DEVNULL, Popen, TimeoutExpired
 from dotenv import load_dotenv, find_dotenv
 from multiprocessing.dummy import Pool as DummyPool
 from multiprocessing import Pool
+from utils import SingleFlight, AsyncSingleFlight
+from health import HostHealth
+from inventory import inventory
+from log import log_context
 
 
 load_dotenv(find_dotenv())
 
 
-available_servers = open('ENV/available_servers').read().strip().split('\n')
-master_server = open('ENV/master_server').read().strip()
+def available_servers():
+    """
+    nicknames of servers that users can use, see inventory.HostInventory.
+    """
+    return inventory.available_servers()
+
+
+def master_server():
+    return inventory.master_server()
+
+
+# identical remote queries running at the same time share one SSH session.
+# successful results are reused for REMOTE_QUERY_CACHE_TTL seconds.
+remote_query_flight = SingleFlight()
+aremote_query_flight = AsyncSingleFlight()
+REMOTE_QUERY_CACHE_TTL = float(os.getenv('REMOTE_QUERY_CACHE_TTL', 0))
+
+# hard deadline of one command, and max bytes kept of stdout and stderr
+SSH_TIMEOUT = float(os.getenv('SSH_TIMEOUT', 60))
+SSH_MAX_OUTPUT = int(os.getenv('SSH_MAX_OUTPUT', 1024 * 1024))
+
+BASH_SCRIPTS_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'bash-scripts')
+# end of here-document used by run_remote_script
+REMOTE_STDIN_EOF = '__LARK_BOT_STDIN_EOF__'
+
+# health of servers. after HOST_FAILURE_THRESHOLD connection failures in a 
+# row, a server is skipped for HOST_RETRY_SECONDS, then probed again.
+host_health = HostHealth(
+    int(os.getenv('HOST_FAILURE_THRESHOLD', 3)),
+    float(os.getenv('HOST_RETRY_SECONDS', 60)),
+    probe_timeout = SSH_TIMEOUT
+)
+
+# result of exec_cmd. duration is in seconds. timed_out means killed by
+# deadline, truncated means stdout or stderr exceeds max output.
+CommandResult = namedtuple('CommandResult', [
+    'returncode', 'stdout', 'stderr', 'duration', 'timed_out', 'truncated'
+])
+
+
+def exec_cmd(cmd, timeout = None, input = None, max_output = None):
+    """
+    run cmd in shell with a hard deadline. stdout and stderr are read 
+    while the command runs, and at most max_output bytes of each are kept,
+    so large output never blocks the command. if the deadline passes, the 
+    whole process group is killed.
+    args:
+        timeout: seconds, default SSH_TIMEOUT.
+        input: string written to stdin. if None, stdin is /dev/null.
+        max_output: bytes, default SSH_MAX_OUTPUT.
+
+    return: CommandResult
+    """
+    timeout = SSH_TIMEOUT if timeout is None else timeout
+    max_output = SSH_MAX_OUTPUT if max_output is None else max_output
+    logging.debug('running command: %s', cmd)
+    start = time.monotonic()
+    deadline = start + timeout
+    p = Popen(cmd, shell = True, stdout = PIPE, stderr = PIPE,
+              stdin = DEVNULL if input is None else PIPE,
+              start_new_session = True)
+    outputs = {p.stdout: bytearray(), p.stderr: bytearray()}
+    truncated = False
+    timed_out = False
+    selector = selectors.DefaultSelector()
+    selector.register(p.stdout, selectors.EVENT_READ)
+    selector.register(p.stderr, selectors.EVENT_READ)
+    pending = None
+    if input is not None:
+        pending = memoryview(input.encode('utf8'))
+        if len(pending):
+            os.set_blocking(p.stdin.fileno(), False)
+            selector.register(p.stdin, selectors.EVENT_WRITE)
+        else:
+            p.stdin.close()
+    while len(selector.get_map()):
+        left = deadline - time.monotonic()
+        if left <= 0:
+            timed_out = True
+            break
+        for key, _ in selector.select(left):
+            f = key.fileobj
+            if f is p.stdin:
+                try:
+                    pending = pending[os.write(f.fileno(), pending[:65536]):]
+                except BlockingIOError:
+                    continue
+                except BrokenPipeError:
+                    pending = pending[:0]
+                if len(pending) == 0:
+                    selector.unregister(f)
+                    f.close()
+                continue
+            data = os.read(f.fileno(), 65536)
+            if not data:
+                selector.unregister(f)
+                continue
+            buffer = outputs[f]
+            room = max_output - len(buffer)
+            if len(data) > room:
+                # keep reading to drain the pipe, but drop the data
+                truncated = True
+                data = data[:max(room, 0)]
+            buffer += data
+    selector.close()
+    if not timed_out:
+        try:
+            p.wait(max(0, deadline - time.monotonic()))
+        except TimeoutExpired:
+            timed_out = True
+    if timed_out:
+        _kill_group(p.pid)
+        p.wait()
+    for f in [p.stdin, p.stdout, p.stderr]:
+        if f is not None and not f.closed:
+            f.close()
+    return _command_result(
+        cmd, p.returncode, outputs[p.stdout], outputs[p.stderr], start, 
+        timeout, timed_out, truncated, max_output)
+
+
+def _kill_group(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _command_result(cmd, returncode, stdout, stderr, start, timeout, 
+                    timed_out, truncated, max_output):
+    duration = time.monotonic() - start
+    stdout = stdout.decode('utf8', errors = 'replace')
+    stderr = stderr.decode('utf8', errors = 'replace')
+    if timed_out:
+        logging.error(f'command timed out after {timeout}s: {cmd}')
+        stderr += f'\ncommand timed out after {timeout}s'
+    if truncated:
+        stderr += f'\noutput truncated to {max_output} bytes'
+    return CommandResult(
+        returncode, stdout, stderr, duration, timed_out, truncated)
+
+
+async def aexec_cmd(cmd, timeout = None, input = None, max_output = None):
+    """
+    coroutine version of exec_cmd, used by asgi.py. the event loop is not 
+    blocked while the command runs. if the caller is cancelled, the 
+    process group is killed too.
+
+    return: CommandResult
+    """
+    timeout = SSH_TIMEOUT if timeout is None else timeout
+    max_output = SSH_MAX_OUTPUT if max_output is None else max_output
+    logging.debug('running command: %s', cmd)
+    start = time.monotonic()
+    p = await asyncio.create_subprocess_shell(
+        cmd, stdout = PIPE, stderr = PIPE, 
+        stdin = DEVNULL if input is None else PIPE, 
+        start_new_session = True)
+    stdout = bytearray()
+    stderr = bytearray()
+    truncated = False
+    timed_out = False
+
+    async def read(stream, buffer):
+        nonlocal truncated
+        while True:
+            data = await stream.read(65536)
+            if not data:
+                return
+            room = max_output - len(buffer)
+            if len(data) > room:
+                # keep reading to drain the pipe, but drop the data
+                truncated = True
+                data = data[:max(room, 0)]
+            buffer += data
+
+    async def write():
+        if input is None:
+            return
+        try:
+            p.stdin.write(input.encode('utf8'))
+            await p.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        p.stdin.close()
+
+    async def communicate():
+        await asyncio.gather(
+            read(p.stdout, stdout), read(p.stderr, stderr), write(), 
+            p.wait())
+
+    try:
+        await asyncio.wait_for(communicate(), timeout)
+    except asyncio.TimeoutError:
+        timed_out = True
+    finally:
+        if p.returncode is None:
+            _kill_group(p.pid)
+    if timed_out:
+        await p.wait()
+    return _command_result(
+        cmd, p.returncode, stdout, stderr, start, timeout, timed_out, 
+        truncated, max_output)
+
+
+def _known_down_result(server):
+    return CommandResult(
+        255, '', host_health.down_message(server), 0.0, False, False)
+
+
+def _unknown_server_result(server):
+    return CommandResult(
+        255, '', f'unrecognized server name: {server}', 0.0, False, False)
+
+
+def exec_on_server(server, cmd, **kwargs):
+    """
+    exec_cmd for a command that only connects to server. if server is 
+    known down, return a failed result instantly; otherwise the result is
+    recorded in host_health. kwargs are passed to exec_cmd.
+    """
+    if not host_health.allow(server):
+        return _known_down_result(server)
+    try:
+        with log_context(host = server):
+            res = exec_cmd(cmd, **kwargs)
+        host_health.record(server, res)
+    finally:
+        host_health.release(server)
+    return res
+
+
+async def aexec_on_server(server, cmd, **kwargs):
+    """
+    coroutine version of exec_on_server.
+    """
+    if not host_health.allow(server):
+        return _known_down_result(server)
+    try:
+        with log_context(host = server):
+            res = await aexec_cmd(cmd, **kwargs)
+        host_health.record(server, res)
+    finally:
+        host_health.release(server)
+    return res
+
 
+def _probe_server(server, timeout = 10):
+    with log_context(host = server):
+        return server, exec_cmd(
+            f'ssh -o ConnectTimeout={timeout} -o BatchMode=yes {server} true',
+            timeout = timeout + 5)
 
-def exec_cmd(cmd):
-    logging.warning(f'running command: {cmd}')
-    p = Popen(cmd, shell = True, stdout = PIPE, stderr = PIPE)
-    p.wait()
-    stdout, stderr = p.communicate()
-    return p.returncode, stdout.decode('utf8'), stderr.decode('utf8')
+
+def probe_down_servers(pool = 5):
+    """
+    cheaply check servers that are known down and waited long enough, so 
+    user requests do not need to wait for them. expected to run 
+    periodically in background.
+    """
+    servers = [x for x in host_health.down_servers() if host_health.allow(x)]
+    if len(servers) == 0:
+        return
+    pool = DummyPool(pool)
+    pending = set(servers)
+    try:
+        for server, res in pool.imap_unordered(_probe_server, servers):
+            host_health.record(server, res)
+            pending.discard(server)
+    finally:
+        pool.close()
+        pool.join()
+        for server in pending:
+            host_health.release(server)
 
 
 def change_password(server, user, password):
-    cmd = f""" ssh {server} "echo '{user}:{password}' | chpasswd" """
-    return exec_cmd(cmd)
+    return change_passwords(server, [(user, password)])
 
 
-def change_password_w(args):
-    return change_password(*args)
+def change_passwords(server, user_passwords):
+    """
+    change passwords of many users in one SSH session. `user:password' 
+    lines are fed to chpasswd by stdin, so they never appear in command 
+    line. user_passwords is a list of (user, password).
+    """
+    lines = ''.join(f'{user}:{password}\n' for user, password in user_passwords)
+    return exec_cmd(f'ssh {server} chpasswd', input = lines)
 
 
-def lock_password(server):
-    users = open('ENV/available_accounts').read().strip().split('\n')
-    users = users + ['mdm']
+def chpasswd_failed_users(result, users):
+    """
+    users failed in result of change_passwords. chpasswd reports failed 
+    lines like `chpasswd: line 2: ...' and continues other lines. if 
+    failed lines are unknown, e.g. server is down, or chpasswd ignores all
+    changes after an error, all users are failed.
+
+    return: {user: reason}
+    """
+    if result.returncode == 0:
+        return {}
+    failed = {}
+    for line in result.stderr.split('\n'):
+        found = re.search(r'line (\d+)', line)
+        if found and 1 <= int(found.group(1)) <= len(users):
+            failed[users[int(found.group(1)) - 1]] = line.strip()
+    if len(failed) == 0 or 'changes ignored' in result.stderr:
+        reason = result.stderr.strip().split('\n')[-1]
+        failed = {user: failed.get(user, reason) for user in users}
+    return failed
+
+
+def lock_password(server, users = None):
+    """
+    lock password of users in server. default all accounts and mdm.
+    """
+    if users is None:
+        users = open('ENV/available_accounts').read().strip().split('\n')
+        users = users + ['mdm']
     cmd = f"""ssh {server} " """
     for user in users:
         cmd += f""" passwd -l {user}; """
@@ -40,119 +348,405 @@ def lock_password(server):
     return exec_cmd(cmd)
 
 
-def get_auth_keys(server, user):
-    cmd = (
-        f""" ssh {server} " """
-        f""" if [[ ! -e /home/{user}/.ssh ]]; then """
-        f"""   mkdir /home/{user}/.ssh; """
-        f"""   chown {user}:{user} /home/{user}/.ssh; """
-        f""" fi; """
-        f""" if [[ ! -e /home/{user}/.ssh/authorized_keys ]]; then """
-        f"""   touch /home/{user}/.ssh/authorized_keys; """
-        f"""   chmod 600 /home/{user}/.ssh/authorized_keys; """
-        f"""   chown {user}:{user} /home/{user}/.ssh/authorized_keys; """
-        f""" fi; """
-        f""" cat /home/{user}/.ssh/authorized_keys;" """
-    )
-    return exec_cmd(cmd)
+def run_remote_script(server, script, args = (), stdin_lines = None, 
+                      **kwargs):
+    """
+    run a bash script in server over one SSH session. script defines 
+    functions, and its last command is built from args (shell quoted), 
+    with stdin_lines passed as a quoted here-document. kwargs are passed to
+    exec_cmd.
+    """
+    cmd = ' '.join(shlex.quote(str(x)) for x in args)
+    if stdin_lines is not None:
+        for line in stdin_lines:
+            if '\n' in line or '\r' in line or line == REMOTE_STDIN_EOF:
+                return CommandResult(
+                    1, '', f'invalid input line: {line!r}', 0.0, False, False)
+        cmd += f" <<'{REMOTE_STDIN_EOF}'\n" + ''.join(
+            x + '\n' for x in stdin_lines) + REMOTE_STDIN_EOF
+    return exec_cmd(
+        f'ssh {server} bash -s', input = script + '\n' + cmd + '\n', 
+        **kwargs)
+
+
+def _run_on_server(job):
+    func, server, args = job
+    with log_context(host = server):
+        return server, func(*args)
+
+
+def fan_out(func, jobs, pool = 5):
+    """
+    run func(*args) for every (server, args) in jobs, pool parallel number 
+    with multiprocessing. results are yielded as (server, result) as soon 
+    as each server finishes, not in order of jobs. func should return a
+    CommandResult, which is recorded in host_health. servers that are known
+    down are not run, and failed results are yielded first.
+    """
+    run_jobs = []
+    for server, args in jobs:
+        if host_health.allow(server):
+            run_jobs.append((func, server, args))
+        else:
+            yield server, _known_down_result(server)
+    if len(run_jobs) == 0:
+        return
+    pool = Pool(pool)
+    pending = set(x[1] for x in run_jobs)
+    try:
+        for server, res in pool.imap_unordered(_run_on_server, run_jobs):
+            host_health.record(server, res)
+            pending.discard(server)
+            yield server, res
+    finally:
+        pool.close()
+        pool.join()
+        # servers without result, if a job raised or the caller stopped
+        for server in pending:
+            host_health.release(server)
+
+
+async def afan_out(func, jobs, pool = 5):
+    """
+    coroutine version of fan_out, func is a coroutine function. at most 
+    pool servers run at the same time, in one thread. results are yielded 
+    as (server, result) as soon as each server finishes.
+    """
+    semaphore = asyncio.Semaphore(pool)
+
+    async def run(server, args):
+        if not host_health.allow(server):
+            return server, _known_down_result(server)
+        try:
+            async with semaphore:
+                res = await func(*args)
+            host_health.record(server, res)
+        finally:
+            host_health.release(server)
+        return server, res
+
+    tasks = [asyncio.ensure_future(run(x, y)) for x, y in jobs]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def _collect_errors(results, on_result = None):
+    """
+    consume (server, CommandResult) from fan_out. on_result is called with
+    (server, CommandResult) for every server.
+
+    return: if all success, none. else, a dict: 
+        {error_server_name: { stdout: xxx, stderr: yyy } }
+    """
+    errors = {}
+    for server, res in results:
+        if on_result is not None:
+            on_result(server, res)
+        if res.returncode != 0:
+            errors[server] = {'stdout': res.stdout, 'stderr': res.stderr}
+    if len(errors):
+        return errors
 
 
-def set_auth_keys(server, user, auth_keys):
-    cmd = (
-        f""" ssh {server} "echo {auth_keys} | tr ':' '\\n' """
-        f""" > /home/{user}/.ssh/authorized_keys;" """
-    )
-    return exec_cmd(cmd)
+def password_servers(user):
+    """
+    servers to change password of user.
+    """
+    servers = available_servers()
+    if user == 'mdm':
+        # if set mdm password, then include self
+        servers = servers + [master_server()]
+    return servers
+
+
+def lock_servers():
+    """
+    servers to lock password.
+    """
+    return available_servers() + [master_server()]
 
 
-def change_all_password(user, password, pool = 5):
+def change_all_password(user, password, pool = 5, on_result = None):
     """
     change all password in servers, pool parallel number with multiprocessing.
+    on_result is called when each server finishes, see _collect_errors.
 
     return: if all success, none. else, a dict: 
         {error_server_name: { stdout: xxx, stderr: yyy } }
     """
-    pool = Pool(pool)
-    args = []
-    servers = available_servers[:]
-    if user == 'mdm':
-        # if set mdm password, then include self
-        servers = servers + [master_server]
-    for i in servers:
-        args.append([i, user, password])
-    errors = {}
-    for server, [retcode, res_out, res_err] \
-            in zip(servers, pool.imap(change_password_w, args)):
-        # logging.warning(str((retcode, res_out, res_err)))
-        if retcode != 0:
-            errors[server] = {'stdout': res_out, 'stderr': res_err}
-    pool.close()
-    pool.join()
-    if len(errors):
-        return errors
+    jobs = [(i, [i, user, password]) for i in password_servers(user)]
+    return _collect_errors(fan_out(change_password, jobs, pool), on_result)
 
 
-def lock_all_password(pool = 5):
+def change_all_passwords(user_passwords, pool = 5, on_result = None):
+    """
+    change passwords of many users in all servers, one SSH session per 
+    server. user_passwords is a list of (user, password). on_result is 
+    called when each server finishes, see _collect_errors.
+
+    return: {user: {failed_server_name: reason}}, empty dict for users 
+        success in all servers.
+    """
+    server_users = {}
+    for user, password in user_passwords:
+        for server in password_servers(user):
+            server_users.setdefault(server, []).append((user, password))
+    jobs = [(i, [i, users]) for i, users in server_users.items()]
+    results = {user: {} for user, _ in user_passwords}
+    for server, res in fan_out(change_passwords, jobs, pool):
+        if on_result is not None:
+            on_result(server, res)
+        users = [x[0] for x in server_users[server]]
+        for user, reason in chpasswd_failed_users(res, users).items():
+            results[user][server] = reason
+    return results
+
+
+def lock_all_password(pool = 5, on_result = None):
     """
     lock all password in servers, pool parallel number with multiprocessing.
-    expected to run daily.
+    expected to run daily. on_result is called when each server finishes, 
+    see _collect_errors.
 
     return: if all success, none. else, a dict: 
         {error_server_name: { stdout: xxx, stderr: yyy } }
     """
-    pool = Pool(pool)
-    errors = {}
-    servers = available_servers + [master_server]
-    for server, [retcode, res_out, res_err] \
-            in zip(servers, pool.imap(lock_password, servers)):
-        # logging.warning(str((retcode, res_out, res_err)))
-        if retcode != 0:
-            errors[server] = {'stdout': res_out, 'stderr': res_err}
-    pool.close()
-    pool.join()
-    if len(errors):
-        return errors
+    jobs = [(i, [i]) for i in lock_servers()]
+    return _collect_errors(fan_out(lock_password, jobs, pool), on_result)
+
+
+def lock_passwords(server_users, pool = 5, on_result = None):
+    """
+    lock password of selected users, server_users is {server: [users]}.
+    one SSH session per server. on_result is called when each server 
+    finishes, see _collect_errors.
+
+    return: if all success, none. else, a dict: 
+        {error_server_name: { stdout: xxx, stderr: yyy } }
+    """
+    jobs = [(i, [i, users]) for i, users in server_users.items()]
+    return _collect_errors(fan_out(lock_password, jobs, pool), on_result)
 
 
 def change_auth_keys(server, user, auth_keys):
     """
     update authorize keys. ath_keys is list of keys.
-    will get current auth_keys, remove keys with auth_tag, and add new 
-    auth_keys with auth_tag.
+    in one SSH session, remove current keys with auth_tag, and add new 
+    auth_keys with auth_tag, see bash-scripts/auth-keys.sh.
 
-    return: if success, 0, none, none. else, 1, stdout, stderr
+    return: CommandResult, stdout is the digest of new authorized_keys.
     """
     auth_tag = os.getenv('AUTH_KEY_TAG')
-    retcode, out, err = get_auth_keys(server, user)
-    if retcode != 0:
-        return retcode, out, err
-    current_keys = [x for x in out.strip().split('\n') if auth_tag not in x]
-    for key in auth_keys:
-        current_keys.append(f'{key} {auth_tag}')
-    retcode, out, err = set_auth_keys(server, user, ':'.join(current_keys))
-    if retcode != 0:
-        return retcode, out, err
-    return 0, None, None
+    script = open(f'{BASH_SCRIPTS_DIR}/auth-keys.sh').read()
+    return run_remote_script(
+        server, script, ['apply_auth_keys', user, auth_tag], auth_keys)
 
 
-def change_auth_keys_w(args):
-    return change_auth_keys(*args)
+def change_all_auth_keys(user, auth_keys, pool = 5, on_result = None):
+    """
+    update authorize keys of user in all servers. on_result is called when 
+    each server finishes, see _collect_errors.
 
+    return: if all success, none. else, a dict: 
+        {error_server_name: { stdout: xxx, stderr: yyy } }
+    """
+    jobs = [(i, [i, user, auth_keys]) for i in available_servers()]
+    return _collect_errors(fan_out(change_auth_keys, jobs, pool), on_result)
 
-def change_all_auth_keys(user, auth_keys, pool = 5):
-    pool = Pool(pool)
-    args = []
-    for i in available_servers:
-        args.append([i, user, auth_keys])
-    errors = {}
-    for server, [retcode, res_out, res_err] \
-            in zip(available_servers, pool.imap(change_auth_keys_w, args)):
-        if retcode != 0:
-            errors[server] = {'stdout': res_out, 'stderr': res_err}
-    pool.close()
-    pool.join()
-    if len(errors):
-        return errors
+
+def change_many_auth_keys(server, user_keys):
+    """
+    update authorize keys of many users in one SSH session. user_keys is
+    {user: [keys]}, empty list removes all keys with auth_tag.
+
+    return: CommandResult, stdout lines are `user ok' or `user failed'.
+    """
+    auth_tag = os.getenv('AUTH_KEY_TAG')
+    script = open(f'{BASH_SCRIPTS_DIR}/auth-keys.sh').read()
+    lines = []
+    for user, auth_keys in user_keys.items():
+        lines += [f'{user} {x}' for x in auth_keys] or [user]
+    return run_remote_script(
+        server, script, ['apply_many_auth_keys', auth_tag], lines)
+
+
+def reconcile_auth_keys(server_user_keys, pool = 5):
+    """
+    update authorize keys of selected users, server_user_keys is
+    {server: {user: [keys]}}. one SSH session per server, pool servers at
+    the same time.
+
+    return: {server: [users updated]}
+    """
+    jobs = [(i, [i, user_keys]) for i, user_keys in server_user_keys.items()]
+    results = {}
+    for server, res in fan_out(change_many_auth_keys, jobs, pool):
+        results[server] = [
+            x.split()[0] for x in res.stdout.strip().split('\n')
+            if x.endswith(' ok') and x.split()[0] in server_user_keys[server]
+        ]
+        if res.returncode != 0:
+            logging.warning(
+                f'update public keys in {server} failed: {res.stderr}')
+    return results
+
+
+def auth_keys_digest(auth_keys):
+    """
+    sha256 of lines that change_auth_keys writes for auth_keys, same as
+    digests from get_auth_keys_digests if keys in server are not changed.
+    """
+    auth_tag = os.getenv('AUTH_KEY_TAG')
+    lines = ''.join(f'{x} {auth_tag}\n' for x in auth_keys)
+    return hashlib.sha256(lines.encode('utf8')).hexdigest()
+
+
+def get_auth_keys_digests(server, users):
+    """
+    digests of keys with auth_tag of users in server, in one SSH session.
+
+    return: CommandResult, stdout lines are `user sha256'.
+    """
+    auth_tag = os.getenv('AUTH_KEY_TAG')
+    script = open(f'{BASH_SCRIPTS_DIR}/auth-keys.sh').read()
+    return run_remote_script(
+        server, script, ['digest_auth_keys', auth_tag] + list(users))
+
+
+def verify_all_auth_keys(user_keys, pool = 5):
+    """
+    check authorize keys of users in all servers by digests, user_keys is
+    {user: [keys]}. servers failed to check are skipped.
+
+    return: list of (user, server) whose keys are different.
+    """
+    if len(user_keys) == 0:
+        return []
+    expected = {x: auth_keys_digest(y) for x, y in user_keys.items()}
+    jobs = [(i, [i, list(user_keys)]) for i in available_servers()]
+    different = []
+    for server, res in fan_out(get_auth_keys_digests, jobs, pool):
+        if res.returncode != 0:
+            logging.warning(
+                f'check public keys in {server} failed: {res.stderr}')
+            continue
+        digests = dict(
+            x.split()[:2] for x in res.stdout.strip().split('\n')
+            if len(x.split()) >= 2
+        )
+        for user, digest in expected.items():
+            if digests.get(user) != digest:
+                different.append((user, server))
+    return different
+
+
+def provision_user(server, user, uid):
+    """
+    create user with uid and home layout in server if not yet, see
+    bash-scripts/setuser.sh. the script is sent by stdin, nothing is
+    written in server's /tmp.
+
+    return: CommandResult, last line of stdout is `status: STATUS'.
+    """
+    script = open(f'{BASH_SCRIPTS_DIR}/setuser.sh').read()
+    return run_remote_script(server, script, ['setup_user', user, uid])
+
+
+def provision_status(result):
+    """
+    status of a provision_user CommandResult: created, updated, unchanged,
+    conflict or error; and the output as detail.
+    """
+    status = 'error'
+    for line in result.stdout.strip().split('\n'):
+        if line.startswith('status: '):
+            status = line[len('status: '):].strip()
+    detail = (result.stdout + result.stderr).strip()
+    return status, detail
+
+
+def provision_all_user(user, uid, pool = 5, on_result = None):
+    """
+    create user in all servers at the same time. servers where user already
+    has uid and home layout are unchanged. on_result is called when each
+    server finishes, see _collect_errors.
+
+    return: {server_name: (status, detail)}, see provision_status.
+    """
+    jobs = [(i, [i, user, uid]) for i in available_servers()]
+    results = {}
+    for server, res in fan_out(provision_user, jobs, pool):
+        if on_result is not None:
+            on_result(server, res)
+        results[server] = provision_status(res)
+    return results
+
+
+def _nvidia_smi_cmds(server):
+    return [f'ssh {server} "nvidia-smi"']
+
+
+def _my_monitor_cmds(server, all):
+    all = '-a' if all else ''
+    return [
+        f'scp {BASH_SCRIPTS_DIR}/my-monitor {server}:/tmp/my-monitor',
+        f'ssh {server} "/tmp/my-monitor -1 {all}"',
+    ]
+
+
+def _query_result(res):
+    if res.returncode != 0:
+        return None, {'stdout': res.stdout, 'stderr': res.stderr}
+    return res.stdout, None
+
+
+def _query_ok(res):
+    return res[0] is not None
+
+
+def _unknown_server():
+    return None, { 'stdout': None, 'stderr': 'unrecognized server name' }
+
+
+def _run_query(server, cmds):
+    # run cmds one by one, stop at the first failure
+    for cmd in cmds:
+        res = exec_on_server(server, cmd)
+        if res.returncode != 0:
+            break
+    return _query_result(res)
+
+
+async def _arun_query(server, cmds):
+    for cmd in cmds:
+        res = await aexec_on_server(server, cmd)
+        if res.returncode != 0:
+            break
+    return _query_result(res)
+
+
+def _remote_query(server, key, cmds):
+    """
+    run query cmds on server by remote_query_flight. if success, return 
+    [stdout of the last command, None], else [None, error_dict]
+    """
+    if not inventory.is_available(server):
+        return _unknown_server()
+    return remote_query_flight.do(
+        key, lambda: _run_query(server, cmds), REMOTE_QUERY_CACHE_TTL,
+        _query_ok)
+
+
+async def _aremote_query(server, key, cmds):
+    if not inventory.is_available(server):
+        return _unknown_server()
+    return await aremote_query_flight.do(
+        key, lambda: _arun_query(server, cmds), REMOTE_QUERY_CACHE_TTL,
+        _query_ok)
 
 
 def get_nvidia_smi(server):
@@ -160,12 +754,8 @@ def get_nvidia_smi(server):
     remote nvidia-smi. if success, return [response, None], 
     else [None, error_dict]
     """
-    if server not in available_servers:
-        return None, { 'stdout': None, 'stderr': 'unrecognized server name' }
-    retcode, out, err = exec_cmd(f'ssh {server} "nvidia-smi"')
-    if retcode != 0:
-        return None, {'stdout': out, 'stderr': err}
-    return out, None
+    return _remote_query(
+        server, ('nvidia-smi', server), _nvidia_smi_cmds(server))
 
 
 def get_my_monitor(server, all = False):
@@ -173,30 +763,107 @@ def get_my_monitor(server, all = False):
     Like nvidia-smi, but scp my-monitor to target server and run. all means 
     show full length command.
     """
-    if server not in available_servers:
-        return None, { 'stdout': None, 'stderr': 'unrecognized server name' }
-    retcode, out, err = exec_cmd(
-        f'scp {os.path.dirname(os.path.abspath(__file__))}/bash-scripts/my-monitor '
-        f'{server}:/tmp/my-monitor'
-    )
-    if retcode != 0:
-        return None, {'stdout': out, 'stderr': err}
-    all = '-a' if all else ''
-    retcode, out, err = exec_cmd(f'ssh {server} "/tmp/my-monitor -1 {all}"')
-    if retcode != 0:
-        return None, {'stdout': out, 'stderr': err}
-    return out, None
+    return _remote_query(
+        server, ('my-monitor', server, all), _my_monitor_cmds(server, all))
 
 
-def clear_cache(server):
+async def aget_nvidia_smi(server):
     """
-    remote clear cache. if success, return [True, None], 
-    else [None, error_dict]
+    coroutine version of get_nvidia_smi.
+    """
+    return await _aremote_query(
+        server, ('nvidia-smi', server), _nvidia_smi_cmds(server))
+
+
+async def aget_my_monitor(server, all = False):
+    """
+    coroutine version of get_my_monitor.
+    """
+    return await _aremote_query(
+        server, ('my-monitor', server, all), _my_monitor_cmds(server, all))
+
+
+def parse_cached(output):
+    """
+    values of `Cached:' lines of /proc/meminfo in output, in kB.
+    """
+    return [
+        int(x.split()[1]) for x in output.split('\n')
+        if x.startswith('Cached:') and len(x.split()) >= 2
+    ]
+
+
+def clear_cache(server, start_at = None):
+    """
+    remote clear cache, page cache size is read before and after in the
+    same SSH session. if start_at (UNIX timestamp) is set, wait until then.
+
+    return: CommandResult, stdout has two `Cached:' lines, see parse_cached.
+        a failed CommandResult if server is not in inventory.
+    """
+    # server is put into a shell command
+    if not inventory.is_available(server):
+        return _unknown_server_result(server)
+    if start_at is not None:
+        time.sleep(max(0, start_at - time.time()))
+    return exec_cmd(_clear_cache_cmd(server))
+
+
+def _clear_cache_cmd(server):
+    return (
+        f'ssh {server} "grep ^Cached: /proc/meminfo; '
+        f'echo 3 > /proc/sys/vm/drop_caches && grep ^Cached: /proc/meminfo"')
+
+
+def _cached_before_after(res):
+    cached = parse_cached(res.stdout)
+    if res.returncode != 0 or len(cached) != 2:
+        return None, None
+    return tuple(cached)
+
+
+def clear_all_cache(servers, pool = 5, stagger = 0, on_result = None):
+    """
+    clear cache of servers, at most pool servers at the same time, and 
+    each server starts at least stagger seconds after the previous one, so 
+    shared storage is not read by all servers at once. on_result is called
+    when each server finishes, see _collect_errors.
+
+    return: {server: (cached kB before, cached kB after)}, both None if 
+        failed.
+    """
+    start = time.time()
+    jobs = [(x, [x, start + i * stagger]) for i, x in enumerate(servers)]
+    results = {}
+    for server, res in fan_out(clear_cache, jobs, pool):
+        if on_result is not None:
+            on_result(server, res)
+        results[server] = _cached_before_after(res)
+    return results
+
+
+async def aclear_cache(server, start_at = None):
+    """
+    coroutine version of clear_cache.
+    """
+    if not inventory.is_available(server):
+        return _unknown_server_result(server)
+    if start_at is not None:
+        await asyncio.sleep(max(0, start_at - time.time()))
+    return await aexec_cmd(_clear_cache_cmd(server))
+
+
+async def aclear_all_cache(servers, pool = 5, stagger = 0, on_result = None):
+    """
+    coroutine version of clear_all_cache, on_result is a coroutine 
+    function.
     """
-    if server not in available_servers:
-        return None, { 'stdout': None, 'stderr': 'unrecognized server name' }
-    retcode, out, err = exec_cmd(f'ssh {server} "echo 3 > /proc/sys/vm/drop_caches"')
-    if retcode != 0:
-        return None, {'stdout': out, 'stderr': err}
-    return True, None
+    start = time.time()
+    jobs = [(x, [x, start + i * stagger]) for i, x in enumerate(servers)]
+    results = {}
+    async for server, res in afan_out(aclear_cache, jobs, pool):
+        if on_result is not None:
+            await on_result(server, res)
+        results[server] = _cached_before_after(res)
+    return results
 
@@ -0,0 +1,98 @@
+import os
+import time
+import logging
+from ssh import probe_down_servers
+
+
+def expire_password_scheduler(database):
+    # each password is locked PASSWORD_EXPIRE_HOURS after generated
+    res = database.expire_password()
+    if res is not None:
+        logging.warning(f'error in expire_password: {res}')
+
+
+def lock_all_password_scheduler(database):
+    # safety net, periodically lock all passwords
+    if not database.full_lock_password_due():
+        return
+    res = database.lock_password(True)
+    if res is not None:
+        logging.warning(f'error in lock_all_password: {res}')
+
+
+def probe_servers_scheduler():
+    # check whether down servers are up again
+    probe_down_servers()
+
+
+def reconcile_auth_keys_scheduler(database):
+    # update public keys in servers that are changed, new or failed before
+    res = database.reconcile_auth_keys()
+    if res is not None:
+        logging.warning(f'error in reconcile_auth_keys: {res}')
+
+
+def verify_auth_keys_scheduler(database):
+    # find public keys in servers that are changed by others
+    res = database.verify_auth_keys()
+    if len(res):
+        logging.warning(f'public keys are different in: {res}')
+
+
+def daily_shutdown_scheduler():
+    # import requests
+    # requests.get('http://localhost:29980/shutdown_the_server')
+    os.system('pkill -2 python')
+
+
+def warm_up(database, get_token, ready, retry_seconds = 5):
+    """
+    connect Redis and get Lark token (by get_token) in background after 
+    startup, retried until both succeed. then set ready (a threading.Event),
+    which is reported by the /ready endpoint. only ready waits for it, 
+    start the scheduler before calling this.
+    """
+    while True:
+        try:
+            database.conn.ping()
+            database.ephemeral.ping()
+            get_token()
+            break
+        except Exception as e:
+            logging.warning(f'warm up failed, retry: {e}')
+            time.sleep(retry_seconds)
+    ready.set()
+    logging.info('ready')
+
+
+def register_tasks(scheduler, database, leader = None):
+    """
+    add background jobs to scheduler. works with both Flask-APScheduler
+    (server.py) and APScheduler (asgi.py) schedulers. with leader (a 
+    leader.LeaderLease), jobs that change shared data run only on the 
+    leader instance; jobs on state of this process run on every instance.
+    """
+    # (func, args, trigger, run only on leader)
+    jobs = [
+        (expire_password_scheduler, [database],
+         {'trigger': 'interval', 'minutes': 1}, True),
+        (lock_all_password_scheduler, [database],
+         {'trigger': 'cron', 'hour': 4}, True),
+        # health of servers is kept in each process
+        (probe_servers_scheduler, [],
+         {'trigger': 'interval', 'seconds': 30}, False),
+        (reconcile_auth_keys_scheduler, [database],
+         {'trigger': 'interval', 'minutes': 1}, True),
+        (verify_auth_keys_scheduler, [database], {
+            'trigger': 'interval',
+            'minutes': int(os.getenv('AUTH_KEYS_VERIFY_MINUTES', 60))
+        }, True),
+        # restarts this process only
+        (daily_shutdown_scheduler, [], {'trigger': 'interval', 'days': 1},
+         False),
+    ]
+    for func, args, trigger, singleton in jobs:
+        job_id = func.__name__
+        if singleton and leader is not None:
+            func = leader.only(func)
+        scheduler.add_job(id = job_id, func = func, args = args, **trigger)
@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import logging
+from dotenv import load_dotenv, find_dotenv
+from event import CallbackVerifier
+from inventory import inventory
+
+
+load_dotenv(find_dotenv())
+
+# shared secret of monitor-agent, telemetry is disabled if not set
+TELEMETRY_TOKEN = os.getenv('TELEMETRY_TOKEN')
+TELEMETRY_MAX_BYTES = int(os.getenv('TELEMETRY_MAX_BYTES', 1024 * 1024))
+# each server can post TELEMETRY_BURST times, then one every
+# TELEMETRY_MIN_INTERVAL seconds
+TELEMETRY_BURST = int(os.getenv('TELEMETRY_BURST', 10))
+TELEMETRY_MIN_INTERVAL = float(os.getenv('TELEMETRY_MIN_INTERVAL', 1))
+
+
+def _number(x):
+    return isinstance(x, (int, float)) and not isinstance(x, bool)
+
+
+def valid_data(data):
+    """
+    whether data matches a sample of monitor-agent: {'cpu', 'mem': [use,
+    all, unit], 'gpus': [[temp, util, mem, mem all]], 'procs': {pid: [gpu
+    index, gpu mem, cpu, mem, user, cmd]}}, user to cmd may be None.
+    """
+    try:
+        mem_use, mem_all, unit = data['mem']
+        if not (_number(data['cpu']) and _number(mem_use)
+                and _number(mem_all) and isinstance(unit, str)):
+            return False
+        for gpu in data['gpus']:
+            if len(gpu) != 4 or not all(_number(x) for x in gpu):
+                return False
+        for pid, row in data['procs'].items():
+            if len(row) != 6 or not isinstance(row[0], int) \
+                    or not _number(row[1]):
+                return False
+            if row[4] is not None and not (
+                    _number(row[2]) and _number(row[3])
+                    and isinstance(row[4], str) and isinstance(row[5], str)):
+                return False
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return False
+    return True
+
+
+def apply_updates(state, updates, received = None):
+    """
+    apply updates posted by bash-scripts/monitor-agent to state of a server.
+    state is None or {'seq', 'time', 'received', 'data'}. an update is
+    {'seq', 'time', 'full': data} or {'seq', 'base', 'time', 'set',
+    'procs'}, a delta is applied only if base is seq of state. updates
+    already applied (sent again after a timeout) are skipped.
+
+    return: (new state, True if a full update is needed)
+        raise ValueError if an update, or the data it gives, is invalid.
+    """
+    received = time.time() if received is None else received
+    for update in updates:
+        if not isinstance(update, dict) or not isinstance(
+                update.get('seq'), int) or not _number(update.get('time')):
+            raise ValueError('invalid seq or time of update')
+        if 'full' in update:
+            state = {'seq': update['seq'], 'data': update['full']}
+        elif state is not None and update['seq'] <= state['seq']:
+            continue
+        elif state is not None and update.get('base') == state['seq']:
+            data = dict(state['data'])
+            data.update(update.get('set', {}))
+            procs = dict(data.get('procs', {}))
+            for pid, row in update.get('procs', {}).items():
+                if row is None:
+                    procs.pop(pid, None)
+                else:
+                    procs[pid] = row
+            data['procs'] = procs
+            state = {'seq': update['seq'], 'data': data}
+        else:
+            return state, True
+        if not valid_data(state['data']):
+            raise ValueError(f'invalid data in update {update["seq"]}')
+        state['time'] = update['time']
+        state['received'] = received
+    return state, False
+
+
+def receive(database, headers, body):
+    """
+    handle a post of monitor-agent, independent of web framework.
+
+    return: (response dict, HTTP status, extra headers)
+    """
+    if not TELEMETRY_TOKEN:
+        return {'message': 'telemetry is disabled'}, 404, {}
+    if not CallbackVerifier.same_string(
+            headers.get('X-Telemetry-Token'), TELEMETRY_TOKEN):
+        return {'message': 'invalid token'}, 403, {}
+    if len(body) > TELEMETRY_MAX_BYTES:
+        return {'message': 'too large'}, 413, {}
+    try:
+        data = json.loads(body)
+        host = data['host']
+        updates = data['updates']
+    except (ValueError, KeyError, TypeError):
+        return {'message': 'invalid body'}, 400, {}
+    if not inventory.is_available(host):
+        return {'message': f'unknown server {host}'}, 400, {}
+    allowed, wait = database.take_rate_limit_token([
+        (f'telemetry:{host}', TELEMETRY_BURST, TELEMETRY_MIN_INTERVAL)])
+    if not allowed:
+        return {'message': 'too many posts'}, 429, {
+            'Retry-After': str(int(wait) + 1)}
+    try:
+        state, need_full = apply_updates(
+            database.get_telemetry(host), updates)
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        logging.warning(f'invalid telemetry of {host}: {e}')
+        return {'message': 'invalid update'}, 400, {}
+    if state is not None:
+        database.set_telemetry(host, state)
+    return {
+        'seq': None if state is None else state['seq'],
+        'need_full': need_full,
+    }, 200, {}
+
+
+def _age(state, now):
+    return f'{max(0, now - state["received"]):.0f}s ago'
+
+
+def _percent(a, b):
+    return a / b * 100 if b else 0
+
+
+def format_server(server, state, now = None):
+    """
+    usage of one server like my-monitor: CPU, memory, GPUs and processes
+    on each GPU.
+    """
+    now = time.time() if now is None else now
+    data = state['data']
+    if not valid_data(data):
+        return f'{server}: invalid telemetry'
+    mem_use, mem_all, unit = data['mem']
+    lines = [
+        f'{server} ({_age(state, now)})',
+        f'CPU usage: {data["cpu"]:.1f}%, Memory usage: '
+        f'{_percent(mem_use, mem_all):.1f}%, All memory: {mem_all} {unit}',
+    ]
+    gpu_procs = {}
+    for pid, row in data['procs'].items():
+        gpu_procs.setdefault(row[0], []).append((pid, row))
+    for index, (temp, util, gmem, gmem_all) in enumerate(data['gpus']):
+        lines.append('=' * 30)
+        lines.append(
+            f'GPU {index}, Temp:{temp}, Util:{util}%, '
+            f'Mem:{_percent(gmem, gmem_all):.0f}%, TotMem:{gmem_all}MiB')
+        for pid, (_, pmem, cpu, mem, user, cmd) in gpu_procs.get(index, []):
+            if user is None:
+                lines.append(f'{pid:<8}{"???":<8}{pmem}MiB Unknown PID!')
+            else:
+                lines.append(f'{pid:<8}{user:<8}{cpu:.1f}% {mem:.1f}% '
+                             f'{pmem}MiB {cmd[:60]}')
+    return '\n'.join(lines)
+
+
+def format_summary(server, state, now = None):
+    """
+    one line of a server, for many servers.
+    """
+    if state is None:
+        return f'{server}: no telemetry'
+    now = time.time() if now is None else now
+    data = state['data']
+    if not valid_data(data):
+        return f'{server}: invalid telemetry'
+    mem_use, mem_all, _ = data['mem']
+    gpus = data['gpus']
+    gpu_procs = sum(1 for x in data['procs'].values() if x[0] >= 0)
+    text = (f'{server} ({_age(state, now)}): CPU {data["cpu"]:.0f}%, '
+            f'Mem {_percent(mem_use, mem_all):.0f}%')
+    if len(gpus):
+        text += (
+            f', GPU util {"/".join(str(x[1]) for x in gpus)}%, '
+            f'GPU mem {sum(x[2] for x in gpus) // 1024}/'
+            f'{sum(x[3] for x in gpus) // 1024}GiB, '
+            f'{gpu_procs} GPU processes')
+    return text
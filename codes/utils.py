@@ -1,11 +1,15 @@
 #!/usr/bin/env python3.8
 
 
+import time
 import base64
 import logging
 import secrets
 import json
 import logging
+import asyncio
+import threading
+from inventory import inventory
 
 
 class Obj(dict):
@@ -21,9 +25,113 @@ def dict_2_obj(d: dict):
     return Obj(d)
 
 
+class SingleFlight:
+    """
+    coalesce concurrent identical calls. when a call with the same key is
+    running, later callers wait for it and share its result instead of 
+    running again. optionally results are kept for ttl seconds.
+    """
+    class _Call:
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self, max_cached = 256):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._results = {}
+        self._max_cached = max_cached
+
+    def do(self, key, func, ttl = 0, cache_if = None):
+        """
+        run func() once for all concurrent callers with same key.
+        args:
+            key: hashable key to identify identical calls.
+            func: function without arguments.
+            ttl: seconds to keep result for later callers. 0 means no cache.
+            cache_if: if set, only cache result when cache_if(result) is 
+                True.
+        """
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                return cached[1]
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = SingleFlight._Call()
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                if (
+                    ttl > 0 and call.error is None 
+                    and (cache_if is None or cache_if(call.result))
+                ):
+                    self._store(key, call.result, ttl)
+            call.event.set()
+        return call.result
+
+    def _store(self, key, result, ttl):
+        now = time.monotonic()
+        if len(self._results) >= self._max_cached:
+            for k in [k for k, v in self._results.items() if v[0] <= now]:
+                del self._results[k]
+            if len(self._results) >= self._max_cached:
+                self._results.clear()
+        self._results[key] = (now + ttl, result)
+
+
+class AsyncSingleFlight(SingleFlight):
+    """
+    SingleFlight for coroutines in one event loop. concurrent callers with
+    the same key await the same task.
+    """
+    def __init__(self, max_cached = 256):
+        super().__init__(max_cached)
+        self._tasks = {}
+
+    async def do(self, key, func, ttl = 0, cache_if = None):
+        """
+        same as SingleFlight.do, except func is a coroutine function 
+        without arguments.
+        """
+        cached = self._results.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        task = self._tasks.get(key)
+        if task is None:
+            task = self._tasks[key] = asyncio.ensure_future(func())
+            task.add_done_callback(
+                lambda x: self._done(key, x, ttl, cache_if))
+        # a cancelled caller should not cancel the shared task
+        return await asyncio.shield(task)
+
+    def _done(self, key, task, ttl, cache_if):
+        del self._tasks[key]
+        if (
+            ttl > 0 and not task.cancelled() and task.exception() is None
+            and (cache_if is None or cache_if(task.result()))
+        ):
+            self._store(key, task.result(), ttl)
+
+
+def list_available_accounts():
+    return open('ENV/available_accounts').read().strip().split('\n')
+
+
 def is_valid_account_name(account_name):
-    valid = open('ENV/available_accounts').read().strip().split('\n')
-    return account_name in valid
+    return account_name in list_available_accounts()
 
 
 def is_valid_pk(pk):
@@ -122,66 +230,98 @@ def parse_alertmanager_value_string(vs):
     return res
 
 
+# header color of alert cards by status, others are blue
+ALERT_CARD_COLORS = {'firing': 'red', 'resolved': 'green'}
+
+
 def generate_alert_card(status, title, detail, rule_id, fingerprint):
-    template = '{ "config": { "wide_screen_mode": true }, "elements": [ { "tag": "div", "text": { "content": "DETAIL", "tag": "plain_text" } } ], "header": { "template": "COLOR", "title": { "content": "STATUS: TITLE", "tag": "plain_text" } } }'
-    template = json.loads(template)
-    kwargs = {}
-    if status == 'firing':
-        template['header']['template'] = 'red' 
-    elif status == 'resolved':
-        template['header']['template'] = 'green' 
+    card = {
+        'config': {'wide_screen_mode': True},
+        'elements': [{'tag': 'div', 'text': {
+            'content': (
+                '\n'.join([str(x) for x in detail])
+                + '\n' + '-' * 10
+                + f'\nalert rule id: {rule_id}'
+                + f'\nfingerprint: {fingerprint}'
+            ),
+            'tag': 'plain_text',
+        }}],
+        'header': {
+            'template': ALERT_CARD_COLORS.get(status, 'blue'),
+            'title': {
+                'content': f'{status.upper()}: {title}',
+                'tag': 'plain_text'
+            }
+        }
+    }
+    return json.dumps(card)
+
+
+def alertmanager_card(alert):
+    """
+    card of one alert of AlertManager, alert is an object by dict_2_obj.
+
+    return: (title, card)
+    """
+    title = alert.labels.alertname
+    rule_id = getattr(alert.labels, '__alert_rule_uid__', None)
+    if '__value_string__' in dir(alert.annotations):
+        detail = parse_alertmanager_value_string(
+            alert.annotations.__value_string__)
     else:
-        template['header']['template'] = 'blue'
-    template['header']['title']['content'] = f'{status.upper()}: {title}'
-    template['elements'][0]['text']['content'] = (
-        '\n'.join([str(x) for x in detail])
-        + '\n' + '-' * 10
-        + f'\nalert rule id: {rule_id}'
-        + f'\nfingerprint: {fingerprint}'
-    )
-    return json.dumps(template)
+        detail = []
+    return title, generate_alert_card(
+        alert.status, title, detail, rule_id, alert.fingerprint)
+
+
+def generate_text_card(title, text, color = 'blue'):
+    """
+    a card with title and plain text. update_multi is set, so the card can
+    be updated after sent.
+    """
+    card = {
+        'config': {'wide_screen_mode': True, 'update_multi': True},
+        'elements': [
+            {'tag': 'div', 'text': {'content': text, 'tag': 'plain_text'}}
+        ],
+        'header': {
+            'template': color,
+            'title': {'content': title, 'tag': 'plain_text'}
+        }
+    }
+    return json.dumps(card)
 
 
 def list_all_servers():
     """
-    list all server nickname and IP.
+    list all server IP and nickname.
     """
-    server_nickname = open('ENV/available_servers').read().strip().split('\n')
-    hosts = []
-    try:
-        hosts += open('/etc/hosts').read().strip().split('\n')
-    except:
-        pass
-    try:
-        hosts += open('/etc/host_hosts').read().strip().split('\n')
-    except:
-        pass
-    res = []
-    for nickname in server_nickname:
-        for host in hosts:
-            if nickname in host:
-                res.append(host.split())
-                break
-    logging.warning(f'servers: {res}')
+    res = [[x.address, x.name] for x in inventory.hosts()]
+    logging.debug(f'servers: {res}')
     return res
 
 
 def update_hosts():
     """
-    update /etc/host_hosts into /etc/hosts
+    update /etc/host_hosts into /etc/hosts. /etc/hosts is only written when
+    some lines are missing in it.
     """
     hosts = []
-    try:
-        hosts += open('/etc/hosts').read().strip().split('\n')
-    except:
-        pass
-    try:
-        hosts += open('/etc/host_hosts').read().strip().split('\n')
-    except:
-        pass
+    for path in inventory.hosts_paths:
+        try:
+            hosts += open(path).read().strip().split('\n')
+        except:
+            pass
 
     hosts = list(set(hosts))
     hosts.sort()
     hosts_str = '\n'.join(hosts)
-    logging.warning(f"Host updated: \n{hosts_str}")
-    open('/etc/hosts', 'w').write('\n'.join(hosts))
+    try:
+        current = open('/etc/hosts').read().strip().split('\n')
+    except:
+        current = []
+    if sorted(set(current)) == hosts:
+        logging.info('Host not changed')
+        return
+    logging.info(f"Host updated: \n{hosts_str}")
+    open('/etc/hosts', 'w').write(hosts_str)